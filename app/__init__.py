@@ -1,4 +1,5 @@
 # app/__init__.py
+import click
 from flask import Flask
 from .extensions import db, login_manager, csrf, limiter
 from flask_wtf.csrf import CSRFError
@@ -36,6 +37,10 @@ def create_app():
     from .routes.main import bp as main_bp
     app.register_blueprint(main_bp)
 
+    # Background generation jobs (status + SSE progress)
+    from .routes.jobs import bp as jobs_bp
+    app.register_blueprint(jobs_bp)
+
     try:
         from .routes.features import bp as features_bp
         app.register_blueprint(features_bp)
@@ -101,19 +106,34 @@ def create_app():
     except Exception:
         pass
 
+    # Parse and validate workflow templates once (reloaded when files change)
+    try:
+        from backend.workflows import registry as workflow_registry
+        workflow_registry.load_all()
+    except Exception:
+        pass
+
     # Ensure tables
     with app.app_context():
         try:
             db.create_all()
             try:
-                from backend.db_migrate import ensure_user_columns, ensure_image_columns
+                from backend.db_migrate import ensure_user_columns, ensure_image_columns, ensure_billing_indexes
                 ensure_user_columns(db)
                 ensure_image_columns(db)
+                ensure_billing_indexes(db)
             except Exception:
                 pass
         except Exception:
             pass
 
+    @app.cli.command("billing-reconcile")
+    @click.option("--days", default=2, show_default=True, help="Days of usage counters to rebuild")
+    def billing_reconcile(days):
+        """Rebuild credit balances and usage counters from the ledgers."""
+        from .billing import reconcile_counters
+        click.echo(reconcile_counters(days=days))
+
     @app.errorhandler(CSRFError)
     def handle_csrf(err):
         from flask import request, jsonify, redirect, url_for, flash
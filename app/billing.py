@@ -1,13 +1,14 @@
 from __future__ import annotations
 
-from datetime import datetime, timedelta
-from typing import Optional, Tuple
+from datetime import date, datetime, timedelta
+from typing import Dict, Optional, Tuple
 
 from flask import current_app, request
 from sqlalchemy import func
+from sqlalchemy.exc import IntegrityError
 
 from .extensions import db
-from .models import CreditTransaction, ImageResult
+from .models import CreditBalance, CreditTransaction, ImageResult, UsageCounter
 
 
 DAILY_FREE_LIMIT = 10
@@ -43,20 +44,139 @@ def free_remaining(user_id: Optional[int], ip: str) -> int:
     except Exception:
         pass
 
-    start, end = today_range()
-    q = db.session.query(func.count(ImageResult.id)).filter(ImageResult.created_at >= start, ImageResult.created_at < end)
-    if user_id:
-        q = q.filter(ImageResult.user_id == user_id)
-    else:
-        q = q.filter(ImageResult.request_ip == ip)
-    count = int(q.scalar() or 0)
+    count = _usage_counter(_usage_subject(user_id, ip), today_range()[0].date()).count
     remain = max(0, DAILY_FREE_LIMIT - count)
     return remain
 
 
 def balance(user_id: int) -> float:
-    total = db.session.query(func.coalesce(func.sum(CreditTransaction.amount), 0.0)).filter(CreditTransaction.user_id == user_id).scalar() or 0.0
-    return float(total)
+    row = db.session.get(CreditBalance, user_id)
+    if row is None:
+        row = _init_balance(user_id)
+        db.session.commit()
+    return float(row.balance or 0.0)
+
+
+# ---------------------------------------------------------------------------
+# Maintained counters
+#
+# ``credit_balances`` mirrors SUM(credit_transactions.amount) per user and
+# ``usage_counters`` mirrors COUNT(image_results) per user/IP and UTC day.  Both
+# are updated in the same transaction as the ledger / result row they count;
+# a missing row is initialised from the ledger once, and
+# ``reconcile_counters`` rebuilds everything from scratch.
+# ---------------------------------------------------------------------------
+
+def _usage_subject(user_id: Optional[int], ip: str) -> str:
+    return f"user:{user_id}" if user_id else f"ip:{ip or ''}"
+
+
+def _count_results(subject: str, day: date) -> int:
+    start = datetime(day.year, day.month, day.day)
+    q = db.session.query(func.count(ImageResult.id)).filter(
+        ImageResult.created_at >= start, ImageResult.created_at < start + timedelta(days=1)
+    )
+    kind, _, value = subject.partition(":")
+    if kind == "user":
+        q = q.filter(ImageResult.user_id == int(value))
+    else:
+        q = q.filter(ImageResult.request_ip == value)
+    return int(q.scalar() or 0)
+
+
+def _usage_counter(subject: str, day: date) -> UsageCounter:
+    """Counter row for ``subject``/``day``, created from image_results if missing."""
+    row = db.session.get(UsageCounter, (day, subject))
+    if row is not None:
+        return row
+    try:
+        with db.session.begin_nested():
+            row = UsageCounter(day=day, subject=subject, count=_count_results(subject, day))
+            db.session.add(row)
+    except IntegrityError:
+        # Another worker created it first
+        row = db.session.get(UsageCounter, (day, subject))
+    return row
+
+
+def _init_balance(user_id: int) -> CreditBalance:
+    total = db.session.query(func.coalesce(func.sum(CreditTransaction.amount), 0.0)).filter(
+        CreditTransaction.user_id == user_id
+    ).scalar() or 0.0
+    try:
+        with db.session.begin_nested():
+            row = CreditBalance(user_id=user_id, balance=float(total))
+            db.session.add(row)
+    except IntegrityError:
+        row = db.session.get(CreditBalance, user_id)
+    return row
+
+
+def _add_to_balance(user_id: int, amount: float) -> None:
+    """Apply a just-flushed ledger entry to the user's maintained balance."""
+    updated = CreditBalance.query.filter_by(user_id=user_id).update(
+        {CreditBalance.balance: CreditBalance.balance + amount, CreditBalance.updated_at: datetime.utcnow()},
+        synchronize_session="fetch",
+    )
+    if not updated:
+        _init_balance(user_id)  # sums the ledger, which already holds this entry
+
+
+def record_usage(user_id: Optional[int], ip: str, when: Optional[datetime] = None) -> None:
+    """Count one generation for the user and the IP (call with the ImageResult flushed, before commit)."""
+    day = (when or datetime.utcnow()).date()
+    subjects = {_usage_subject(None, ip)}
+    if user_id:
+        subjects.add(_usage_subject(user_id, ip))
+    for subject in subjects:
+        updated = UsageCounter.query.filter_by(day=day, subject=subject).update(
+            {UsageCounter.count: UsageCounter.count + 1}, synchronize_session="fetch"
+        )
+        if not updated:
+            _usage_counter(subject, day)  # counts image_results, which already holds this one
+
+
+def reconcile_counters(days: int = 2) -> Dict[str, int]:
+    """Rebuild balances and the last ``days`` of usage counters from the ledgers."""
+    balances = dict(
+        db.session.query(CreditTransaction.user_id, func.coalesce(func.sum(CreditTransaction.amount), 0.0))
+        .group_by(CreditTransaction.user_id)
+        .all()
+    )
+    for row in CreditBalance.query.all():
+        row.balance = float(balances.pop(row.user_id, 0.0))
+    for user_id, total in balances.items():
+        db.session.add(CreditBalance(user_id=user_id, balance=float(total)))
+
+    start = today_range()[0] - timedelta(days=max(0, days - 1))
+    counts: Dict[Tuple[date, str], int] = {}
+    day_col = func.date(ImageResult.created_at)
+    recent = ImageResult.created_at >= start
+    for day, user_id, n in (
+        db.session.query(day_col, ImageResult.user_id, func.count(ImageResult.id))
+        .filter(recent, ImageResult.user_id.isnot(None))
+        .group_by(day_col, ImageResult.user_id)
+    ):
+        counts[(_as_date(day), _usage_subject(user_id, ""))] = int(n)
+    for day, ip, n in (
+        db.session.query(day_col, ImageResult.request_ip, func.count(ImageResult.id))
+        .filter(recent)
+        .group_by(day_col, ImageResult.request_ip)
+    ):
+        counts[(_as_date(day), _usage_subject(None, ip))] = int(n)
+    UsageCounter.query.filter(UsageCounter.day >= start.date()).delete(synchronize_session=False)
+    for (day, subject), n in counts.items():
+        db.session.add(UsageCounter(day=day, subject=subject, count=n))
+    db.session.commit()
+    return {"balances": CreditBalance.query.count(), "usage_counters": len(counts)}
+
+
+def _as_date(value) -> date:
+    if isinstance(value, datetime):
+        return value.date()
+    if isinstance(value, date):
+        return value
+    return datetime.strptime(str(value)[:10], "%Y-%m-%d").date()
 
 
 def compute_cost(kind: str, *, width: Optional[int] = None, height: Optional[int] = None, steps: Optional[int] = None, denoise: Optional[float] = None) -> float:
@@ -85,13 +205,21 @@ def compute_cost(kind: str, *, width: Optional[int] = None, height: Optional[int
     return float(round(cost, 2))
 
 
-def spend(user_id: int, amount: float, *, kind: str, reference: Optional[str] = None, meta: Optional[str] = None) -> None:
+def spend(user_id: int, amount: float, *, kind: str, reference: Optional[str] = None, meta: Optional[str] = None,
+          commit: bool = True) -> None:
     tx = CreditTransaction(user_id=user_id, amount=-abs(amount), kind='spend', reference=reference, meta=meta)
     db.session.add(tx)
-    db.session.commit()
+    db.session.flush()
+    _add_to_balance(user_id, tx.amount)
+    if commit:
+        db.session.commit()
 
 
-def grant(user_id: int, amount: float, *, kind: str = 'purchase', reference: Optional[str] = None, meta: Optional[str] = None) -> None:
+def grant(user_id: int, amount: float, *, kind: str = 'purchase', reference: Optional[str] = None, meta: Optional[str] = None,
+          commit: bool = True) -> None:
     tx = CreditTransaction(user_id=user_id, amount=abs(amount), kind=kind, reference=reference, meta=meta)
     db.session.add(tx)
-    db.session.commit()
+    db.session.flush()
+    _add_to_balance(user_id, tx.amount)
+    if commit:
+        db.session.commit()
@@ -0,0 +1,141 @@
+from __future__ import annotations
+
+import json
+import multiprocessing
+import os
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor
+from typing import Dict, Optional
+
+from flask import current_app
+from PIL import Image, features
+
+from .extensions import db
+from .models import ImageResult
+
+
+# Delivery copies of finished outputs.  ComfyUI's SaveImage embeds the whole
+# prompt/workflow JSON in PNG text chunks, so each output gets a metadata-free
+# PNG plus WebP/AVIF siblings in OUTPUT_DIR.  Encoding runs in a process pool
+# after the job is recorded; the variants that came out smaller than the
+# original are stored on ImageResult.variants as {mimetype: filename} and
+# serve_output picks one per the request's Accept header.
+
+_SOURCE_EXTS = {".png", ".jpg", ".jpeg", ".webp"}
+# Most preferred first; serve_output walks this order
+DELIVERY_TYPES = ("image/avif", "image/webp", "image/png")
+
+_lock = threading.Lock()
+_executor: Optional[ProcessPoolExecutor] = None
+
+
+def _pool() -> Optional[ProcessPoolExecutor]:
+    global _executor
+    workers = int(current_app.config.get("ENCODE_WORKERS") or 0)
+    if workers <= 0:
+        return None
+    with _lock:
+        if _executor is None:
+            # spawn: forking a process that runs request/job threads is unsafe
+            _executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+        return _executor
+
+
+def _options() -> Dict:
+    cfg = current_app.config
+    return {
+        "webp_quality": int(cfg.get("ENCODE_WEBP_QUALITY") or 85),
+        "avif_quality": int(cfg.get("ENCODE_AVIF_QUALITY") or 60),
+        "formats": [f.strip().lower() for f in str(cfg.get("ENCODE_FORMATS") or "").split(",") if f.strip()],
+    }
+
+
+def encode_variants(src: str, options: Dict) -> Dict[str, str]:
+    """Write delivery copies of ``src`` next to it; returns {mimetype: filename} of the useful ones.
+
+    Runs in a pool worker, so it only touches the filesystem.
+    """
+    folder, name = os.path.split(src)
+    stem = os.path.splitext(name)[0]
+    original = os.path.getsize(src)
+    formats = options.get("formats") or ["png", "webp", "avif"]
+    variants: Dict[str, str] = {}
+    with Image.open(src) as im:
+        im.load()
+        icc = im.info.get("icc_profile")
+        if im.mode not in ("RGB", "RGBA"):
+            im = im.convert("RGBA" if "A" in im.getbands() else "RGB")
+        targets = []
+        if "png" in formats:
+            targets.append(("image/png", f"{stem}.opt.png", "PNG", {"optimize": True}))
+        if "webp" in formats and features.check("webp"):
+            targets.append(("image/webp", f"{stem}.webp", "WEBP", {"quality": options["webp_quality"], "method": 4}))
+        if "avif" in formats and features.check("avif"):
+            targets.append(("image/avif", f"{stem}.avif", "AVIF", {"quality": options["avif_quality"]}))
+        for mimetype, fn, fmt, kw in targets:
+            if fn == name:
+                continue
+            dst = os.path.join(folder, fn)
+            tmp = dst + ".tmp"
+            if icc:
+                kw = dict(kw, icc_profile=icc)
+            try:
+                im.save(tmp, fmt, **kw)
+            except Exception:
+                if os.path.exists(tmp):
+                    os.remove(tmp)
+                continue
+            if os.path.getsize(tmp) >= original:
+                os.remove(tmp)
+                continue
+            os.replace(tmp, dst)
+            variants[mimetype] = fn
+    return variants
+
+
+def schedule(app, image_id: int, path: str) -> Optional[Future]:
+    """Encode ``path`` in the background and store the variants on ImageResult ``image_id``."""
+    if os.path.splitext(path)[1].lower() not in _SOURCE_EXTS or not os.path.exists(path):
+        return None
+    pool = _pool()
+    if pool is None:
+        return None
+    fut = pool.submit(encode_variants, path, _options())
+
+    def _done(f: Future) -> None:
+        try:
+            variants = f.result()
+        except Exception:
+            app.logger.exception("Encoding delivery copies of %s failed", path)
+            return
+        if not variants:
+            return
+        try:
+            with app.app_context():
+                ImageResult.query.filter_by(id=image_id).update({"variants": json.dumps(variants)})
+                db.session.commit()
+        except Exception:
+            app.logger.exception("Recording variants of image %s failed", image_id)
+
+    fut.add_done_callback(_done)
+    return fut
+
+
+def variants_of(rec: Optional[ImageResult]) -> Dict[str, str]:
+    try:
+        return json.loads(rec.variants) if rec is not None and rec.variants else {}
+    except ValueError:
+        return {}
+
+
+def negotiate(variants: Dict[str, str], accept) -> Optional[str]:
+    """Filename of the preferred variant the client explicitly accepts (wildcards don't count
+    for AVIF/WebP, so downloads by plain clients stay PNG)."""
+    explicit = {value.lower() for value, quality in accept if quality > 0}
+    for mimetype in DELIVERY_TYPES:
+        fn = variants.get(mimetype)
+        if not fn:
+            continue
+        if mimetype == "image/png" or mimetype in explicit:
+            return fn
+    return None
@@ -0,0 +1,490 @@
+from __future__ import annotations
+
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+from flask import current_app, jsonify, request, url_for
+from video_tools import poster_path
+
+from . import encode
+from .billing import record_usage, spend
+from .extensions import db
+from .models import GenerationJob, ImageResult
+
+
+TERMINAL = {"done", "error", "cancelled"}
+
+# A runner does the ComfyUI work for one job.  It receives ``report(event, **data)``
+# for progress updates and returns ``(filename, None)`` with the output already
+# in OUTPUT_DIR, or ``(None, (http_status, json_payload))`` on failure.
+#
+# ``report.cancelled`` is a threading.Event set when the job is cancelled, and
+# ``report.on_cancel(fn)`` registers ``fn()`` to stop the remote work (dequeue /
+# interrupt the ComfyUI prompt); it runs at once if the job is already cancelled.
+# A cancelled job's result is discarded and nothing is charged.
+Runner = Callable[[Callable[..., None]], Tuple[Optional[str], Optional[Tuple[int, str]]]]
+
+# Progress is pushed to local listeners immediately but persisted at most this often.
+_PROGRESS_FLUSH_SECS = 1.0
+# How often each process checks the DB for its jobs cancelled through another worker.
+_CANCEL_POLL_SECS = 2.0
+
+logger = logging.getLogger(__name__)
+
+
+class _LocalJob:
+    """Event log for a job running in this process (feeds SSE without DB polling).
+
+    Latent previews are not logged: only the newest one is kept, so a late or
+    slow viewer gets the current frame instead of every frame it missed.
+    """
+
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.events: List[Tuple[str, Dict]] = []
+        self.finished = False
+        self.preview: Optional[Dict] = None
+        self.preview_seq = 0
+        self.cancelled = threading.Event()
+        self.cancel_hooks: List[Callable[[], None]] = []
+        self.viewers = 0
+
+    def publish(self, event: str, data: Dict) -> None:
+        with self.cond:
+            self.events.append((event, data))
+            if event in ("done", "error", "cancelled"):
+                self.finished = True
+            self.cond.notify_all()
+
+    def publish_preview(self, data: Dict) -> None:
+        with self.cond:
+            self.preview = data
+            self.preview_seq += 1
+            self.cond.notify_all()
+
+    def on_cancel(self, fn: Callable[[], None]) -> None:
+        with self.cond:
+            if not self.cancelled.is_set():
+                self.cancel_hooks.append(fn)
+                return
+        _run_hook(fn)
+
+    def cancel(self) -> bool:
+        with self.cond:
+            if self.finished or self.cancelled.is_set():
+                return False
+            self.cancelled.set()
+            hooks, self.cancel_hooks = self.cancel_hooks, []
+        for fn in hooks:
+            _run_hook(fn)
+        return True
+
+
+def _run_hook(fn: Callable[[], None]) -> None:
+    try:
+        fn()
+    except Exception:
+        logger.exception("Job cancel hook failed")
+
+
+_executor: Optional[ThreadPoolExecutor] = None
+_executor_lock = threading.Lock()
+_local: Dict[str, _LocalJob] = {}
+_local_lock = threading.Lock()
+_watcher: Optional[threading.Thread] = None
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            workers = int(current_app.config.get("JOB_WORKERS") or 4)
+            _executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="gen-job")
+        return _executor
+
+
+def job_payload(job: GenerationJob) -> Dict:
+    data = {
+        "job_id": job.id,
+        "kind": job.kind,
+        "status": job.status,
+        "progress": round(float(job.progress or 0.0), 4),
+        "status_url": url_for("jobs.job_status", job_id=job.id),
+        "events_url": url_for("jobs.job_events", job_id=job.id),
+    }
+    if job.status == "done" and job.filename:
+        data["filename"] = job.filename
+        data["download"] = url_for("main.serve_output", filename=job.filename)
+        data["message"] = "生成完成"
+        poster = _poster_of(job.filename)
+        if poster:
+            data["poster"] = url_for("main.serve_output", filename=poster)
+    if job.status in ("error", "cancelled"):
+        try:
+            data.update(json.loads(job.error or "{}"))
+        except Exception:
+            data["error"] = job.error
+        data["code"] = job.error_code
+    return data
+
+
+def submit(kind: str, runner: Runner, *, billing: Dict, source_path: Optional[str] = None,
+           record: bool = True) -> GenerationJob:
+    """Create a queued job row and hand ``runner`` to the background dispatcher.
+
+    ``record=False`` finishes the job without an ImageResult row or any charge
+    (for free, non-gallery outputs such as /img2vid clips).
+    """
+    job = GenerationJob(
+        id=uuid.uuid4().hex,
+        kind=kind,
+        status="queued",
+        user_id=billing.get("user_id"),
+        request_ip=billing.get("ip"),
+    )
+    db.session.add(job)
+    db.session.commit()
+
+    with _local_lock:
+        _local[job.id] = _LocalJob()
+    app = current_app._get_current_object()
+    _ensure_cancel_watcher(app)
+    _get_executor().submit(_execute, app, job.id, kind, runner, dict(billing), source_path, record)
+    return job
+
+
+def wait(job_id: str, timeout: Optional[float] = None) -> Optional[GenerationJob]:
+    """Block until a job started by this process is finished; returns the fresh row."""
+    local = _local.get(job_id)
+    if local is not None:
+        with local.cond:
+            local.cond.wait_for(lambda: local.finished, timeout=timeout)
+    db.session.expire_all()
+    return db.session.get(GenerationJob, job_id)
+
+
+def cancel(job_id: str, reason: str = "user") -> Optional[GenerationJob]:
+    """Cancel a queued or running job; returns the fresh row (None if unknown).
+
+    The row is marked ``cancelled`` at once.  The process running the job then
+    dequeues or interrupts its ComfyUI prompt and frees the waiting thread -- this
+    process directly, any other worker within ``_CANCEL_POLL_SECS``.  A job that
+    already finished is returned unchanged.
+    """
+    payload = json.dumps({"error": "工作已取消", "reason": reason}, ensure_ascii=False)
+    changed = GenerationJob.query.filter(
+        GenerationJob.id == job_id, GenerationJob.status.in_(("queued", "running"))
+    ).update(
+        {"status": "cancelled", "error": payload, "error_code": 409, "finished_at": datetime.utcnow()},
+        synchronize_session=False,
+    )
+    db.session.commit()
+    if changed:
+        local = _local.get(job_id)
+        if local is not None:
+            local.cancel()
+    db.session.expire_all()
+    return db.session.get(GenerationJob, job_id)
+
+
+def _ensure_cancel_watcher(app) -> None:
+    global _watcher
+    with _local_lock:
+        if _watcher is None or not _watcher.is_alive():
+            _watcher = threading.Thread(target=_watch_cancellations, args=(app,), name="job-cancel-watch", daemon=True)
+            _watcher.start()
+
+
+def _watch_cancellations(app) -> None:
+    """Pick up cancellations of this process's jobs made through other workers."""
+    while True:
+        time.sleep(_CANCEL_POLL_SECS)
+        with _local_lock:
+            ids = [jid for jid, local in _local.items() if not local.finished and not local.cancelled.is_set()]
+        if not ids:
+            continue
+        try:
+            with app.app_context():
+                rows = db.session.query(GenerationJob.id).filter(
+                    GenerationJob.id.in_(ids), GenerationJob.status == "cancelled"
+                ).all()
+        except Exception:
+            app.logger.exception("Polling job cancellations failed")
+            continue
+        for (jid,) in rows:
+            local = _local.get(jid)
+            if local is not None:
+                local.cancel()
+
+
+def _abandon_later(app, job_id: str, local: _LocalJob) -> None:
+    """Cancel ``job_id`` if nobody is watching it again within JOB_ABANDON_GRACE seconds."""
+    grace = float(app.config.get("JOB_ABANDON_GRACE") or 0)
+    if grace <= 0:
+        return
+
+    def check() -> None:
+        with local.cond:
+            if local.viewers or local.finished:
+                return
+        with app.app_context():
+            cancel(job_id, reason="disconnected")
+            app.logger.info("Job %s cancelled: its viewer went away", job_id)
+
+    timer = threading.Timer(grace, check)
+    timer.daemon = True
+    timer.start()
+
+
+def respond(kind: str, runner: Runner, billing: Dict, source_path: Optional[str] = None, record: bool = True):
+    """Submit a generation and build the HTTP response for it.
+
+    Responds 202 with the job id and its status/SSE URLs.  Clients that still
+    want the old blocking behaviour can send ``wait=1`` and receive the final
+    ``{message, download, filename}`` payload (or the error) as before.
+    """
+    job = submit(kind, runner, billing=billing, source_path=source_path, record=record)
+    if (request.values.get("wait") or "").lower() not in ("1", "true", "yes"):
+        return jsonify(job_payload(job)), 202
+
+    job = wait(job.id)
+    payload = job_payload(job)
+    if job.status == "done":
+        return jsonify(message="生成完成", download=payload["download"], filename=job.filename, job_id=job.id), 200
+    try:
+        data = json.loads(job.error or "{}")
+    except Exception:
+        data = {"error": job.error}
+    data["job_id"] = job.id
+    return jsonify(data), job.error_code or 500
+
+
+def _execute(app, job_id: str, kind: str, runner: Runner, billing: Dict, source_path: Optional[str],
+             record: bool = True) -> None:
+    with app.app_context():
+        local = _local.get(job_id) or _LocalJob()
+        # Conditional: a job cancelled while waiting for a thread stays cancelled
+        started = GenerationJob.query.filter_by(id=job_id, status="queued").update({"status": "running"})
+        db.session.commit()
+        job = db.session.get(GenerationJob, job_id)
+        if started:
+            local.publish("status", {"status": "running"})
+        else:
+            local.cancelled.set()
+
+        last_flush = [0.0]
+
+        def report(event: str = "progress", **data) -> None:
+            # May be called from the ComfyUI reader thread, so never touch
+            # ``job`` / the request-scoped session here.
+            if event == "preview":
+                local.publish_preview(data)
+                return
+            if event == "submitted" and data.get("prompt_id"):
+                _update(app, job_id, prompt_id=data["prompt_id"])
+            if event == "progress" and data.get("max"):
+                data["progress"] = max(0.0, min(1.0, float(data["value"]) / float(data["max"])))
+                now = time.monotonic()
+                if now - last_flush[0] >= _PROGRESS_FLUSH_SECS:
+                    last_flush[0] = now
+                    _update(app, job_id, progress=data["progress"])
+            local.publish(event, data)
+
+        report.cancelled = local.cancelled
+        report.on_cancel = local.on_cancel
+
+        newfn, err = None, None
+        if started:
+            try:
+                newfn, err = runner(report)
+            except Exception as e:
+                current_app.logger.exception("Job %s crashed", job_id)
+                newfn, err = None, (500, json.dumps({"error": "生成失敗", "detail": str(e)}, ensure_ascii=False))
+
+        try:
+            db.session.refresh(job)
+            if local.cancelled.is_set() or job.status == "cancelled":
+                # Nothing is recorded or charged; drop whatever the runner still produced
+                _discard_output(newfn)
+            elif err:
+                code, payload = err
+                job.status = "error"
+                job.error = payload
+                job.error_code = code
+            else:
+                try:
+                    rec = _record_result(newfn, kind, billing, source_path) if record else None
+                except Exception as e:
+                    # A result that was not recorded / charged is not handed out
+                    current_app.logger.exception("Job %s: recording or charging the result failed", job_id)
+                    _discard_output(newfn)
+                    job.status = "error"
+                    job.error = json.dumps({"error": "結果記錄失敗", "detail": str(e)}, ensure_ascii=False)
+                    job.error_code = 500
+                else:
+                    job.status = "done"
+                    job.progress = 1.0
+                    job.filename = newfn
+                    job.image_id = rec.id if rec is not None else None
+                    if rec is not None:
+                        encode.schedule(app, rec.id, rec.output_path)
+            job.finished_at = datetime.utcnow()
+            db.session.commit()
+        except Exception:
+            current_app.logger.exception("Job %s could not be finalised", job_id)
+            db.session.rollback()
+        finally:
+            try:
+                with app.test_request_context():
+                    payload = job_payload(job)
+            except Exception:
+                payload = {"job_id": job_id, "status": "error", "error": "工作狀態更新失敗"}
+            status = payload.get("status")
+            local.publish(status if status in ("done", "cancelled") else "error", payload)
+            db.session.remove()
+            # Keep the finished log briefly for late SSE subscribers
+            timer = threading.Timer(60.0, lambda: _local.pop(job_id, None))
+            timer.daemon = True
+            timer.start()
+
+
+def _poster_of(filename: str) -> Optional[str]:
+    """The poster still written next to a video output, if there is one."""
+    from config import OUTPUT_DIR
+
+    if not filename.lower().endswith(".mp4"):
+        return None
+    poster = poster_path(filename)
+    return poster if os.path.isfile(os.path.join(OUTPUT_DIR, poster)) else None
+
+
+def _discard_output(newfn: Optional[str]) -> None:
+    from config import OUTPUT_DIR
+
+    if not newfn:
+        return
+    for fn in (newfn, _poster_of(newfn)):
+        if not fn:
+            continue
+        try:
+            os.remove(os.path.join(OUTPUT_DIR, fn))
+        except OSError:
+            pass
+
+
+def _update(app, job_id: str, **fields) -> None:
+    """Write job columns from any thread (uses its own app context / session)."""
+    try:
+        with app.app_context():
+            GenerationJob.query.filter_by(id=job_id).update(fields)
+            db.session.commit()
+    except Exception:
+        app.logger.exception("Job %s progress update failed", job_id)
+
+
+def _record_result(newfn: str, kind: str, billing: Dict, source_path: Optional[str]) -> Optional[ImageResult]:
+    """Persist the ImageResult, bump usage counters and charge credits in one transaction.
+
+    Rolls back and re-raises on failure.
+    """
+    from config import OUTPUT_DIR
+
+    try:
+        user_id = billing.get("user_id")
+        use_free = bool(billing.get("use_free"))
+        cost = 0.0 if use_free else float(billing.get("cost") or 0.0)
+        rec = ImageResult(
+            filename=newfn,
+            kind=kind or "unknown",
+            source_path=source_path,
+            output_path=os.path.join(OUTPUT_DIR, newfn),
+            user_id=user_id,
+            cost_credits=cost,
+            request_ip=billing.get("ip"),
+        )
+        db.session.add(rec)
+        db.session.flush()
+        record_usage(user_id, billing.get("ip") or "")
+        if not use_free and user_id:
+            spend(int(user_id), float(cost), kind=kind or "unknown", reference=f"image:{rec.id}", commit=False)
+        db.session.commit()
+        return rec
+    except Exception:
+        db.session.rollback()
+        raise
+
+
+def sse_format(event: str, data: Dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+def _stream_local(app, job_id: str, local: _LocalJob, heartbeat: float) -> Iterator[str]:
+    with local.cond:
+        local.viewers += 1
+    try:
+        idx = 0
+        seen_preview = 0
+        while True:
+            with local.cond:
+                local.cond.wait_for(
+                    lambda: len(local.events) > idx or local.finished or local.preview_seq != seen_preview,
+                    timeout=heartbeat,
+                )
+                batch = local.events[idx:]
+                idx += len(batch)
+                finished = local.finished
+                preview = local.preview if local.preview_seq != seen_preview else None
+                seen_preview = local.preview_seq
+            if not batch and preview is None and not finished:
+                yield ": keep-alive\n\n"
+            for event, data in batch:
+                yield sse_format(event, data)
+            if preview is not None and not finished:
+                yield sse_format("preview", preview)
+            if finished and idx >= len(local.events):
+                return
+    finally:
+        # GeneratorExit lands here when the client went away
+        with local.cond:
+            local.viewers -= 1
+            abandoned = not local.viewers and not local.finished
+        if abandoned:
+            _abandon_later(app, job_id, local)
+
+
+def stream_events(job_id: str, heartbeat: float = 15.0) -> Iterator[str]:
+    """Yield SSE frames for a job until it reaches a terminal state.
+
+    Jobs running in this process are streamed from their in-memory event log;
+    jobs owned by another worker are followed through the database row.  When
+    the last viewer of a local job disconnects, the job is cancelled unless
+    someone reconnects within JOB_ABANDON_GRACE seconds.
+    """
+    local = _local.get(job_id)
+    if local is not None:
+        yield from _stream_local(current_app._get_current_object(), job_id, local, heartbeat)
+        return
+
+    last = None
+    while True:
+        db.session.expire_all()
+        job = db.session.get(GenerationJob, job_id)
+        if job is None:
+            yield sse_format("error", {"error": "找不到工作", "job_id": job_id})
+            return
+        payload = job_payload(job)
+        if job.status in TERMINAL:
+            yield sse_format(job.status if job.status in ("done", "cancelled") else "error", payload)
+            return
+        snapshot = (job.status, payload["progress"])
+        if snapshot != last:
+            last = snapshot
+            yield sse_format("progress", {"status": job.status, "progress": payload["progress"]})
+        time.sleep(1.0)
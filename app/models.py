@@ -35,9 +35,26 @@ class ImageResult(db.Model):
     # Billing-related
     cost_credits = db.Column(db.Float, default=0.0, nullable=False)
     request_ip = db.Column(db.String(64))
+    # Delivery copies written by app.encode: JSON {mimetype: filename}
+    variants = db.Column(db.Text)
+    # Rating rollup maintained by feedback.rate_image (avoids aggregating image_ratings per card)
+    rating_count = db.Column(db.Integer, default=0, nullable=False)
+    rating_sum = db.Column(db.Integer, default=0, nullable=False)
 
     user = db.relationship("User", backref=db.backref("images", lazy=True))
 
+    @property
+    def rating_avg(self) -> float:
+        return (self.rating_sum or 0) / self.rating_count if self.rating_count else 0.0
+
+    __table_args__ = (
+        db.Index("ix_image_results_filename", "filename"),
+        db.Index("ix_image_results_created_id", "created_at", "id"),
+        db.Index("ix_image_results_kind_created", "kind", "created_at", "id"),
+        db.Index("ix_image_results_user_created", "user_id", "created_at"),
+        db.Index("ix_image_results_ip_created", "request_ip", "created_at"),
+    )
+
 
 class ImageRating(db.Model):
     __tablename__ = "image_ratings"
@@ -84,3 +101,58 @@ class CreditTransaction(db.Model):
     created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
 
     user = db.relationship("User", backref=db.backref("credit_transactions", lazy=True))
+
+    __table_args__ = (db.Index("ix_credit_transactions_user_created", "user_id", "created_at"),)
+
+
+class CreditBalance(db.Model):
+    """Running total of a user's credit_transactions (maintained by spend/grant)."""
+
+    __tablename__ = "credit_balances"
+
+    user_id = db.Column(db.Integer, db.ForeignKey("users.id"), primary_key=True)
+    balance = db.Column(db.Float, default=0.0, nullable=False)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, nullable=False)
+
+
+class UsageCounter(db.Model):
+    """Generations per subject ("user:<id>" or "ip:<addr>") per UTC day."""
+
+    __tablename__ = "usage_counters"
+
+    day = db.Column(db.Date, primary_key=True)
+    subject = db.Column(db.String(80), primary_key=True)
+    count = db.Column(db.Integer, default=0, nullable=False)
+
+
+class GenerationJob(db.Model):
+    __tablename__ = "generation_jobs"
+
+    id = db.Column(db.String(32), primary_key=True)  # uuid4 hex
+    kind = db.Column(db.String(50), nullable=False)  # upload2|text2image|img2img|inpaint
+    status = db.Column(db.String(16), default="queued", nullable=False, index=True)  # queued|running|done|error
+    progress = db.Column(db.Float, default=0.0, nullable=False)  # 0..1
+    prompt_id = db.Column(db.String(64))  # ComfyUI prompt id once submitted
+    filename = db.Column(db.String(512))
+    image_id = db.Column(db.Integer, db.ForeignKey("image_results.id"), nullable=True)
+    error = db.Column(db.Text)  # JSON error payload
+    error_code = db.Column(db.Integer)
+    user_id = db.Column(db.Integer, db.ForeignKey("users.id"), nullable=True, index=True)
+    request_ip = db.Column(db.String(64))
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, nullable=False)
+    finished_at = db.Column(db.DateTime, nullable=True)
+
+    image = db.relationship("ImageResult")
+
+
+class ResultCacheEntry(db.Model):
+    __tablename__ = "result_cache"
+
+    key = db.Column(db.String(64), primary_key=True)  # sha256 of canonical workflow + input hashes
+    kind = db.Column(db.String(50), nullable=False)
+    path = db.Column(db.String(1024), nullable=False)  # cached copy under RESULT_CACHE_DIR
+    size = db.Column(db.Integer, default=0, nullable=False)  # bytes
+    hits = db.Column(db.Integer, default=0, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+    last_used_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False, index=True)  # LRU order
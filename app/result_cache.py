@@ -0,0 +1,155 @@
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import shutil
+import threading
+from datetime import datetime
+from typing import Dict, Optional
+
+from flask import current_app
+from sqlalchemy import func
+
+from comfy_client import file_digest
+from .extensions import db
+from .models import ResultCacheEntry
+
+
+# Generations are deterministic for a given workflow (the seed is part of it)
+# and input images, so the output of an earlier run can be served again.  The
+# key is the SHA-256 of the canonical patched workflow with local image paths
+# replaced by their content hashes.
+
+_stats_lock = threading.Lock()
+_stats = {"hits": 0, "misses": 0, "stores": 0, "evictions": 0}
+
+
+def _count(name: str, n: int = 1) -> None:
+    with _stats_lock:
+        _stats[name] += n
+
+
+def _max_bytes() -> int:
+    return int(current_app.config.get("RESULT_CACHE_MAX_MB") or 0) * 1024 * 1024
+
+
+def enabled() -> bool:
+    return _max_bytes() > 0
+
+
+def canonical_workflow(wf: Dict, images: Optional[Dict] = None) -> str:
+    """Stable JSON for ``wf``: sorted keys, no UI metadata, input paths as ``sha256:<hex>``."""
+    subst = {}
+    for value in (images or {}).values():
+        for path in value if isinstance(value, (list, tuple)) else (value,):
+            if isinstance(path, str) and os.path.isfile(path):
+                subst[path] = "sha256:" + file_digest(path)
+    nodes = {}
+    for nid, node in wf.items():
+        inputs = {
+            k: subst.get(v, v) if isinstance(v, str) else v
+            for k, v in (node.get("inputs") or {}).items()
+        }
+        nodes[str(nid)] = {"class_type": node.get("class_type"), "inputs": inputs}
+    return json.dumps(nodes, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+
+
+def cache_key(wf: Dict, images: Optional[Dict] = None) -> str:
+    return hashlib.sha256(canonical_workflow(wf, images).encode("utf-8")).hexdigest()
+
+
+def _link_or_copy(src: str, dst: str) -> None:
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+
+def lookup(key: str) -> Optional[str]:
+    """Path of the cached output for ``key`` (and mark it recently used), else None."""
+    entry = db.session.get(ResultCacheEntry, key)
+    if entry is None or not os.path.exists(entry.path):
+        if entry is not None:
+            db.session.delete(entry)
+            db.session.commit()
+        _count("misses")
+        return None
+    entry.hits = (entry.hits or 0) + 1
+    entry.last_used_at = datetime.utcnow()
+    db.session.commit()
+    _count("hits")
+    current_app.logger.info("Result cache hit %s (%s)", key[:12], entry.kind)
+    return entry.path
+
+
+def copy_to(path: str, dest_dir: str, filename: str) -> str:
+    """Materialise a cached output as ``dest_dir/filename`` (hard link when possible)."""
+    os.makedirs(dest_dir, exist_ok=True)
+    dst = os.path.join(dest_dir, filename)
+    _link_or_copy(path, dst)
+    return dst
+
+
+def store(key: str, kind: str, src: str) -> None:
+    """Keep a copy of a finished output under ``key`` and enforce the size bound."""
+    if not enabled() or not os.path.exists(src):
+        return
+    try:
+        ext = os.path.splitext(src)[1].lower()
+        folder = os.path.join(current_app.config["RESULT_CACHE_DIR"], key[:2])
+        os.makedirs(folder, exist_ok=True)
+        path = os.path.join(folder, key + ext)
+        if not os.path.exists(path):
+            _link_or_copy(src, path)
+        entry = db.session.get(ResultCacheEntry, key) or ResultCacheEntry(key=key, kind=kind)
+        entry.path = path
+        entry.size = os.path.getsize(path)
+        entry.last_used_at = datetime.utcnow()
+        db.session.add(entry)
+        db.session.commit()
+        _count("stores")
+        evict()
+    except Exception:
+        db.session.rollback()
+        current_app.logger.exception("Result cache store failed for %s", key[:12])
+
+
+def evict(max_bytes: Optional[int] = None) -> int:
+    """Drop least recently used entries until the cache fits; returns how many were removed."""
+    limit = _max_bytes() if max_bytes is None else max_bytes
+    total = int(db.session.query(func.coalesce(func.sum(ResultCacheEntry.size), 0)).scalar() or 0)
+    removed = 0
+    if total <= limit:
+        return 0
+    for entry in ResultCacheEntry.query.order_by(ResultCacheEntry.last_used_at.asc()).all():
+        if total <= limit:
+            break
+        try:
+            os.remove(entry.path)
+        except FileNotFoundError:
+            pass
+        except OSError:
+            current_app.logger.warning("Result cache could not remove %s", entry.path)
+            continue
+        total -= entry.size or 0
+        db.session.delete(entry)
+        removed += 1
+    db.session.commit()
+    _count("evictions", removed)
+    return removed
+
+
+def stats() -> Dict:
+    """Hit/miss counters of this process plus the cache's current size."""
+    with _stats_lock:
+        data = dict(_stats)
+    lookups = data["hits"] + data["misses"]
+    data["hit_rate"] = round(data["hits"] / lookups, 4) if lookups else 0.0
+    entries, size, hits = db.session.query(
+        func.count(ResultCacheEntry.key),
+        func.coalesce(func.sum(ResultCacheEntry.size), 0),
+        func.coalesce(func.sum(ResultCacheEntry.hits), 0),
+    ).one()
+    data.update(entries=int(entries), bytes=int(size), max_bytes=_max_bytes(), lifetime_hits=int(hits))
+    return data
@@ -1,28 +1,36 @@
 import os
 import json
-import copy
 import time
 import uuid
-import shutil
 import traceback
-import urllib.request
-import websocket
-from flask import Blueprint, request, jsonify, current_app, url_for
+from flask import Blueprint, request, jsonify, current_app
 from app.extensions import csrf, limiter
 
-from config import UPLOAD1, UPLOAD2, OUTPUT_DIR, COMFY_ADDR, COMFY_OUTPUT
-from backend.comfy import patch_workflow_models, get_model_options
-from app.models import ImageResult
-from app.extensions import db
+from config import UPLOAD1, UPLOAD2, OUTPUT_DIR, COMFY_ADDR, COMFY_NODES, COMFY_OUTPUT
+from backend.comfy import select_models, get_model_options, invalidate_object_info, output_filename, run_prompt
+from backend.workflows import WorkflowError, registry as workflow_registry
+from comfy_pool import get_pool
+import mask_crop
+from image_ingest import IngestError, normalize as normalize_image
+from app import jobs, result_cache
 from flask_login import current_user
-from app.billing import client_ip, free_remaining, balance, compute_cost, spend
+from app.billing import client_ip, free_remaining, balance, compute_cost
 
 
 bp = Blueprint("features", __name__)
 csrf.exempt(bp)
 
+# Templates in the workflow registry (relative to workflows/)
+TEXT2IMAGE_WORKFLOW = "api/文生圖工作流api.json"
+IMG2IMG_WORKFLOW = "目前的服務/圖生圖工作流api.json"
+INPAINT_WORKFLOW = "api/圖生圖工作流局部重繪api.json"
 
-def _save_upload(file_storage, target_dir):
+
+def _save_upload(file_storage, target_dir, kind="default"):
+    """Store an uploaded image normalized for workflow ``kind`` (see ``image_ingest``).
+
+    Raises ``IngestError`` for files that are not acceptable images.
+    """
     os.makedirs(target_dir, exist_ok=True)
     _, ext = os.path.splitext(file_storage.filename or "")
     if not ext:
@@ -30,7 +38,7 @@ def _save_upload(file_storage, target_dir):
     fn = f"{int(time.time())}_{uuid.uuid4().hex}{ext}"
     path = os.path.join(target_dir, fn)
     file_storage.save(path)
-    return path
+    return normalize_image(path, kind)
 
 
 def _json_fail(status, summary, exc=None, extra=None):
@@ -56,111 +64,131 @@ def model_options():
         return jsonify(error="failed to fetch model options", detail=str(e)), 500
 
 
-def _run_comfy(prompt_obj, kind=None, billing=None):
-    before = {f for f in os.listdir(COMFY_OUTPUT) if f.lower().endswith(".png")}
+@bp.post("/models/refresh")
+@limiter.limit("6/minute")
+def model_refresh():
+    """Drop the cached ComfyUI model catalog (e.g. after adding a checkpoint)
+    and return freshly fetched options.
+    """
+    addr = current_app.config.get("COMFY_ADDR", "127.0.0.1:8188")
+    invalidate_object_info(addr)
+    try:
+        return jsonify(get_model_options(addr)), 200
+    except Exception as e:
+        return jsonify(error="failed to fetch model options", detail=str(e)), 500
 
-    client_id = str(uuid.uuid4())
-    payload = {"prompt": prompt_obj, "client_id": client_id}
 
-    # Patch models to current ComfyUI availability (ckpt/vae)
+def _maybe_num(v):
+    if v is None or v == "":
+        return None
     try:
-        prompt_obj, selected = patch_workflow_models(prompt_obj, COMFY_ADDR)
-        current_app.logger.info("Using models: ckpt=%s, vae=%s", selected.get("ckpt"), selected.get("vae"))
+        if "." in str(v):
+            return float(v)
+        return int(v)
     except Exception:
-        pass
+        return v
 
-    data = json.dumps({"prompt": prompt_obj, "client_id": client_id}).encode("utf-8")
-    req = urllib.request.Request(f"http://{COMFY_ADDR}/prompt", data=data)
 
-    try:
-        resp = urllib.request.urlopen(req)
-        prompt_id = json.loads(resp.read())["prompt_id"]
-    except urllib.error.HTTPError as e:
-        try:
-            body = e.read().decode("utf-8", "ignore")
-        except Exception:
-            body = None
-        current_app.logger.error("ComfyUI HTTPError %s %s\n%s", getattr(e, 'code', None), getattr(e, 'reason', None), body)
-        err = {
-            "code": getattr(e, "code", None),
-            "reason": getattr(e, "reason", None),
-            "body": body,
-            "comfy_addr": COMFY_ADDR,
-        }
-        return None, (502, json.dumps({"error": "ComfyUI 介面回應錯誤", "detail": err}, ensure_ascii=False))
-    except Exception as e:
-        current_app.logger.exception("ComfyUI 發送請求時發生例外")
-        err = {"exception": str(e), "traceback": traceback.format_exc(), "comfy_addr": COMFY_ADDR}
-        return None, (502, json.dumps({"error": "ComfyUI 介面異常", "detail": err}, ensure_ascii=False))
+def _form_spec(numeric=(), text=()):
+    """Patch spec entries for the optional form fields that were sent."""
+    spec = {key: _maybe_num(request.form.get(key)) for key in numeric}
+    spec.update({key: (request.form.get(key) or None) for key in text})
+    return {k: v for k, v in spec.items() if v is not None}
 
-    # Wait on websocket for completion
-    last_msg = None
-    try:
-        ws = websocket.create_connection(f"ws://{COMFY_ADDR}/ws?clientId={client_id}")
-        try:
-            while True:
-                msg = json.loads(ws.recv())
-                last_msg = msg
-                data_msg = msg.get("data", {})
-                if (
-                    msg.get("type") == "executing"
-                    and data_msg.get("node") is None
-                    and data_msg.get("prompt_id") == prompt_id
-                ):
-                    break
-        finally:
+
+def _patch(wf, spec):
+    """Resolve ckpt/vae and apply ``spec`` to ``wf`` in one pass.
+
+    Runs in the request thread: the preferred models may come from the form or
+    the session.  Raises ``WorkflowError`` when the workflow has no slot for a
+    requested parameter.
+    """
+    selected = select_models(
+        COMFY_ADDR,
+        ckpt=(request.form.get("ckpt_name") or "").strip() or None,
+        vae=(request.form.get("vae_name") or "").strip() or None,
+    )
+    current_app.logger.info("Using models: ckpt=%s, vae=%s", selected.get("ckpt"), selected.get("vae"))
+    wf.patch(dict(spec, ckpt=selected["ckpt"], vae=selected["vae"]), optional=("ckpt", "vae"))
+    return wf
+
+
+def _sampler_inputs(wf):
+    samplers = wf.slot("sampler", required=False)
+    return wf.inputs(samplers[0].node_id) if samplers else {}
+
+
+def _check_credits(user_id, ip, cost):
+    """Return ``(free_left, None)`` or ``(None, error_response)`` when the user cannot pay."""
+    free_left = free_remaining(user_id, ip)
+    if free_left <= 0:
+        if not user_id:
+            return None, (jsonify(error='今日免費次數已用完，請登入並購買點數'), 402)
+        if balance(user_id) < cost:
+            return None, (jsonify(error='點數不足，請先購買', need=cost), 402)
+    return free_left, None
+
+
+def _run_comfy(prompt_obj, report=None, images=None):
+    """Run ``prompt_obj`` on the configured ComfyUI nodes (see ``backend.comfy.run_prompt``)."""
+    return run_prompt(get_pool(COMFY_NODES, COMFY_OUTPUT), prompt_obj, OUTPUT_DIR, report, images)
+
+
+def _generation_runner(kind, wf, images=None):
+    """Job runner for ``wf``: an identical earlier result (same canonical
+    workflow and input image hashes) is served from the result cache, anything
+    else runs on ComfyUI and its output is cached.  Send ``cache=0`` to bypass.
+    """
+    if not result_cache.enabled() or (request.form.get("cache") or "").lower() in ("0", "false", "no"):
+        return lambda report: _run_comfy(wf, report, images)
+
+    key = result_cache.cache_key(wf, images)
+    cached = result_cache.lookup(key)
+
+    def run(report):
+        if cached:
+            newfn = output_filename(cached)
             try:
-                ws.close()
-            except Exception:
-                pass
-    except Exception as e:
-        current_app.logger.exception("WebSocket 等待執行完成時發生例外")
-        err = {"exception": str(e), "traceback": traceback.format_exc(), "last_ws_msg": last_msg}
-        return None, (502, json.dumps({"error": "ComfyUI WebSocket 連線/等待失敗", "detail": err}, ensure_ascii=False))
-
-    # Find new image(s)
-    after = {f for f in os.listdir(COMFY_OUTPUT) if f.lower().endswith(".png")}
-    new_files = [os.path.join(COMFY_OUTPUT, f) for f in after - before]
-    if not new_files:
-        current_app.logger.error("未在 %s 找到新的 PNG 輸出", COMFY_OUTPUT)
-        err = {"comfy_output": COMFY_OUTPUT, "before": list(before), "after": list(after)}
-        return None, (500, json.dumps({"error": "沒有產生任何輸出圖片", "detail": err}, ensure_ascii=False))
-
-    src = max(new_files, key=lambda p: os.path.getmtime(p))
-    stamp = time.strftime("%Y%m%d_%H%M%S", time.localtime())
-    newfn = f"{stamp}.png"
-    os.makedirs(OUTPUT_DIR, exist_ok=True)
-    dst = os.path.join(OUTPUT_DIR, newfn)
-    shutil.move(src, dst)
-    try:
-        user_id = None
-        req_ip = None
-        cost = 0.0
-        use_free = True
-        if isinstance(billing, dict):
-            user_id = billing.get('user_id')
-            req_ip = billing.get('ip')
-            use_free = bool(billing.get('use_free'))
-            cost = 0.0 if use_free else float(billing.get('cost') or 0.0)
-        else:
-            user_id = (current_user.id if getattr(current_user, 'is_authenticated', False) else None)
-
-        rec = ImageResult(
-            filename=newfn,
-            kind=kind or "unknown",
-            source_path=None,
-            output_path=dst,
-            user_id=user_id,
-            cost_credits=cost,
-            request_ip=req_ip,
-        )
-        db.session.add(rec)
-        db.session.commit()
-        if not use_free and user_id:
-            spend(int(user_id), float(cost), kind=kind or 'unknown', reference=f'image:{rec.id}')
-    except Exception:
-        db.session.rollback()
-    return newfn, None
+                result_cache.copy_to(cached, OUTPUT_DIR, newfn)
+                report("cached", key=key)
+                return newfn, None
+            except OSError:
+                current_app.logger.warning("Cached result %s vanished, regenerating", key[:12])
+        newfn, err = _run_comfy(wf, report, images)
+        if newfn:
+            result_cache.store(key, kind, os.path.join(OUTPUT_DIR, newfn))
+        return newfn, err
+
+    return run
+
+
+def _composite_runner(run, crop):
+    """Wrap a job runner for a crop-to-mask inpaint: paste the generated crop
+    back into the full-resolution original (see ``mask_crop``).  The result
+    cache keeps the bare crop, so a hit is composited again here.
+    """
+    feather = current_app.config.get("INPAINT_FEATHER", 8)
+
+    def composited(report):
+        newfn, err = run(report)
+        if not newfn:
+            return newfn, err
+        dst = os.path.join(OUTPUT_DIR, newfn)
+        try:
+            mask_crop.composite(crop, dst, dst, feather=feather)
+        except Exception as e:
+            current_app.logger.exception("合成局部重繪結果失敗")
+            err = {"exception": str(e), "file": newfn}
+            return None, (500, json.dumps({"error": "合成局部重繪結果失敗", "detail": err}, ensure_ascii=False))
+        return newfn, None
+
+    return composited
+
+
+@bp.get("/cache/stats")
+def cache_stats():
+    """Result cache hit rate (this worker) and size."""
+    return jsonify(result_cache.stats()), 200
 
 
 @bp.route("/text2image", methods=["POST"])
@@ -172,113 +200,42 @@ def text2image():
 
     negative = (request.form.get("negative") or "").strip()
 
-    wf_path = os.path.join(os.getcwd(), "workflows", "文生圖工作流api.json")
     try:
-        with open(wf_path, "r", encoding="utf-8") as f:
-            wf = json.load(f)
+        wf = workflow_registry.instantiate(TEXT2IMAGE_WORKFLOW)
     except Exception as e:
         return _json_fail(500, "讀取工作流失敗", e)
 
-    wf = copy.deepcopy(wf)
-
     # Optional: allow client to specify an alternative workflow file path
     alt_path = (request.form.get("workflow_path") or "").strip()
     if alt_path:
         try:
-            if os.path.isabs(alt_path) and os.path.exists(alt_path):
-                with open(alt_path, "r", encoding="utf-8") as f:
-                    wf = json.load(f)
-            else:
-                alt_full = os.path.join(os.getcwd(), alt_path)
-                if os.path.exists(alt_full):
-                    with open(alt_full, "r", encoding="utf-8") as f:
-                        wf = json.load(f)
+            wf = workflow_registry.instantiate(alt_path)
         except Exception:
             pass
 
-    # Optional overrides: ckpt / vae / workflow path inputs
-    try:
-        ckpt_override = (request.form.get("ckpt_name") or "").strip()
-        if ckpt_override:
-            for _nid, node in wf.items():
-                if isinstance(node, dict) and node.get("class_type") == "CheckpointLoaderSimple":
-                    node.setdefault("inputs", {})["ckpt_name"] = ckpt_override
-        vae_override = (request.form.get("vae_name") or "").strip()
-        if vae_override:
-            for _nid, node in wf.items():
-                if isinstance(node, dict) and node.get("class_type") == "VAELoader":
-                    node.setdefault("inputs", {})["vae_name"] = vae_override
-    except Exception:
-        pass
-
-    # Patch prompt/negative
-    try:
-        wf["2"]["inputs"]["text"] = prompt_txt
-        wf["3"]["inputs"]["text"] = negative
-    except Exception:
-        pass
-
-    # Optional sampler params
-    sampler = wf.get("4", {}).get("inputs", {})
-
-    def _maybe_num(v):
-        if v is None or v == "":
-            return None
-        try:
-            if "." in str(v):
-                return float(v)
-            return int(v)
-        except Exception:
-            return v
-
-    for key in ("seed", "steps", "cfg"):
-        val = _maybe_num(request.form.get(key))
-        if val is not None and isinstance(sampler, dict):
-            sampler[key] = val
-    for key in ("sampler_name", "scheduler"):
-        val = request.form.get(key)
-        if val:
-            sampler[key] = val
-
-    # Optional size on EmptyLatentImage (commonly node 15)
-    width = _maybe_num(request.form.get("width"))
-    height = _maybe_num(request.form.get("height"))
+    spec = {"prompt": prompt_txt, "negative": negative}
+    spec.update(_form_spec(numeric=("seed", "steps", "cfg", "width", "height"), text=("sampler_name", "scheduler")))
     try:
-        if width:
-            wf["15"]["inputs"]["width"] = width
-        if height:
-            wf["15"]["inputs"]["height"] = height
-    except Exception:
-        pass
+        _patch(wf, spec)
+    except WorkflowError as e:
+        return _json_fail(400, "工作流不支援指定的參數", e)
 
     # Billing check
     ip = client_ip()
     user_id = current_user.id if getattr(current_user, 'is_authenticated', False) else None
-    steps_val = sampler.get('steps') if isinstance(sampler, dict) else None
-    cost = compute_cost('text2image', width=width, height=height, steps=steps_val)
-    free_left = free_remaining(user_id, ip)
-    if free_left <= 0:
-        if not user_id:
-            return jsonify(error='今日免費次數已用完，請登入並購買點數'), 402
-        if balance(user_id) < cost:
-            return jsonify(error='點數不足，請先購買', need=cost), 402
+    steps_val = _sampler_inputs(wf).get('steps')
+    cost = compute_cost('text2image', width=spec.get("width"), height=spec.get("height"), steps=steps_val)
+    free_left, denied = _check_credits(user_id, ip, cost)
+    if denied:
+        return denied
 
-    newfn, err = _run_comfy(wf, kind="text2image", billing={
+    billing = {
         'user_id': user_id,
         'ip': ip,
         'cost': cost,
         'use_free': free_left > 0,
-    })
-    if err:
-        code, payload = err
-        try:
-            data = json.loads(payload)
-        except Exception:
-            data = {"error": payload}
-        return jsonify(data), code
-
-    download_url = url_for("main.serve_output", filename=newfn)
-    return jsonify(message="生成完成", download=download_url, filename=newfn), 200
+    }
+    return jobs.respond("text2image", _generation_runner("text2image", wf), billing)
 
 
 @bp.route("/img2img", methods=["POST"])
@@ -287,129 +244,47 @@ def img2img():
     if "image" not in request.files:
         return jsonify(error="請以上傳 image 檔案 (multipart/form-data)", detail={"missing": "image"}), 400
 
-    img_path = _save_upload(request.files["image"], UPLOAD1)
+    try:
+        img_path = _save_upload(request.files["image"], UPLOAD1, "img2img")
+    except IngestError as e:
+        return jsonify(error=str(e), detail={"field": "image"}), 400
     prompt_txt = (request.form.get("prompt") or "").strip()
     negative = (request.form.get("negative") or "").strip()
 
-    wf_path = os.path.join(os.getcwd(), "workflows", "目前的服務", "圖生圖工作流api.json")
     try:
-        with open(wf_path, "r", encoding="utf-8") as f:
-            wf = json.load(f)
+        wf = workflow_registry.instantiate(IMG2IMG_WORKFLOW)
     except Exception as e:
         return _json_fail(500, "讀取工作流失敗", e)
 
-    wf = copy.deepcopy(wf)
-
-    # Prompts
-    try:
-        wf["2"]["inputs"]["text"] = prompt_txt
-        wf["3"]["inputs"]["text"] = negative
-    except Exception:
-        pass
-
-    # Set image input
-    patched = False
-    # Prefer LoadImage node (id 10 in provided workflow)
-    try:
-        if "10" in wf and isinstance(wf["10"], dict) and "inputs" in wf["10"] and "image" in wf["10"]["inputs"]:
-            wf["10"]["inputs"]["image"] = img_path
-            patched = True
-    except Exception:
-        pass
-    try:
-        if "17" in wf and "inputs" in wf["17"]:
-            if "image" in wf["17"]["inputs"]:
-                wf["17"]["inputs"]["image"] = img_path
-                patched = True
-    except Exception:
-        pass
-    if not patched:
-        for nid in ("30", "47", "50"):
-            if nid in wf and isinstance(wf[nid], dict) and "inputs" in wf[nid]:
-                if "image_path" in wf[nid]["inputs"]:
-                    wf[nid]["inputs"]["image_path"] = img_path
-                    patched = True
-                    break
-
-    # Sampler params
-    sampler = wf.get("4", {}).get("inputs", {})
-
-    def _maybe_num(v):
-        if v is None or v == "":
-            return None
-        try:
-            if "." in str(v):
-                return float(v)
-            return int(v)
-        except Exception:
-            return v
-
-    for key in ("seed", "steps", "cfg", "denoise"):
+    spec = {"prompt": prompt_txt, "negative": negative, "image": img_path}
+    spec.update(_form_spec(numeric=("seed", "steps", "cfg", "denoise"), text=("sampler_name", "scheduler")))
+    # Optional: LatentUpscale width/height
+    for key in ("width", "height"):
         val = _maybe_num(request.form.get(key))
-        if val is not None and isinstance(sampler, dict):
-            sampler[key] = val
-    # Allow sampler_name / scheduler to be overridden by user
-    for key in ("sampler_name", "scheduler"):
-        sval = request.form.get(key)
-        if sval and isinstance(sampler, dict):
-            sampler[key] = sval
-
-    # Optional overrides: ckpt / vae
-    try:
-        ckpt_override = (request.form.get("ckpt_name") or "").strip()
-        if ckpt_override:
-            for _nid, node in wf.items():
-                if isinstance(node, dict) and node.get("class_type") == "CheckpointLoaderSimple":
-                    node.setdefault("inputs", {})["ckpt_name"] = ckpt_override
-        vae_override = (request.form.get("vae_name") or "").strip()
-        if vae_override:
-            for _nid, node in wf.items():
-                if isinstance(node, dict) and node.get("class_type") == "VAELoader":
-                    node.setdefault("inputs", {})["vae_name"] = vae_override
-    except Exception:
-        pass
-
-    # Optional: override LatentUpscale width/height if node 14 exists
-    w_override = _maybe_num(request.form.get("width"))
-    h_override = _maybe_num(request.form.get("height"))
+        if val:
+            spec[key] = int(val)
     try:
-        if "14" in wf and isinstance(wf["14"], dict) and "inputs" in wf["14"]:
-            if w_override:
-                wf["14"]["inputs"]["width"] = int(w_override)
-            if h_override:
-                wf["14"]["inputs"]["height"] = int(h_override)
-    except Exception:
-        pass
+        _patch(wf, spec)
+    except WorkflowError as e:
+        return _json_fail(400, "工作流不支援指定的參數", e)
 
     # Billing check
     ip = client_ip()
     user_id = current_user.id if getattr(current_user, 'is_authenticated', False) else None
-    steps_val = sampler.get('steps') if isinstance(sampler, dict) else None
-    denoise_val = sampler.get('denoise') if isinstance(sampler, dict) else None
-    cost = compute_cost('img2img', steps=steps_val, denoise=denoise_val)
-    free_left = free_remaining(user_id, ip)
-    if free_left <= 0:
-        if not user_id:
-            return jsonify(error='今日免費次數已用完，請登入並購買點數'), 402
-        if balance(user_id) < cost:
-            return jsonify(error='點數不足，請先購買', need=cost), 402
+    sampler = _sampler_inputs(wf)
+    cost = compute_cost('img2img', steps=sampler.get('steps'), denoise=sampler.get('denoise'))
+    free_left, denied = _check_credits(user_id, ip, cost)
+    if denied:
+        return denied
 
-    newfn, err = _run_comfy(wf, kind="img2img", billing={
+    billing = {
         'user_id': user_id,
         'ip': ip,
         'cost': cost,
         'use_free': free_left > 0,
-    })
-    if err:
-        code, payload = err
-        try:
-            data = json.loads(payload)
-        except Exception:
-            data = {"error": payload}
-        return jsonify(data), code
-
-    download_url = url_for("main.serve_output", filename=newfn)
-    return jsonify(message="生成完成", download=download_url, filename=newfn), 200
+    }
+    images = {"image": img_path}
+    return jobs.respond("img2img", _generation_runner("img2img", wf, images), billing, source_path=img_path)
 
 
 @bp.route("/inpaint", methods=["POST"])
@@ -419,77 +294,57 @@ def inpaint():
         missing = [k for k in ("image", "mask") if k not in request.files]
         return jsonify(error="請上傳 image 與 mask 檔案", detail={"missing": missing}), 400
 
-    base_img = _save_upload(request.files["image"], UPLOAD1)
-    mask_img = _save_upload(request.files["mask"], UPLOAD2)
+    try:
+        base_img = _save_upload(request.files["image"], UPLOAD1, "inpaint")
+        mask_img = _save_upload(request.files["mask"], UPLOAD2, "inpaint")
+    except IngestError as e:
+        return jsonify(error=str(e)), 400
     prompt_txt = (request.form.get("prompt") or "").strip()
     negative = (request.form.get("negative") or "").strip()
 
-    wf_path = os.path.join(os.getcwd(), "workflows", "圖生圖工作流局部重繪api.json")
     try:
-        with open(wf_path, "r", encoding="utf-8") as f:
-            wf = json.load(f)
+        wf = workflow_registry.instantiate(INPAINT_WORKFLOW)
     except Exception as e:
         return _json_fail(500, "讀取工作流失敗", e)
 
-    wf = copy.deepcopy(wf)
-
-    try:
-        wf["2"]["inputs"]["text"] = prompt_txt
-        wf["3"]["inputs"]["text"] = negative
-    except Exception:
-        pass
-
-    try:
-        if "28" in wf and "inputs" in wf["28"] and "image_path" in wf["28"]["inputs"]:
-            wf["28"]["inputs"]["image_path"] = base_img
-    except Exception:
-        pass
-    try:
-        if "29" in wf and "inputs" in wf["29"] and "image_path" in wf["29"]["inputs"]:
-            wf["29"]["inputs"]["image_path"] = mask_img
-    except Exception:
-        pass
-
-    # Optional overrides: ckpt / vae
+    # Only the masked region (plus some context) goes through diffusion
+    crop = None
+    cfg = current_app.config
+    if cfg.get("INPAINT_CROP") and (request.form.get("crop") or "").lower() not in ("0", "false", "no"):
+        try:
+            crop = mask_crop.crop_for_inpaint(base_img, mask_img, UPLOAD1,
+                                              resolution=cfg.get("INPAINT_RESOLUTION") or 512,
+                                              padding=cfg.get("INPAINT_CROP_PADDING", 32))
+        except (OSError, ValueError) as e:
+            return _json_fail(400, "無法讀取圖片或遮罩", e)
+        if crop is None:
+            return jsonify(error="遮罩為空", detail={"mask": os.path.basename(mask_img)}), 400
+
+    spec = {"prompt": prompt_txt, "negative": negative, "image": base_img, "mask": mask_img}
+    if crop:
+        w, h = crop.size
+        spec.update(image=crop.image_path, mask=crop.mask_path, width=w, height=h)
     try:
-        ckpt_override = (request.form.get("ckpt_name") or "").strip()
-        if ckpt_override:
-            for _nid, node in wf.items():
-                if isinstance(node, dict) and node.get("class_type") == "CheckpointLoaderSimple":
-                    node.setdefault("inputs", {})["ckpt_name"] = ckpt_override
-        vae_override = (request.form.get("vae_name") or "").strip()
-        if vae_override:
-            for _nid, node in wf.items():
-                if isinstance(node, dict) and node.get("class_type") == "VAELoader":
-                    node.setdefault("inputs", {})["vae_name"] = vae_override
-    except Exception:
-        pass
+        _patch(wf, spec)
+    except WorkflowError as e:
+        return _json_fail(400, "工作流不支援指定的參數", e)
 
     # Billing check
     ip = client_ip()
     user_id = current_user.id if getattr(current_user, 'is_authenticated', False) else None
     cost = compute_cost('inpaint')
-    free_left = free_remaining(user_id, ip)
-    if free_left <= 0:
-        if not user_id:
-            return jsonify(error='今日免費次數已用完，請登入並購買點數'), 402
-        if balance(user_id) < cost:
-            return jsonify(error='點數不足，請先購買', need=cost), 402
+    free_left, denied = _check_credits(user_id, ip, cost)
+    if denied:
+        return denied
 
-    newfn, err = _run_comfy(wf, kind="inpaint", billing={
+    billing = {
         'user_id': user_id,
         'ip': ip,
         'cost': cost,
         'use_free': free_left > 0,
-    })
-    if err:
-        code, payload = err
-        try:
-            data = json.loads(payload)
-        except Exception:
-            data = {"error": payload}
-        return jsonify(data), code
-
-    download_url = url_for("main.serve_output", filename=newfn)
-    return jsonify(message="生成完成", download=download_url, filename=newfn), 200
-
+    }
+    images = {"image": spec["image"], "mask": spec["mask"]}
+    runner = _generation_runner("inpaint", wf, images)
+    if crop:
+        runner = _composite_runner(runner, crop)
+    return jobs.respond("inpaint", runner, billing, source_path=base_img)
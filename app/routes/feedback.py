@@ -67,19 +67,25 @@ def rate_image():
     if user_id:
         rec = ImageRating.query.filter_by(image_id=img.id, user_id=user_id).first()
     if rec:
+        delta_count, delta_sum = 0, rating_val - rec.rating
         rec.rating = rating_val
         cmt = (data.get("comment") or "").strip()
         rec.comment = cmt or rec.comment
     else:
+        delta_count, delta_sum = 1, rating_val
         rec = ImageRating(image_id=img.id, user_id=user_id, rating=rating_val, comment=(data.get("comment") or "").strip() or None)
         db.session.add(rec)
+    # Keep the rollup on image_results in the same transaction (atomic increment)
+    ImageResult.query.filter_by(id=img.id).update(
+        {
+            ImageResult.rating_count: ImageResult.rating_count + delta_count,
+            ImageResult.rating_sum: ImageResult.rating_sum + delta_sum,
+        },
+        synchronize_session=False,
+    )
     db.session.commit()
+    db.session.refresh(img)
 
-    # Aggregate
-    from sqlalchemy import func
-
-    agg = db.session.query(func.count(ImageRating.id), func.avg(ImageRating.rating)).filter(ImageRating.image_id == img.id).first()
-    count = int(agg[0] or 0)
-    avg = float(agg[1] or 0.0)
-    return jsonify(message="已送出評分", image_id=img.id, filename=img.filename, rating=rating_val, avg=round(avg, 2), count=count)
+    return jsonify(message="已送出評分", image_id=img.id, filename=img.filename, rating=rating_val,
+                   avg=round(img.rating_avg, 2), count=img.rating_count)
 
@@ -1,15 +1,102 @@
-from flask import Blueprint, render_template
+from __future__ import annotations
+
+import base64
+from datetime import datetime
+from typing import List, Optional, Tuple
+
+from flask import Blueprint, render_template, request, jsonify, url_for
 from flask_login import current_user
+from sqlalchemy import and_, or_
 
 from app.models import ImageResult
 
 
 bp = Blueprint("gallery", __name__)
 
+PAGE_SIZE = 30
+MAX_PAGE_SIZE = 100
+
+
+class CursorError(ValueError):
+    pass
+
+
+def encode_cursor(im: ImageResult) -> str:
+    raw = f"{im.created_at.isoformat()}|{im.id}".encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str) -> Tuple[datetime, int]:
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+        created, _, image_id = raw.partition("|")
+        return datetime.fromisoformat(created), int(image_id)
+    except Exception as e:
+        raise CursorError("cursor 格式錯誤") from e
+
+
+def gallery_page_of(
+    *, cursor: Optional[str] = None, limit: int = PAGE_SIZE, user_id: Optional[int] = None, kind: Optional[str] = None
+) -> Tuple[List[ImageResult], Optional[str]]:
+    """One page, newest first, seeking past ``cursor`` on (created_at, id) instead of OFFSET."""
+    q = ImageResult.query
+    if user_id is not None:
+        q = q.filter(ImageResult.user_id == user_id)
+    if kind:
+        q = q.filter(ImageResult.kind == kind)
+    if cursor:
+        created, image_id = decode_cursor(cursor)
+        q = q.filter(or_(
+            ImageResult.created_at < created,
+            and_(ImageResult.created_at == created, ImageResult.id < image_id),
+        ))
+    rows = q.order_by(ImageResult.created_at.desc(), ImageResult.id.desc()).limit(limit + 1).all()
+    next_cursor = encode_cursor(rows[limit - 1]) if len(rows) > limit else None
+    return rows[:limit], next_cursor
+
+
+def _item(im: ImageResult) -> dict:
+    return {
+        "id": im.id,
+        "filename": im.filename,
+        "kind": im.kind,
+        "created_at": im.created_at.isoformat(),
+        "url": url_for("main.serve_output", filename=im.filename),
+        "thumb": url_for("main.serve_output", filename=im.filename, w=384, fmt="webp"),
+        "rating_count": im.rating_count or 0,
+        "rating_avg": round(im.rating_avg, 2),
+    }
+
 
 @bp.get("/gallery")
 def gallery_page():
-    # Show recent 60 for now
-    images = ImageResult.query.order_by(ImageResult.created_at.desc()).limit(60).all()
-    return render_template("gallery.html", images=images)
+    # First page rendered server-side; the rest loads from /api/gallery while scrolling
+    images, next_cursor = gallery_page_of(limit=PAGE_SIZE)
+    return render_template("gallery.html", images=images, next_cursor=next_cursor)
+
 
+@bp.get("/api/gallery")
+def gallery_api():
+    """?cursor=&limit=&kind=&user=me|<id> -> {items, next_cursor}."""
+    limit = max(1, min(request.args.get("limit", PAGE_SIZE, type=int), MAX_PAGE_SIZE))
+    user = (request.args.get("user") or "").strip()
+    user_id = None
+    if user == "me":
+        if not getattr(current_user, "is_authenticated", False):
+            return jsonify(error="請先登入"), 401
+        user_id = current_user.id
+    elif user:
+        try:
+            user_id = int(user)
+        except ValueError:
+            return jsonify(error="user 需為 me 或使用者編號"), 400
+    try:
+        images, next_cursor = gallery_page_of(
+            cursor=request.args.get("cursor") or None,
+            limit=limit,
+            user_id=user_id,
+            kind=(request.args.get("kind") or "").strip() or None,
+        )
+    except CursorError as e:
+        return jsonify(error=str(e)), 400
+    return jsonify(items=[_item(im) for im in images], next_cursor=next_cursor)
@@ -0,0 +1,51 @@
+from flask import Blueprint, Response, jsonify, stream_with_context
+from flask_login import current_user
+
+from app import jobs
+from app.billing import client_ip
+from app.extensions import csrf, db
+from app.models import GenerationJob
+
+
+bp = Blueprint("jobs", __name__)
+csrf.exempt(bp)
+
+
+def _owns(job: GenerationJob) -> bool:
+    if job.user_id is not None:
+        return getattr(current_user, "is_authenticated", False) and current_user.id == job.user_id
+    return job.request_ip == client_ip()
+
+
+@bp.get("/jobs/<job_id>")
+def job_status(job_id):
+    job = db.session.get(GenerationJob, job_id)
+    if job is None:
+        return jsonify(error="找不到工作", job_id=job_id), 404
+    return jsonify(jobs.job_payload(job)), 200
+
+
+@bp.delete("/jobs/<job_id>")
+def cancel_job(job_id):
+    """Cancel a queued/running job: its ComfyUI prompt is dequeued or interrupted and nothing is charged."""
+    job = db.session.get(GenerationJob, job_id)
+    if job is None:
+        return jsonify(error="找不到工作", job_id=job_id), 404
+    if not _owns(job):
+        return jsonify(error="無權取消此工作", job_id=job_id), 403
+    if job.status in jobs.TERMINAL:
+        return jsonify(jobs.job_payload(job)), 409
+    job = jobs.cancel(job_id)
+    return jsonify(jobs.job_payload(job)), 200
+
+
+@bp.get("/jobs/<job_id>/events")
+def job_events(job_id):
+    """Server-Sent Events: ``progress`` updates, then a final ``done``/``error``/``cancelled``."""
+    if db.session.get(GenerationJob, job_id) is None:
+        return jsonify(error="找不到工作", job_id=job_id), 404
+    headers = {
+        "Cache-Control": "no-cache",
+        "X-Accel-Buffering": "no",
+    }
+    return Response(stream_with_context(jobs.stream_events(job_id)), mimetype="text/event-stream", headers=headers)
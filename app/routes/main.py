@@ -1,32 +1,85 @@
 # app/routes/main.py
 import os
 import glob
-from flask import Blueprint, current_app, render_template, url_for, send_from_directory, Response
+from flask import Blueprint, current_app, render_template, url_for, send_from_directory, Response, abort, jsonify, request
+from flask_login import current_user
+
+from file_delivery import find_file, send_output
+
+from app import encode, thumbs
+from app.billing import client_ip
+from app.models import ImageResult
 
 bp = Blueprint('main', __name__)
 ALLOWED_EXT = {".png", ".jpg", ".jpeg", ".webp"}
 
 @bp.route('/')
 def index():
-    output_dir = current_app.config['OUTPUT_DIR']
-    # 確保資料夾存在
-    os.makedirs(output_dir, exist_ok=True)
-
-    # 列出所有 .png
-    files = [f for f in os.listdir(output_dir) if f.lower().endswith('.png')]
+    latest = _latest_image()
     latest_url = None
-    if files:
-        # 取最新
-        latest = max(files, key=lambda fn: os.path.getctime(os.path.join(output_dir, fn)))
+    if latest is not None:
         # 生成 /outputs/<filename> 的 URL
-        latest_url = url_for('main.serve_output', filename=latest)
+        latest_url = url_for('main.serve_output', filename=latest.filename)
 
     return render_template('index.html', latest_url=latest_url)
 
+def _latest_image():
+    """呼叫者（登入使用者，否則同 IP）最新的圖片結果；走 (user_id|request_ip, created_at) 索引，不掃描 OUTPUT_DIR。"""
+    q = ImageResult.query
+    if getattr(current_user, 'is_authenticated', False):
+        q = q.filter(ImageResult.user_id == current_user.id)
+    else:
+        q = q.filter(ImageResult.user_id.is_(None), ImageResult.request_ip == client_ip())
+    return q.filter(ImageResult.filename.like('%.png')).order_by(
+        ImageResult.created_at.desc(), ImageResult.id.desc()
+    ).first()
+
+
 @bp.route('/outputs/<path:filename>')
 def serve_output(filename):
-    # 從 OUTPUT_DIR 讀檔案並回傳
-    return send_from_directory(current_app.config['OUTPUT_DIR'], filename)
+    # ?w=<寬度>&fmt=webp|jpeg 回傳縮圖變體，否則回傳原檔
+    width = request.args.get('w', type=int)
+    fmt = request.args.get('fmt')
+    if width is not None or fmt:
+        return _serve_variant(filename, width, fmt)
+    # 依 Accept 標頭改送較小的交付版本（AVIF/WebP/去除中繼資料的 PNG）；?dl=1 下載時只給 PNG
+    download = request.args.get('dl') == '1'
+    rec = ImageResult.query.filter_by(filename=filename).order_by(ImageResult.id.desc()).first()
+    variants = encode.variants_of(rec)
+    if download:
+        variants = {k: v for k, v in variants.items() if k == 'image/png'}
+    chosen = encode.negotiate(variants, request.accept_mimetypes)
+    output_dir = current_app.config['OUTPUT_DIR']
+    if chosen and find_file(output_dir, chosen):
+        resp = send_output(output_dir, chosen, as_attachment=download,
+                           download_name=os.path.basename(filename) if download else None)
+    else:
+        # 從 OUTPUT_DIR 讀檔案並回傳（依 OUTPUT_DELIVERY 交給 nginx/Apache 或由 Flask 串流）
+        resp = send_output(output_dir, filename, as_attachment=download)
+    if variants:
+        resp.vary.add('Accept')
+    return resp
+
+
+def _serve_variant(filename, width, fmt):
+    src = find_file(current_app.config['OUTPUT_DIR'], filename)
+    if src is None:
+        abort(404)
+    try:
+        path, etag, mimetype = thumbs.variant(src, width, fmt)
+    except thumbs.VariantError as e:
+        return jsonify(error="無法產生縮圖", detail=str(e)), 400
+    # 變體以內容雜湊命名，可長期快取
+    return send_output(os.path.dirname(path), os.path.basename(path), mimetype=mimetype, etag=etag)
+
+
+@bp.app_template_global()
+def output_srcset(filename, fmt='webp', max_width=None):
+    """srcset of the resized variants of an output, for <img srcset>."""
+    widths = [w for w in thumbs.widths() if not max_width or w <= max_width]
+    return ', '.join(
+        f"{url_for('main.serve_output', filename=filename, w=w, fmt=fmt)} {w}w" for w in widths
+    )
 
 
 @bp.route('/favicon.ico')
@@ -2,7 +2,7 @@ import requests
 from flask import Blueprint, render_template, request, redirect, url_for, flash, session, current_app
 from flask_login import login_required
 
-from backend.comfy import _fetch_object_info, _extract_choices
+from backend.comfy import get_object_info, _extract_choices
 
 
 bp = Blueprint("settings", __name__)
@@ -15,7 +15,7 @@ def settings_page():
     vae_choices = []
     err = None
     try:
-        info = _fetch_object_info(current_app.config.get("COMFY_ADDR", "127.0.0.1:8188"))
+        info = get_object_info(current_app.config.get("COMFY_ADDR", "127.0.0.1:8188"))
         ckpt_choices = _extract_choices(info, "CheckpointLoaderSimple", "ckpt_name")
         vae_choices = _extract_choices(info, "VAELoader", "vae_name")
     except Exception as e:
@@ -1,12 +1,14 @@
+import json
 import os
 import time
 import uuid
-from typing import Tuple
 
-import numpy as np
 from PIL import Image
-from moviepy.editor import VideoClip
-from flask import Blueprint, request, jsonify, current_app, url_for
+from flask import Blueprint, request, jsonify, current_app
+from flask_login import current_user
+import video_tools
+from app import jobs, video_render
+from app.billing import client_ip
 from app.extensions import csrf, limiter
 from config import OUTPUT_DIR, UPLOAD1
 
@@ -26,95 +28,57 @@ def _save_upload(file_storage, target_dir: str) -> str:
     return path
 
 
-def _pick_output_size(w: int, h: int, prefer: Tuple[int, int] | None) -> Tuple[int, int]:
-    if prefer and prefer[0] and prefer[1]:
-        return int(prefer[0]), int(prefer[1])
-    # Keep aspect, cap long side to 720
-    long = 720
-    if w >= h:
-        ow = long
-        oh = int(h * (long / w))
-    else:
-        oh = long
-        ow = int(w * (long / h))
-    # Ensure multiples of 2 for h264
-    ow += ow % 2
-    oh += oh % 2
-    return ow, oh
-
-
 @bp.post("/img2vid")
 @limiter.limit("20/minute")
 def img2vid():
     if "image" not in request.files:
         return jsonify(error="請以 multipart/form-data 上傳 image 檔"), 400
 
+    # Parameters (bounded before anything is stored or rendered)
+    try:
+        duration, fps, prefer_size = video_render.clip_options(
+            request.form.get("duration"), request.form.get("fps"), request.form.get("width"), request.form.get("height"))
+    except ValueError as e:
+        return jsonify(error="影片參數錯誤", detail=str(e)), 400
+
     src_path = _save_upload(request.files["image"], UPLOAD1)
 
-    # Parameters
-    try:
-        duration = float(request.form.get("duration", "4"))
-    except Exception:
-        duration = 4.0
-    try:
-        fps = int(request.form.get("fps", "24"))
-    except Exception:
-        fps = 24
     motion = (request.form.get("motion") or "zoom_in").strip()
-    out_w = request.form.get("width")
-    out_h = request.form.get("height")
+    easing = (request.form.get("easing") or "linear").strip()
+    if motion not in video_render.MOTIONS or easing not in video_render.EASINGS:
+        return jsonify(error="不支援的運鏡參數", motions=list(video_render.MOTIONS), easings=list(video_render.EASINGS)), 400
     try:
-        prefer_size = (int(out_w), int(out_h)) if out_w and out_h else None
-    except Exception:
-        prefer_size = None
-
-    # Load image
-    im = Image.open(src_path).convert("RGB")
-    W, H = im.size
-    OW, OH = _pick_output_size(W, H, prefer_size)
+        preset, crf = video_render.encoder_options(request.form.get("preset"), request.form.get("crf"))
+    except ValueError as e:
+        return jsonify(error="編碼參數錯誤", detail=str(e)), 400
 
-    # Precompute numpy array for speed
-    # We'll crop on PIL per frame to preserve quality
-
-    # Motion parameters
-    start_zoom = 1.0
-    end_zoom = 1.08 if motion == "zoom_in" else (0.92 if motion == "zoom_out" else 1.0)
-    pan_x = {"pan_left": -0.2, "pan_right": 0.2}.get(motion, 0.0)
-    pan_y = {"pan_up": -0.15, "pan_down": 0.15}.get(motion, 0.0)
-
-    def make_frame(t: float):
-        p = 0.0 if duration <= 0 else max(0.0, min(1.0, t / duration))
-        zoom = start_zoom + (end_zoom - start_zoom) * p
-        # Compute crop window under zoom + pan
-        crop_w = int(W / zoom)
-        crop_h = int(H / zoom)
-        max_x = max(0, W - crop_w)
-        max_y = max(0, H - crop_h)
-        x = int((max_x / 2) + max_x * pan_x * (p - 0.5) * 2)
-        y = int((max_y / 2) + max_y * pan_y * (p - 0.5) * 2)
-        x = max(0, min(W - crop_w, x))
-        y = max(0, min(H - crop_h, y))
-        frame = im.crop((x, y, x + crop_w, y + crop_h)).resize((OW, OH), Image.LANCZOS)
-        return np.asarray(frame)
-
-    clip = VideoClip(make_frame, duration=max(0.5, duration))
+    # Only read the header here; decoding happens in the render process
+    try:
+        with Image.open(src_path) as im:
+            W, H = im.size
+    except Exception as e:
+        return jsonify(error="無法讀取圖片", detail=str(e)), 400
+    OW, OH = video_render.pick_output_size(W, H, prefer_size)
 
-    # Write video
     ts = time.strftime("%Y%m%d_%H%M%S", time.localtime())
-    out_fn = f"i2v_{ts}.mp4"
+    out_fn = f"i2v_{ts}_{uuid.uuid4().hex[:8]}.mp4"
     os.makedirs(OUTPUT_DIR, exist_ok=True)
-    out_path = os.path.join(OUTPUT_DIR, out_fn)
-    clip.write_videofile(
-        out_path,
-        fps=fps,
-        codec="libx264",
-        audio=False,
-        preset="medium",
-        ffmpeg_params=["-pix_fmt", "yuv420p"],
-        verbose=False,
-        logger=None,
-    )
-
-    url = url_for("main.serve_output", filename=out_fn)
-    return jsonify(message="已產生影片", download=url, filename=out_fn, width=OW, height=OH, fps=fps, duration=duration), 200
-
+    opts = dict(duration=duration, fps=fps, motion=motion, easing=easing, width=OW, height=OH, preset=preset, crf=crf)
+
+    def runner(report):
+        out_path = os.path.join(OUTPUT_DIR, out_fn)
+        try:
+            video_render.render(src_path, out_path, opts, report)
+        except Exception as e:
+            current_app.logger.exception("img2vid render failed")
+            return None, (500, json.dumps({"error": "影片產生失敗", "detail": str(e)}, ensure_ascii=False))
+        # First frame as <video poster> (job_payload links it); the clip itself is already fast-start
+        try:
+            video_tools.poster(out_path)
+        except Exception:
+            current_app.logger.warning("img2vid poster failed for %s", out_fn, exc_info=True)
+        return out_fn, None
+
+    billing = {"user_id": current_user.id if getattr(current_user, "is_authenticated", False) else None, "ip": client_ip()}
+    # 非同步工作（202 + job_id，SSE 進度）；wait=1 時同步回傳結果
+    return jobs.respond("img2vid", runner, billing, source_path=src_path, record=False)
@@ -26,17 +26,27 @@ document.addEventListener('DOMContentLoaded', () => {
   }
   function showOk(el, text) { el.textContent = '✅ ' + (text || '完成'); }
 
+  // Resized variants served by /outputs/<file>?w=&fmt= (full size stays for download / zoom)
+  function outputVariant(url, w) { return url + (url.includes('?') ? '&' : '?') + 'w=' + w + '&fmt=webp'; }
+  function outputSrcset(url) { return [384, 768, 1024].map(w => outputVariant(url, w) + ' ' + w + 'w').join(', '); }
+
   function renderImageCard(container, titleText, url) {
     container.innerHTML = '';
     const card = document.createElement('div'); card.className = 'card result';
     const title = document.createElement('h2'); title.textContent = titleText || '最新結果';
-    const img = document.createElement('img'); img.src = url; img.style.cursor = 'zoom-in';
+    const img = document.createElement('img'); img.style.cursor = 'zoom-in'; img.decoding = 'async';
+    if (url && url.startsWith('/outputs/')) {
+      img.srcset = outputSrcset(url); img.sizes = '(min-width: 900px) 720px, 100vw'; img.src = outputVariant(url, 768);
+      img.addEventListener('error', () => { if (img.srcset) { img.removeAttribute('srcset'); img.src = url; } }, { once: true });
+    } else {
+      img.src = url;
+    }
     card.appendChild(title); card.appendChild(img);
 
     const actions = document.createElement('div'); actions.className = 'row';
     const btnCopy = document.createElement('button'); btnCopy.className = 'btn ghost'; btnCopy.textContent = '複製連結';
     btnCopy.addEventListener('click', async () => { try { await navigator.clipboard.writeText(url); toast('已複製下載連結', 'success'); } catch { toast('無法複製', 'error'); } });
-    const btnDl = document.createElement('a'); btnDl.className = 'btn secondary'; btnDl.textContent = '下載圖片'; btnDl.href = url; btnDl.download = '';
+    const btnDl = document.createElement('a'); btnDl.className = 'btn secondary'; btnDl.textContent = '下載圖片'; btnDl.href = url && url.startsWith('/outputs/') ? url + '?dl=1' : url; btnDl.download = '';
     actions.appendChild(btnCopy); actions.appendChild(btnDl); card.appendChild(actions);
 
     const modal = document.getElementById('imgModal');
@@ -225,23 +235,70 @@ document.addEventListener('DOMContentLoaded', () => {
   function uploadXHR(url, formData, onProgress) {
     return new Promise((resolve, reject) => {
       const xhr = new XMLHttpRequest(); xhr.open('POST', url, true);
-      xhr.onload = () => { try { resolve({ ok: xhr.status >= 200 && xhr.status < 300, json: JSON.parse(xhr.responseText) }); } catch (e) { reject(e); } };
+      xhr.onload = () => { try { resolve({ ok: xhr.status >= 200 && xhr.status < 300, status: xhr.status, json: JSON.parse(xhr.responseText) }); } catch (e) { reject(e); } };
       xhr.onerror = () => reject(new Error('Network error'));
       if (xhr.upload && onProgress) xhr.upload.onprogress = (ev) => { if (ev.lengthComputable) onProgress(Math.round(ev.loaded * 100 / ev.total)); };
       xhr.send(formData);
     });
   }
 
+  // Follow a background generation job (202 + job_id) until it finishes.
+  function followJob(job, onProgress, onStatus, onPreview) {
+    return new Promise((resolve) => {
+      const finish = (ok, data) => resolve({ ok, json: data });
+      if (!window.EventSource) {
+        const poll = async () => {
+          try {
+            const r = await fetch(job.status_url, { headers: { 'Accept': 'application/json' } }); const j = await r.json();
+            if (j.status === 'done') return finish(true, j);
+            if (j.status === 'error' || j.status === 'cancelled' || !r.ok) return finish(false, j);
+            if (onProgress) onProgress(Math.round((j.progress || 0) * 100));
+          } catch (_) {}
+          setTimeout(poll, 1500);
+        };
+        return poll();
+      }
+      const es = new EventSource(job.events_url);
+      es.addEventListener('progress', (ev) => { try { const d = JSON.parse(ev.data); if (onProgress && d.progress != null) onProgress(Math.round(d.progress * 100)); if (onStatus && d.eta != null) onStatus(`⌛ 生成中... 約剩 ${Math.ceil(d.eta)} 秒`); } catch (_) {} });
+      es.addEventListener('queued', (ev) => { try { const d = JSON.parse(ev.data); if (onStatus) onStatus(d.position > 1 ? `⌛ 排隊中，前面還有 ${d.position - 1} 個任務` : '⌛ 排隊中，下一個就輪到您'); } catch (_) {} });
+      es.addEventListener('started', () => { if (onStatus) onStatus('⌛ 生成中...'); });
+      es.addEventListener('preview', (ev) => { try { const d = JSON.parse(ev.data); if (onPreview && d.image) onPreview(d.image); } catch (_) {} });
+      es.addEventListener('done', (ev) => { es.close(); finish(true, JSON.parse(ev.data)); });
+      es.addEventListener('cancelled', (ev) => { es.close(); finish(false, JSON.parse(ev.data)); });
+      es.addEventListener('error', (ev) => {
+        es.close();
+        if (ev.data) { try { return finish(false, JSON.parse(ev.data)); } catch (_) {} }
+        // Stream dropped: fall back to the status endpoint
+        fetch(job.status_url).then((r) => r.json()).then((j) => {
+          if (j.status === 'done') finish(true, j);
+          else if (j.status === 'error' || j.status === 'cancelled') finish(false, j);
+          else setTimeout(() => followJob(job, onProgress, onStatus, onPreview).then(resolve), 1000);
+        }).catch(() => finish(false, { error: '連線中斷' }));
+      });
+    });
+  }
+
   async function submitWithBusy(form, msgEl, url, onSuccess) {
     const btn = form.querySelector('button[type="submit"], .btn'); if (btn) btn.disabled = true;
-    msgEl.textContent = '⌛ 處理中...'; const prog = form.querySelector('.progress');
+    msgEl.textContent = '⌛ 處理中...'; const prog = form.querySelector('.progress'); let preview = null; let stop = null;
     try {
       const fd = new FormData(form); if (prog) prog.style.display = 'block';
-      const r = await uploadXHR(url, fd, (pct) => { const bar = prog && prog.querySelector('.bar'); if (bar) bar.style.width = pct + '%'; });
+      const setBar = (pct) => { const bar = prog && prog.querySelector('.bar'); if (bar) bar.style.width = pct + '%'; };
+      let r = await uploadXHR(url, fd, setBar);
+      if (r.status === 202 && r.json && r.json.job_id) {
+        msgEl.textContent = '⌛ 生成中...'; setBar(0);
+        // Latent previews replace one <img> under the message while the job runs
+        const showPreview = (src) => { if (!preview) { preview = new Image(); preview.className = 'job-preview'; preview.alt = '生成預覽'; msgEl.after(preview); } preview.src = src; };
+        // Cancelling dequeues/interrupts the ComfyUI prompt; nothing is charged
+        const job = r.json; stop = document.createElement('button'); stop.type = 'button'; stop.className = 'btn secondary job-cancel'; stop.textContent = '取消';
+        stop.addEventListener('click', () => { stop.disabled = true; fetch(job.status_url, { method: 'DELETE' }).catch(() => {}); });
+        msgEl.after(stop);
+        r = await followJob(r.json, setBar, (text) => { msgEl.textContent = text; }, showPreview);
+      }
       const j = r.json; if (r.ok) { showOk(msgEl, j.message || '完成'); toast('完成', 'success'); if (onSuccess) onSuccess(j); }
       else { showError(msgEl, j); toast(j.error || '失敗', 'error'); }
     } catch (err) { showError(msgEl, String(err)); toast('連線失敗', 'error'); }
-    finally { if (btn) btn.disabled = false; if (prog) { const bar = prog.querySelector('.bar'); if (bar) bar.style.width = '0%'; prog.style.display = 'none'; } }
+    finally { if (btn) btn.disabled = false; if (preview) preview.remove(); if (stop) stop.remove(); if (prog) { const bar = prog.querySelector('.bar'); if (bar) bar.style.width = '0%'; prog.style.display = 'none'; } }
   }
 
   function bindDropzone(form, fileInput, onPreview) {
@@ -0,0 +1,208 @@
+from __future__ import annotations
+
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+from flask import current_app
+from PIL import Image, features
+
+from comfy_client import file_digest
+
+
+# Resized WebP/JPEG derivatives of files in OUTPUT_DIR.  A variant is keyed by
+# the SHA-256 of its source's content plus the requested width/format, so the
+# key doubles as a strong ETag and an output that is overwritten can never be
+# served a stale thumbnail.  Variants live under THUMB_CACHE_DIR/<key[:2]>/ and
+# the least recently used ones are removed once the directory outgrows
+# THUMB_CACHE_MAX_MB (file mtime is the "last used" stamp).
+
+_VERSION = "1"  # bump to invalidate every variant when the encoding changes
+
+_FORMATS = {
+    "webp": ("WEBP", "image/webp", {"quality": 80, "method": 4}),
+    "jpeg": ("JPEG", "image/jpeg", {"quality": 82, "optimize": True, "progressive": True}),
+}
+_ALIASES = {"jpg": "jpeg"}
+_SOURCE_EXTS = {".png", ".jpg", ".jpeg", ".webp"}
+_TOUCH_AFTER = 3600  # refresh a variant's mtime on hit at most once an hour
+
+
+class VariantError(ValueError):
+    """Raised for a variant request that cannot be served (bad width/format/source)."""
+
+
+_lock = threading.Lock()
+_pool_lock = threading.Lock()
+_executor: Optional[ThreadPoolExecutor] = None
+_inflight: Dict[str, Future] = {}
+_digests: "OrderedDict[Tuple[str, int, int], str]" = OrderedDict()
+_DIGEST_LIMIT = 4096
+_cache_bytes: Optional[int] = None
+
+
+def widths() -> List[int]:
+    raw = str(current_app.config.get("THUMB_WIDTHS") or "")
+    return sorted({int(w) for w in raw.replace(" ", "").split(",") if w.isdigit() and int(w) > 0})
+
+
+def _pool() -> ThreadPoolExecutor:
+    global _executor
+    with _pool_lock:
+        if _executor is None:
+            workers = max(1, int(current_app.config.get("THUMB_WORKERS") or 2))
+            _executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="thumbs")
+        return _executor
+
+
+def _source_digest(path: str) -> str:
+    """Content hash of ``path``, memoised on (path, mtime, size)."""
+    st = os.stat(path)
+    sig = (path, st.st_mtime_ns, st.st_size)
+    with _lock:
+        digest = _digests.get(sig)
+        if digest is not None:
+            _digests.move_to_end(sig)
+            return digest
+    digest = file_digest(path)
+    with _lock:
+        _digests[sig] = digest
+        while len(_digests) > _DIGEST_LIMIT:
+            _digests.popitem(last=False)
+    return digest
+
+
+def normalize(width: Optional[int], fmt: Optional[str]) -> Tuple[int, str]:
+    """Snap ``width`` up to a configured size and resolve ``fmt`` (default webp)."""
+    allowed = widths()
+    if not allowed:
+        raise VariantError("縮圖服務未啟用")
+    if width is None:
+        width = allowed[-1]
+    if width <= 0:
+        raise VariantError("w 需為正整數")
+    width = next((w for w in allowed if w >= width), allowed[-1])
+    fmt = _ALIASES.get((fmt or "webp").lower(), (fmt or "webp").lower())
+    if fmt not in _FORMATS:
+        raise VariantError(f"不支援的格式：{fmt}")
+    if fmt == "webp" and not features.check("webp"):
+        fmt = "jpeg"
+    return width, fmt
+
+
+def _render(src: str, dst: str, width: int, fmt: str) -> None:
+    pil_format, _, options = _FORMATS[fmt]
+    with Image.open(src) as im:
+        im.draft("RGB", (width, width * 4))  # JPEG sources decode at reduced scale
+        if im.width > width:
+            im.thumbnail((width, round(im.height * width / im.width) or 1), Image.LANCZOS, reducing_gap=2.0)
+        if fmt == "jpeg" and im.mode in ("RGBA", "LA", "P"):
+            im = im.convert("RGBA")
+            flat = Image.new("RGB", im.size, (255, 255, 255))
+            flat.paste(im, mask=im.split()[-1])
+            im = flat
+        elif im.mode not in ("RGB", "RGBA"):
+            im = im.convert("RGBA" if "A" in im.getbands() else "RGB")
+        tmp = f"{dst}.{threading.get_ident()}.tmp"
+        im.save(tmp, pil_format, **options)
+    os.replace(tmp, dst)
+
+
+def variant(src: str, width: Optional[int] = None, fmt: Optional[str] = None) -> Tuple[str, str, str]:
+    """Path, ETag and mimetype of the ``width``/``fmt`` variant of ``src``, rendering it if needed."""
+    if os.path.splitext(src)[1].lower() not in _SOURCE_EXTS:
+        raise VariantError("僅支援圖片縮圖")
+    width, fmt = normalize(width, fmt)
+    key = hashlib.sha256(f"{_source_digest(src)}:{width}:{fmt}:{_VERSION}".encode()).hexdigest()
+    folder = os.path.join(current_app.config["THUMB_CACHE_DIR"], key[:2])
+    dst = os.path.join(folder, f"{key}.{fmt}")
+    mimetype = _FORMATS[fmt][1]
+    try:
+        st = os.stat(dst)
+    except FileNotFoundError:
+        pass
+    else:
+        if st.st_mtime < time.time() - _TOUCH_AFTER:
+            try:
+                os.utime(dst)
+            except OSError:
+                pass
+        return dst, key, mimetype
+
+    # One render per key no matter how many requests ask for it concurrently
+    with _lock:
+        fut = _inflight.get(key)
+        owner = fut is None
+        if owner:
+            os.makedirs(folder, exist_ok=True)
+            fut = _pool().submit(_render, src, dst, width, fmt)
+            _inflight[key] = fut
+    try:
+        fut.result(timeout=float(current_app.config.get("THUMB_TIMEOUT") or 30))
+    except Exception as e:
+        raise VariantError(f"縮圖產生失敗：{e}") from e
+    finally:
+        if owner:
+            with _lock:
+                _inflight.pop(key, None)
+    if owner:
+        _account(os.path.getsize(dst))
+    return dst, key, mimetype
+
+
+def _max_bytes() -> int:
+    return int(current_app.config.get("THUMB_CACHE_MAX_MB") or 0) * 1024 * 1024
+
+
+def _account(added: int) -> None:
+    global _cache_bytes
+    if _max_bytes() <= 0:
+        return
+    with _lock:
+        if _cache_bytes is not None:
+            _cache_bytes += added
+        total = _cache_bytes
+    if total is None or total > _max_bytes():
+        evict()
+
+
+def _scan(root: str) -> List[Tuple[float, int, str]]:
+    entries = []
+    for dirpath, _, names in os.walk(root):
+        for name in names:
+            if name.endswith(".tmp"):
+                continue
+            path = os.path.join(dirpath, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+    return entries
+
+
+def evict(max_bytes: Optional[int] = None) -> int:
+    """Remove least recently used variants until the cache fits; returns how many were removed."""
+    global _cache_bytes
+    limit = _max_bytes() if max_bytes is None else max_bytes
+    entries = _scan(current_app.config["THUMB_CACHE_DIR"])
+    total = sum(size for _, size, _ in entries)
+    removed = 0
+    if limit > 0 and total > limit:
+        for _, size, path in sorted(entries):
+            if total <= limit:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+            removed += 1
+        current_app.logger.info("Thumbnail cache evicted %d variants (%d bytes left)", removed, total)
+    with _lock:
+        _cache_bytes = total
+    return removed
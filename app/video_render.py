@@ -0,0 +1,311 @@
+from __future__ import annotations
+
+import multiprocessing
+import os
+import queue
+import subprocess
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable, Dict, Iterator, Optional, Tuple
+
+from flask import current_app
+
+from video_tools import ffmpeg_exe
+
+try:  # POSIX only; elsewhere the per-process pool size is the only bound
+    import fcntl
+except ImportError:  # pragma: no cover
+    fcntl = None
+
+
+# Ken Burns (zoom/pan) clips for /img2vid, rendered outside the web process.
+# Each app process owns a small spawn-based process pool (IMG2VID_WORKERS), and
+# every render additionally holds one of IMG2VID_MAX_PER_NODE lock-file slots
+# so all gunicorn workers on a host together never encode more clips at once
+# than the host has slots for.  Progress comes back over a manager queue.
+#
+# Frames are produced without moviepy: the source is downscaled once to just
+# above the output size, every frame's zoom/pan is precomputed as an affine map
+# with NumPy, each frame is a single Image.transform(AFFINE) of the pre-scaled
+# source, and raw RGB is piped straight into ffmpeg's stdin.
+
+PRESETS = ("ultrafast", "superfast", "veryfast", "faster", "fast", "medium", "slow")
+# Request bounds: a render holds a host-wide slot, and each raw frame is W*H*3 bytes
+MAX_FPS = 60
+MAX_DURATION = 30.0
+MIN_SIDE, MAX_SIDE = 16, 1920
+
+_lock = threading.Lock()
+_executor: Optional[ProcessPoolExecutor] = None
+_manager = None
+
+
+def _pool() -> Tuple[ProcessPoolExecutor, object]:
+    global _executor, _manager
+    with _lock:
+        if _executor is None:
+            ctx = multiprocessing.get_context("spawn")
+            workers = max(1, int(current_app.config.get("IMG2VID_WORKERS") or 1))
+            _executor = ProcessPoolExecutor(max_workers=workers, mp_context=ctx)
+            _manager = ctx.Manager()
+        return _executor, _manager
+
+
+def encoder_options(preset: Optional[str], crf) -> Tuple[str, int]:
+    """Validated x264 preset / CRF, falling back to the configured defaults."""
+    cfg = current_app.config
+    preset = (preset or cfg.get("IMG2VID_PRESET") or "veryfast").strip().lower()
+    if preset not in PRESETS:
+        raise ValueError(f"preset 需為 {', '.join(PRESETS)} 之一")
+    try:
+        crf = int(crf if crf not in (None, "") else cfg.get("IMG2VID_CRF") or 23)
+    except (TypeError, ValueError):
+        raise ValueError("crf 需為整數")
+    if not 0 <= crf <= 51:
+        raise ValueError("crf 需介於 0~51")
+    return preset, crf
+
+
+def clip_options(duration, fps, width, height) -> Tuple[float, int, Optional[Tuple[int, int]]]:
+    """Validated duration / fps / preferred size (None unless both sides are given)."""
+    try:
+        duration = float(duration if duration not in (None, "") else 4)
+        fps = int(fps if fps not in (None, "") else 24)
+    except (TypeError, ValueError):
+        raise ValueError("duration 需為數字、fps 需為整數")
+    if not 0 < duration <= MAX_DURATION:
+        raise ValueError(f"duration 需介於 0~{MAX_DURATION:g} 秒")
+    if not 1 <= fps <= MAX_FPS:
+        raise ValueError(f"fps 需介於 1~{MAX_FPS}")
+    if width in (None, "") or height in (None, ""):
+        return duration, fps, None
+    try:
+        size = (int(width), int(height))
+    except (TypeError, ValueError):
+        raise ValueError("width / height 需為整數")
+    if min(size) < MIN_SIDE or max(size) > MAX_SIDE:
+        raise ValueError(f"width / height 需介於 {MIN_SIDE}~{MAX_SIDE}")
+    return duration, fps, size
+
+
+def pick_output_size(w: int, h: int, prefer: Tuple[int, int] | None) -> Tuple[int, int]:
+    if prefer and prefer[0] and prefer[1]:
+        # yuv420p needs even dimensions
+        return max(2, int(prefer[0]) // 2 * 2), max(2, int(prefer[1]) // 2 * 2)
+    # Keep aspect, cap long side to 720
+    long = 720
+    if w >= h:
+        ow = long
+        oh = int(h * (long / w))
+    else:
+        oh = long
+        ow = int(w * (long / h))
+    # Ensure multiples of 2 for h264
+    ow += ow % 2
+    oh += oh % 2
+    return ow, oh
+
+
+@contextmanager
+def _node_slot(lock_dir: str, slots: int, poll: float = 0.5) -> Iterator[None]:
+    """Hold one of ``slots`` host-wide render slots (flock on lock_dir/slot-N.lock)."""
+    if fcntl is None or slots <= 0:
+        yield
+        return
+    os.makedirs(lock_dir, exist_ok=True)
+    while True:
+        for i in range(slots):
+            fh = open(os.path.join(lock_dir, f"img2vid-slot-{i}.lock"), "a+")
+            try:
+                fcntl.flock(fh, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                fh.close()
+                continue
+            try:
+                yield
+            finally:
+                fcntl.flock(fh, fcntl.LOCK_UN)
+                fh.close()
+            return
+        time.sleep(poll)
+
+
+# Easing curves on p in [0, 1] (vectorised)
+EASINGS = {
+    "linear": lambda p: p,
+    "ease_in": lambda p: p * p * p,
+    "ease_out": lambda p: 1 - (1 - p) ** 3,
+    "ease_in_out": lambda p: p * p * (3 - 2 * p),
+}
+
+# motion -> (zoom_start, zoom_end, x_start, x_end, y_start, y_end); x/y are the
+# crop window's position as a fraction of the slack left by the zoom
+_MOTION_PATHS = {
+    "zoom_in": (1.0, 1.08, 0.5, 0.5, 0.5, 0.5),
+    "zoom_out": (1.08, 1.0, 0.5, 0.5, 0.5, 0.5),
+    "pan_left": (1.15, 1.15, 0.85, 0.15, 0.5, 0.5),
+    "pan_right": (1.15, 1.15, 0.15, 0.85, 0.5, 0.5),
+    "pan_up": (1.15, 1.15, 0.5, 0.5, 0.85, 0.15),
+    "pan_down": (1.15, 1.15, 0.5, 0.5, 0.15, 0.85),
+}
+MOTIONS = tuple(_MOTION_PATHS)
+
+
+def frame_transforms(n: int, src_size: Tuple[int, int], out_size: Tuple[int, int], motion: str,
+                     easing: str = "linear"):
+    """(n, 6) PIL AFFINE coefficients (output pixel -> source pixel) for every frame."""
+    import numpy as np
+
+    W, H = src_size
+    OW, OH = out_size
+    z0, z1, x0, x1, y0, y1 = _MOTION_PATHS.get(motion, _MOTION_PATHS["zoom_in"])
+    p = np.linspace(0.0, 1.0, n) if n > 1 else np.zeros(1)
+    e = EASINGS.get(easing, EASINGS["linear"])(p)
+    zoom = z0 + (z1 - z0) * e
+    crop_w = W / zoom
+    crop_h = H / zoom
+    left = (x0 + (x1 - x0) * e) * (W - crop_w)
+    top = (y0 + (y1 - y0) * e) * (H - crop_h)
+    coeffs = np.zeros((len(p), 6))
+    coeffs[:, 0] = crop_w / OW
+    coeffs[:, 2] = left
+    coeffs[:, 4] = crop_h / OH
+    coeffs[:, 5] = top
+    return coeffs
+
+
+def prescale(im, out_size: Tuple[int, int], max_zoom: float):
+    """Downscale the source once to just above what the most zoomed-in frame samples."""
+    from PIL import Image
+
+    W, H = im.size
+    OW, OH = out_size
+    scale = min(1.0, max(OW * max_zoom / W, OH * max_zoom / H) * 1.05)
+    if scale >= 0.95:
+        return im
+    size = (max(OW, round(W * scale)), max(OH, round(H * scale)))
+    return im.resize(size, Image.LANCZOS, reducing_gap=3.0)
+
+
+def iter_frames(im, out_size: Tuple[int, int], n: int, motion: str, easing: str = "linear") -> Iterator[bytes]:
+    """Raw RGB24 frames: one bilinear AFFINE transform of the pre-scaled source per frame."""
+    from PIL import Image
+
+    z0, z1 = _MOTION_PATHS.get(motion, _MOTION_PATHS["zoom_in"])[:2]
+    src = prescale(im.convert("RGB"), out_size, max(z0, z1))
+    coeffs = frame_transforms(n, src.size, out_size, motion, easing)
+    for row in coeffs:
+        yield src.transform(out_size, Image.AFFINE, tuple(row), resample=Image.BILINEAR).tobytes()
+
+
+def encode_frames(frames: Iterator[bytes], out_path: str, size: Tuple[int, int], fps: int, preset: str, crf: int,
+                  on_frame: Optional[Callable[[int], None]] = None) -> int:
+    """Pipe raw RGB frames into ffmpeg/libx264; returns the number of frames written."""
+    OW, OH = size
+    cmd = [
+        ffmpeg_exe(), "-y", "-loglevel", "error",
+        "-f", "rawvideo", "-pix_fmt", "rgb24", "-s", f"{OW}x{OH}", "-r", str(fps), "-i", "-",
+        "-an", "-c:v", "libx264", "-preset", preset, "-crf", str(crf),
+        "-pix_fmt", "yuv420p", "-movflags", "+faststart",
+        out_path,
+    ]
+    with tempfile.TemporaryFile() as errlog:
+        proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stderr=errlog)
+        written = 0
+        try:
+            for frame in frames:
+                proc.stdin.write(frame)
+                written += 1
+                if on_frame:
+                    on_frame(written)
+        except BrokenPipeError:
+            pass
+        finally:
+            try:
+                proc.stdin.close()
+            except BrokenPipeError:
+                pass
+            code = proc.wait()
+        if code != 0:
+            errlog.seek(0)
+            raise RuntimeError(f"ffmpeg 編碼失敗 ({code}): {errlog.read().decode(errors='replace')[-500:]}")
+    return written
+
+
+def _render_worker(src_path: str, out_path: str, opts: Dict, progress, cancel) -> Dict:
+    """Runs in a pool process: wait for a host slot, then render and encode the clip.
+
+    ``cancel`` (a manager Event) stops the render between frames.
+    """
+    from PIL import Image
+
+    def emit(event: str, **data) -> None:
+        try:
+            progress.put_nowait((event, data))
+        except Exception:
+            pass
+
+    with _node_slot(opts["lock_dir"], opts["max_per_node"]):
+        if cancel.is_set():
+            raise RuntimeError("渲染已取消")
+        emit("status", status="rendering")
+        size = (opts["width"], opts["height"])
+        fps = opts["fps"]
+        total = max(1, int(round(max(0.5, opts["duration"]) * fps)))
+        step = max(1, fps // 4)
+
+        def on_frame(i: int) -> None:
+            if i % step == 0 or i == total:
+                if cancel.is_set():
+                    raise RuntimeError("渲染已取消")
+                emit("progress", value=i, max=total)
+
+        try:
+            with Image.open(src_path) as im:
+                im.draft("RGB", (size[0] * 2, size[1] * 2))  # JPEG: decode at reduced scale
+                frames = iter_frames(im, size, total, opts["motion"], opts.get("easing") or "linear")
+                encode_frames(frames, out_path, size, fps, opts["preset"], opts["crf"], on_frame)
+        except BaseException:
+            if os.path.exists(out_path):
+                os.remove(out_path)
+            raise
+    return {"width": size[0], "height": size[1], "frames": total}
+
+
+def render(src_path: str, out_path: str, opts: Dict, report: Callable[..., None]) -> Dict:
+    """Render in the process pool, relaying the worker's progress to ``report``; blocks until done.
+
+    Stops early when the job is cancelled (``report.cancelled``, see app.jobs).
+    """
+    executor, manager = _pool()
+    progress = manager.Queue()
+    cancel = manager.Event()
+    cancelled = getattr(report, "cancelled", None)
+    opts = dict(
+        opts,
+        lock_dir=current_app.config["IMG2VID_LOCK_DIR"],
+        max_per_node=int(current_app.config.get("IMG2VID_MAX_PER_NODE") or 0),
+    )
+    fut = executor.submit(_render_worker, src_path, out_path, opts, progress, cancel)
+    timeout = float(current_app.config.get("IMG2VID_TIMEOUT") or 600)
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            event, data = progress.get(timeout=0.25)
+            report(event, **data)
+            continue
+        except queue.Empty:
+            pass
+        if fut.done():
+            break
+        if cancelled is not None and cancelled.is_set() and not cancel.is_set():
+            cancel.set()
+            fut.cancel()
+        if time.monotonic() > deadline:
+            cancel.set()
+            fut.cancel()
+            raise TimeoutError(f"影片渲染逾時（{int(timeout)} 秒）")
+    return fut.result()
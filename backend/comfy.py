@@ -1,11 +1,18 @@
 import json
 import os
+import threading
 import time
+import traceback
+import uuid
 from typing import Dict, List, Optional, Tuple
 
 import requests
 from flask import current_app, session, has_request_context
 
+from comfy_client import ComfyError, output_files
+from comfy_pool import NoNodeAvailable
+from comfy_progress import ProgressTracker
+
 
 def _fetch_object_info(comfy_addr: str) -> Dict:
     url = f"http://{comfy_addr}/object_info"
@@ -14,6 +21,85 @@ def _fetch_object_info(comfy_addr: str) -> Dict:
     return r.json()
 
 
+# /object_info is a multi-megabyte document that only changes when models or
+# custom nodes are added, so it is cached per ComfyUI address.  Stale entries
+# are served immediately while a background thread refreshes them; only the
+# very first lookup for an address blocks on ComfyUI.
+_OBJECT_INFO_NEGATIVE_TTL = 15.0  # seconds an unreachable ComfyUI is not retried inline
+
+_catalog: Dict[str, Dict] = {}
+_catalog_lock = threading.Lock()
+
+
+def _catalog_ttl() -> float:
+    try:
+        return float(current_app.config.get("OBJECT_INFO_TTL", 300))
+    except Exception:
+        return float(os.getenv("OBJECT_INFO_TTL", "300"))
+
+
+def _refresh_object_info(comfy_addr: str, entry: Dict) -> None:
+    try:
+        info = _fetch_object_info(comfy_addr)
+        with _catalog_lock:
+            entry.update(info=info, fetched_at=time.monotonic(), error=None, failed_at=None)
+    except Exception as e:
+        with _catalog_lock:
+            entry.update(error=e, failed_at=time.monotonic())
+    finally:
+        with _catalog_lock:
+            entry["refreshing"] = False
+        entry["ready"].set()
+
+
+def get_object_info(comfy_addr: str) -> Dict:
+    """Cached ``/object_info`` for ``comfy_addr`` (stale-while-revalidate).
+
+    Raises the last fetch error only when nothing has ever been fetched.
+    """
+    ttl = _catalog_ttl()
+    now = time.monotonic()
+    with _catalog_lock:
+        entry = _catalog.get(comfy_addr)
+        if entry is None:
+            entry = _catalog[comfy_addr] = {
+                "info": None, "fetched_at": None, "error": None, "failed_at": None,
+                "refreshing": False, "ready": threading.Event(),
+            }
+        info = entry["info"]
+        fresh = info is not None and now - entry["fetched_at"] < ttl
+        recently_failed = entry["failed_at"] is not None and now - entry["failed_at"] < _OBJECT_INFO_NEGATIVE_TTL
+        start = not fresh and not entry["refreshing"] and not recently_failed
+        if start:
+            entry["refreshing"] = True
+            entry["ready"].clear()
+
+    if start and info is not None:
+        threading.Thread(
+            target=_refresh_object_info, args=(comfy_addr, entry), name="object-info-refresh", daemon=True
+        ).start()
+    elif start:
+        _refresh_object_info(comfy_addr, entry)
+    elif info is None and entry["refreshing"]:
+        # Another request is doing the first fetch; share its result.
+        entry["ready"].wait(10)
+
+    with _catalog_lock:
+        if entry["info"] is not None:
+            return entry["info"]
+        err = entry["error"]
+    raise err or RuntimeError(f"ComfyUI object_info unavailable: {comfy_addr}")
+
+
+def invalidate_object_info(comfy_addr: Optional[str] = None) -> None:
+    """Drop cached ``/object_info`` for one address (or all) so the next lookup refetches."""
+    with _catalog_lock:
+        if comfy_addr is None:
+            _catalog.clear()
+        else:
+            _catalog.pop(comfy_addr, None)
+
+
 def _extract_choices(obj_info: Dict, node_type: str, field: str) -> List[str]:
     try:
         # ComfyUI returns input metadata where enum-style fields are returned as [choices, extra_dict]
@@ -61,20 +147,20 @@ def pick_available(preferred: Optional[str], choices: List[str]) -> Optional[str
     return choices[0]
 
 
-def patch_workflow_models(wf: Dict, comfy_addr: str) -> Tuple[Dict, Dict[str, Optional[str]]]:
+def select_models(comfy_addr: str, ckpt: Optional[str] = None, vae: Optional[str] = None) -> Dict[str, Optional[str]]:
     """
-    Ensure workflow uses available ckpt/vae names.
-    - Tries to keep config preferred names (CKPT_NAME/VAE_NAME)
+    Pick the ckpt/vae names to run with.
+    - Explicit ``ckpt``/``vae`` (e.g. a form override) win, then session, then config (CKPT_NAME/VAE_NAME)
     - Falls back to first available reported by ComfyUI /object_info
     """
     cfg = current_app.config if current_app else {}
-    preferred_ckpt = None
-    preferred_vae = None
+    preferred_ckpt = ckpt
+    preferred_vae = vae
     # Prefer per-session selections if available
     try:
         if has_request_context():
-            preferred_ckpt = session.get("CKPT_NAME")
-            preferred_vae = session.get("VAE_NAME")
+            preferred_ckpt = preferred_ckpt or session.get("CKPT_NAME")
+            preferred_vae = preferred_vae or session.get("VAE_NAME")
     except Exception:
         pass
     # Fallback to app config
@@ -85,29 +171,39 @@ def patch_workflow_models(wf: Dict, comfy_addr: str) -> Tuple[Dict, Dict[str, Op
 
     choices = {"ckpt": [], "vae": []}
     try:
-        obj_info = _fetch_object_info(comfy_addr)
+        obj_info = get_object_info(comfy_addr)
         choices["ckpt"] = _extract_choices(obj_info, "CheckpointLoaderSimple", "ckpt_name")
         choices["vae"] = _extract_choices(obj_info, "VAELoader", "vae_name")
     except Exception:
         # Swallow; we'll fall back to preferred names if provided
         pass
 
-    selected = {
+    return {
         "ckpt": pick_available(preferred_ckpt, choices["ckpt"]),
         "vae": pick_available(preferred_vae, choices["vae"]),
     }
 
-    # Traverse nodes and patch
+
+def patch_workflow_models(wf: Dict, comfy_addr: str) -> Tuple[Dict, Dict[str, Optional[str]]]:
+    """
+    Ensure workflow uses available ckpt/vae names (see ``select_models``).
+    Registry workflows are patched through their ckpt/vae slots; plain dicts are scanned.
+    """
+    selected = select_models(comfy_addr)
+    spec = {"ckpt": selected["ckpt"], "vae": selected["vae"]}
+    if hasattr(wf, "patch"):
+        wf.patch(spec, optional=spec)
+        return wf, selected
+
     try:
-        for nid, node in wf.items():
+        for nid, node in list(wf.items()):
             if not isinstance(node, dict):
                 continue
             ctype = node.get("class_type")
-            inputs = node.get("inputs", {})
             if ctype == "CheckpointLoaderSimple" and selected["ckpt"]:
-                inputs["ckpt_name"] = selected["ckpt"]
+                node.setdefault("inputs", {})["ckpt_name"] = selected["ckpt"]
             elif ctype == "VAELoader" and selected["vae"]:
-                inputs["vae_name"] = selected["vae"]
+                node.setdefault("inputs", {})["vae_name"] = selected["vae"]
     except Exception:
         pass
 
@@ -135,7 +231,7 @@ def get_model_options(comfy_addr: str) -> Dict[str, Optional[List[str]] | Option
     ckpt_choices: List[str] = []
     vae_choices: List[str] = []
     try:
-        info = _fetch_object_info(comfy_addr)
+        info = get_object_info(comfy_addr)
         ckpt_choices = _extract_choices(info, "CheckpointLoaderSimple", "ckpt_name")
         vae_choices = _extract_choices(info, "VAELoader", "vae_name")
     except Exception:
@@ -192,21 +288,119 @@ def resolve_history_paths(images: List[Dict[str, str]], base_output: str) -> Lis
     return paths
 
 
-def find_new_images_by_scan(output_dir: str, start_time: float) -> List[str]:
-    exts = {".png", ".jpg", ".jpeg", ".webp"}
-    out: List[str] = []
+IMAGE_EXTS = (".png", ".jpg", ".jpeg", ".webp")
+
+
+def output_filename(src_name: str) -> str:
+    """Unique name for a result copied into OUTPUT_DIR (keeps the source extension).
+
+    The timestamp keeps names sortable; the random suffix keeps concurrent jobs
+    finishing in the same second from overwriting each other.
+    """
+    ext = os.path.splitext(src_name or "")[1].lower() or ".png"
+    stamp = time.strftime("%Y%m%d_%H%M%S", time.localtime())
+    return f"{stamp}_{uuid.uuid4().hex[:8]}{ext}"
+
+
+def stage_images(client, images: Dict) -> Dict:
+    """Upload local input images to ComfyUI and return a patch spec for them.
+
+    ``images`` maps patch keys (``image``/``mask``) to a local path or a tuple
+    of paths.  Uploads are content-addressed (see ``ComfyClient.upload_image``);
+    if one fails the local path is kept, which still works when Flask and
+    ComfyUI share a disk.
+    """
+    def _one(path):
+        try:
+            return client.upload_image(path)
+        except Exception as e:
+            if current_app:
+                current_app.logger.warning("Upload of %s to ComfyUI %s failed, using local path: %s", path, client.addr, e)
+            return path
+
+    return {
+        key: tuple(_one(p) for p in value) if isinstance(value, (list, tuple)) else _one(value)
+        for key, value in images.items()
+    }
+
+
+def run_prompt(pool, prompt_obj, output_dir: str, report=None, images: Optional[Dict] = None):
+    """Queue ``prompt_obj`` on ``pool`` and move the resulting image to ``output_dir``.
+
+    Returns ``(filename, None)`` or ``(None, (status, json_payload))``.  ``report``
+    receives progress events for the job subsystem.  ``images`` (patch key ->
+    local path) are uploaded to the chosen node first (see ``stage_images``).
+    """
+    report = report or (lambda *a, **k: None)
+
+    # Real step counts, node names, queue position, ETA and latent previews for the job's SSE stream
+    tracker = ProgressTracker(report, prompt_obj,
+                              preview_size=current_app.config.get("JOB_PREVIEW_SIZE") or 0,
+                              preview_interval=current_app.config.get("JOB_PREVIEW_INTERVAL") or 0.5)
+
+    def _prepare(client):
+        if images:
+            prompt_obj.patch(stage_images(client, images))
+
+    submitted = []
+
+    def _on_submit(prompt_id, node):
+        submitted.append(node.addr)
+        report("submitted", prompt_id=prompt_id, node=node.addr)
+        tracker.watch_queue(node.client, prompt_id)
+        on_cancel = getattr(report, "on_cancel", None)
+        if on_cancel is not None:
+            # Cancelled job: drop the prompt from the host's queue or interrupt it
+            on_cancel(lambda: node.client.cancel(prompt_id))
+
+    addrs = [n.addr for n in pool.nodes]
     try:
-        for root, _dirs, files in os.walk(output_dir):
-            for f in files:
-                if os.path.splitext(f)[1].lower() in exts:
-                    p = os.path.join(root, f)
-                    try:
-                        if os.path.getmtime(p) >= start_time:
-                            out.append(p)
-                    except OSError:
-                        pass
-    except Exception:
-        pass
-    # Sort by mtime desc
-    out.sort(key=lambda p: os.path.getmtime(p), reverse=True)
-    return out
+        # Least busy capable node; resubmits elsewhere if that host drops
+        node, result = pool.run(prompt_obj, listener=tracker.listener, prepare=_prepare, on_submit=_on_submit)
+    except NoNodeAvailable as e:
+        current_app.logger.error("沒有可用的 ComfyUI 節點: %s", e.detail)
+        return None, (503, json.dumps({"error": "沒有可用的 ComfyUI 節點", "detail": e.detail}, ensure_ascii=False))
+    except ComfyError as e:
+        cancelled = getattr(report, "cancelled", None)
+        if cancelled is not None and cancelled.is_set():
+            return None, (409, json.dumps({"error": "工作已取消"}, ensure_ascii=False))
+        if e.status is not None:
+            current_app.logger.error("ComfyUI HTTPError %s %s\n%s", e.status, e.reason, e.body)
+            err = {
+                "code": e.status,
+                "reason": e.reason,
+                "body": e.body,
+                "comfy_addr": submitted[-1] if submitted else addrs,
+            }
+            return None, (502, json.dumps({"error": "ComfyUI 介面回應錯誤", "detail": err}, ensure_ascii=False))
+        current_app.logger.error("ComfyUI 執行失敗: %s", e)
+        return None, (502, json.dumps({"error": "ComfyUI 執行失敗", "detail": e.detail}, ensure_ascii=False, default=str))
+    except Exception as e:
+        if not submitted:
+            current_app.logger.exception("ComfyUI 發送請求時發生例外")
+            err = {"exception": str(e), "traceback": traceback.format_exc(), "comfy_addr": addrs}
+            return None, (502, json.dumps({"error": "ComfyUI 介面異常", "detail": err}, ensure_ascii=False))
+        current_app.logger.exception("WebSocket 等待執行完成時發生例外")
+        err = {"exception": str(e), "traceback": traceback.format_exc(), "last_ws_msg": getattr(e, "last_event", None)}
+        return None, (502, json.dumps({"error": "ComfyUI WebSocket 連線/等待失敗", "detail": err}, ensure_ascii=False, default=str))
+    finally:
+        tracker.stop()
+    client, prompt_id = node.client, result["prompt_id"]
+
+    # Output files reported by ComfyUI for this prompt (executed events / history)
+    files = output_files(result["outputs"], exts=IMAGE_EXTS) or output_files(client.outputs(prompt_id), exts=IMAGE_EXTS)
+    if not files:
+        current_app.logger.error("ComfyUI 未回報 prompt %s 的輸出圖片", prompt_id)
+        err = {"prompt_id": prompt_id, "outputs": result["outputs"]}
+        return None, (500, json.dumps({"error": "沒有產生任何輸出圖片", "detail": err}, ensure_ascii=False, default=str))
+
+    newfn = output_filename(files[0]["filename"])
+    os.makedirs(output_dir, exist_ok=True)
+    dst = os.path.join(output_dir, newfn)
+    try:
+        client.fetch_output(files[0], dst)
+    except Exception as e:
+        current_app.logger.exception("搬移輸出檔失敗")
+        err = {"exception": str(e), "file": files[0], "dst": dst}
+        return None, (500, json.dumps({"error": "搬移輸出檔失敗", "detail": err}, ensure_ascii=False))
+    return newfn, None
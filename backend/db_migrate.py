@@ -1,6 +1,6 @@
 from typing import Iterable
 from flask import current_app
-from sqlalchemy import text
+from sqlalchemy import inspect, text
 
 
 def _table_has_column(conn, table: str, column: str) -> bool:
@@ -46,3 +46,43 @@ def ensure_image_columns(db):
                 conn.execute(text("ALTER TABLE image_results ADD COLUMN request_ip VARCHAR(64) NULL"))
             except Exception as e:
                 current_app.logger.warning("Add column request_ip failed: %s", e)
+        if not _table_has_column(conn, 'image_results', 'variants'):
+            try:
+                conn.execute(text("ALTER TABLE image_results ADD COLUMN variants TEXT NULL"))
+            except Exception as e:
+                current_app.logger.warning("Add column variants failed: %s", e)
+        if not _table_has_column(conn, 'image_results', 'rating_count'):
+            try:
+                conn.execute(text("ALTER TABLE image_results ADD COLUMN rating_count INTEGER DEFAULT 0 NOT NULL"))
+                conn.execute(text("ALTER TABLE image_results ADD COLUMN rating_sum INTEGER DEFAULT 0 NOT NULL"))
+                # Backfill the rollup from existing ratings
+                conn.execute(text(
+                    "UPDATE image_results SET "
+                    "rating_count = (SELECT COUNT(*) FROM image_ratings r WHERE r.image_id = image_results.id), "
+                    "rating_sum = (SELECT COALESCE(SUM(r.rating), 0) FROM image_ratings r WHERE r.image_id = image_results.id)"
+                ))
+            except Exception as e:
+                current_app.logger.warning("Add rating rollup columns failed: %s", e)
+
+
+_BILLING_INDEXES = (
+    ("ix_image_results_user_created", "image_results", "user_id, created_at"),
+    ("ix_image_results_ip_created", "image_results", "request_ip, created_at"),
+    ("ix_image_results_filename", "image_results", "filename"),
+    ("ix_image_results_created_id", "image_results", "created_at, id"),
+    ("ix_image_results_kind_created", "image_results", "kind, created_at, id"),
+    ("ix_credit_transactions_user_created", "credit_transactions", "user_id, created_at"),
+)
+
+
+def ensure_billing_indexes(db):
+    """Create the indexes used by usage/balance, output and gallery lookups on existing databases."""
+    insp = inspect(db.engine)
+    for name, table, columns in _BILLING_INDEXES:
+        try:
+            if any(ix.get("name") == name for ix in insp.get_indexes(table)):
+                continue
+            with db.engine.begin() as conn:
+                conn.execute(text(f"CREATE INDEX {name} ON {table} ({columns})"))
+        except Exception as e:
+            current_app.logger.warning("Create index %s failed: %s", name, e)
@@ -0,0 +1,403 @@
+"""ComfyUI workflow template registry.
+
+Templates (API-format JSON) are parsed and validated once, kept as read-only
+structures, and handed out as cheap per-request ``Workflow`` instances.  An
+instance shares every node with its template until a node is accessed for
+writing; only then is that one node (and its ``inputs``) copied.
+
+Each template also exposes typed parameter *slots* (positive/negative prompt,
+sampler, image/mask loaders, size, ckpt, vae, lora, output) discovered from
+the graph, so callers do not need to hard-code node ids.  A declarative patch
+spec (``{"prompt": ..., "seed": ..., "width": ..., "image": ...}``) is resolved
+against those slots once per template and applied in a single pass.
+"""
+import json
+import logging
+import os
+import threading
+from functools import lru_cache
+from typing import Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+
+logger = logging.getLogger(__name__)
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+WORKFLOWS_DIR = os.path.join(BASE_DIR, "workflows")
+# Sub-folders of workflows/ that are loaded (and validated) at startup
+TEMPLATE_DIRS = ("api", "目前的服務")
+
+# class_type -> (slot kind, input field)
+_SLOT_CLASSES = {
+    "KSampler": ("sampler", None),
+    "KSamplerAdvanced": ("sampler", None),
+    "LoadImage": ("image", "image"),
+    "VHS_LoadImagePath": ("image", "image"),
+    "ZwngLoadImagePathOrURL": ("image", "image_path"),
+    "Image Load": ("image", "image_path"),
+    "EmptyLatentImage": ("size", None),
+    "LatentUpscale": ("size", None),
+    "CheckpointLoaderSimple": ("ckpt", "ckpt_name"),
+    "VAELoader": ("vae", "vae_name"),
+    "LoraLoader": ("lora", "lora_name"),
+    "SaveImage": ("output", "filename_prefix"),
+}
+# Inputs followed upstream from a sampler to find its prompt encoder
+_CONDITIONING_INPUTS = ("conditioning", "conditioning_to", "conditioning_1")
+_MASK_CONSUMERS = ("ImageToMask",)
+# Loaders that take a file name inside ComfyUI's input dir; the other image
+# loaders take a path or URL.
+_INPUT_DIR_LOADERS = ("LoadImage",)
+
+# Patch spec key -> (slot kind, input fields).  Every listed field the slot's
+# node has is written (KSampler has ``seed``, KSamplerAdvanced ``noise_seed``);
+# ``None`` means the slot's own field (image loaders differ per class).
+PATCH_FIELDS = {
+    "prompt": ("prompt", ("text",)),
+    "negative": ("negative", ("text",)),
+    "seed": ("sampler", ("seed", "noise_seed")),
+    "steps": ("sampler", ("steps",)),
+    "cfg": ("sampler", ("cfg",)),
+    "denoise": ("sampler", ("denoise",)),
+    "sampler_name": ("sampler", ("sampler_name",)),
+    "scheduler": ("sampler", ("scheduler",)),
+    "width": ("size", ("width",)),
+    "height": ("size", ("height",)),
+    "image": ("image", None),
+    "mask": ("mask", None),
+    "ckpt": ("ckpt", ("ckpt_name",)),
+    "vae": ("vae", ("vae_name",)),
+    "lora": ("lora", ("lora_name",)),
+    "lora_strength": ("lora", ("strength_model", "strength_clip")),
+}
+
+
+class WorkflowError(ValueError):
+    """A workflow template is malformed or lacks a requested slot."""
+
+
+class Slot(NamedTuple):
+    kind: str
+    node_id: str
+    class_type: str
+    field: Optional[str]
+
+
+class _FrozenDict(dict):
+    """dict that refuses mutation (templates are shared between requests)."""
+
+    def _readonly(self, *args, **kwargs):
+        raise TypeError("workflow templates are read-only; use Workflow instances")
+
+    __setitem__ = __delitem__ = _readonly
+    setdefault = update = pop = popitem = clear = _readonly
+
+    def __deepcopy__(self, memo):
+        return _thaw(self)
+
+
+def _freeze(obj):
+    if isinstance(obj, dict):
+        return _FrozenDict((k, _freeze(v)) for k, v in obj.items())
+    if isinstance(obj, list):
+        return tuple(_freeze(v) for v in obj)
+    return obj
+
+
+def _thaw(obj):
+    if isinstance(obj, dict):
+        return {k: _thaw(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return [_thaw(v) for v in obj]
+    return obj
+
+
+def _is_link(value) -> bool:
+    return isinstance(value, (list, tuple)) and len(value) == 2 and isinstance(value[1], int)
+
+
+def validate(data) -> None:
+    """Raise ``WorkflowError`` unless ``data`` is an API-format ComfyUI prompt."""
+    if not isinstance(data, dict) or not data:
+        raise WorkflowError("workflow must be a non-empty JSON object")
+    if "nodes" in data and "links" in data:
+        raise WorkflowError("UI-format workflow; export it with 'Save (API Format)'")
+    problems = []
+    for nid, node in data.items():
+        if not isinstance(node, dict) or not isinstance(node.get("class_type"), str):
+            problems.append(f"node {nid}: missing class_type")
+            continue
+        inputs = node.get("inputs", {})
+        if not isinstance(inputs, dict):
+            problems.append(f"node {nid}: inputs is not an object")
+            continue
+        for key, value in inputs.items():
+            if _is_link(value) and str(value[0]) not in data:
+                problems.append(f"node {nid}.{key}: links to missing node {value[0]}")
+    if problems:
+        raise WorkflowError("; ".join(problems))
+
+
+class WorkflowTemplate:
+    """A parsed, validated, read-only workflow plus its node indexes."""
+
+    def __init__(self, name: str, data: Dict, path: Optional[str] = None, mtime: Optional[float] = None):
+        validate(data)
+        self.name = name
+        self.path = path
+        self.mtime = mtime
+        self.nodes: Dict = _freeze({str(k): v for k, v in data.items()})
+
+        by_class: Dict[str, List[str]] = {}
+        consumers: Dict[str, List[Tuple[str, str]]] = {}
+        for nid, node in self.nodes.items():
+            by_class.setdefault(node["class_type"], []).append(nid)
+            for key, value in node.get("inputs", {}).items():
+                if _is_link(value):
+                    consumers.setdefault(str(value[0]), []).append((nid, key))
+        self.by_class: Dict[str, Tuple[str, ...]] = {k: tuple(v) for k, v in by_class.items()}
+        self.slots: Dict[str, Tuple[Slot, ...]] = self._find_slots(consumers)
+        self.targets: Dict[str, Tuple[Tuple[str, Tuple[str, ...]], ...]] = self._find_targets()
+
+    @classmethod
+    def from_file(cls, path: str, name: Optional[str] = None) -> "WorkflowTemplate":
+        mtime = os.path.getmtime(path)
+        with open(path, "r", encoding="utf-8") as f:
+            try:
+                data = json.load(f)
+            except ValueError as e:
+                raise WorkflowError(f"{path}: invalid JSON: {e}") from e
+        return cls(name or path, data, path=path, mtime=mtime)
+
+    def _find_slots(self, consumers) -> Dict[str, Tuple[Slot, ...]]:
+        slots: Dict[str, List[Slot]] = {}
+
+        def add(kind, nid, field):
+            slots.setdefault(kind, []).append(Slot(kind, nid, self.nodes[nid]["class_type"], field))
+
+        for nid, node in self.nodes.items():
+            rule = _SLOT_CLASSES.get(node["class_type"])
+            if rule is None:
+                continue
+            kind, field = rule
+            if kind == "image" and any(
+                self.nodes[c]["class_type"] in _MASK_CONSUMERS or key == "mask" for c, key in consumers.get(nid, ())
+            ):
+                kind = "mask"
+            add(kind, nid, field)
+
+        for sampler in slots.get("sampler", ()):
+            inputs = self.nodes[sampler.node_id].get("inputs", {})
+            for polarity, kind in (("positive", "prompt"), ("negative", "negative")):
+                enc = self._trace_encoder(inputs.get(polarity), polarity)
+                if enc and all(s.node_id != enc for s in slots.get(kind, ())):
+                    add(kind, enc, "text")
+        return {k: tuple(v) for k, v in slots.items()}
+
+    def _find_targets(self) -> Dict[str, Tuple[Tuple[str, Tuple[str, ...]], ...]]:
+        """Per patch key, the ``(node_id, fields)`` to write, one entry per slot."""
+        targets = {}
+        for key, (kind, fields) in PATCH_FIELDS.items():
+            found = []
+            for slot in self.slots.get(kind, ()):
+                inputs = self.nodes[slot.node_id].get("inputs", {})
+                names = tuple(f for f in (fields or (slot.field,)) if f in inputs)
+                if names:
+                    found.append((slot.node_id, names))
+            targets[key] = tuple(found)
+        return targets
+
+    def _trace_encoder(self, link, polarity, depth=0) -> Optional[str]:
+        if not _is_link(link) or depth > 8:
+            return None
+        nid = str(link[0])
+        node = self.nodes.get(nid)
+        if node is None:
+            return None
+        if node["class_type"].startswith("CLIPTextEncode") and "text" in node.get("inputs", {}):
+            return nid
+        inputs = node.get("inputs", {})
+        for key in (polarity,) + _CONDITIONING_INPUTS:
+            if key in inputs:
+                return self._trace_encoder(inputs[key], polarity, depth + 1)
+        return None
+
+    def ids(self, class_type: str) -> Tuple[str, ...]:
+        return self.by_class.get(class_type, ())
+
+    def slot(self, kind: str, required: bool = True) -> Tuple[Slot, ...]:
+        found = self.slots.get(kind, ())
+        if required and not found:
+            raise WorkflowError(f"workflow {self.name} has no '{kind}' slot")
+        return found
+
+    def instantiate(self) -> "Workflow":
+        return Workflow(self)
+
+    def check(self, keys: Iterable[str], optional: Iterable[str] = ()) -> None:
+        """Raise ``WorkflowError`` if a patch key has nothing to write to."""
+        optional = set(optional)
+        unknown = [k for k in keys if k not in self.targets]
+        if unknown:
+            raise WorkflowError(f"unknown patch keys: {', '.join(unknown)}")
+        missing = [k for k in keys if not self.targets[k] and k not in optional]
+        if missing:
+            raise WorkflowError(f"workflow {self.name} has no slot for: {', '.join(missing)}")
+
+
+class Workflow(dict):
+    """Per-request workflow sharing unmodified nodes with its template.
+
+    ``wf[nid]`` / ``wf.get(nid)`` return a private, writable copy of that node;
+    nodes never accessed that way stay shared with the template.  Iterating
+    (``items()``, JSON serialisation) yields nodes as they are, so shared ones
+    are read-only -- write through ``wf[nid]`` or ``wf.inputs(nid)``.
+    """
+
+    def __init__(self, template: WorkflowTemplate):
+        super().__init__(template.nodes)
+        self.template = template
+        self._owned = set()
+
+    def __getitem__(self, nid):
+        node = dict.__getitem__(self, nid)
+        if nid not in self._owned:
+            node = dict(node)
+            node["inputs"] = _thaw(node.get("inputs", {}))
+            dict.__setitem__(self, nid, node)
+            self._owned.add(nid)
+        return node
+
+    def __setitem__(self, nid, node):
+        dict.__setitem__(self, nid, node)
+        self._owned.add(nid)
+
+    def get(self, nid, default=None):
+        return self[nid] if nid in self else default
+
+    def inputs(self, nid: str) -> Dict:
+        """Writable ``inputs`` of node ``nid`` (copied from the template on first use)."""
+        return self[str(nid)]["inputs"]
+
+    def ids(self, class_type: str) -> Tuple[str, ...]:
+        return self.template.ids(class_type)
+
+    def slot(self, kind: str, required: bool = True) -> Tuple[Slot, ...]:
+        return self.template.slot(kind, required)
+
+    def patch(self, spec: Dict, optional: Iterable[str] = ()) -> "Workflow":
+        """Apply a patch spec in one pass; ``None`` values are skipped.
+
+        A scalar is written to every slot of its kind, a list/tuple is matched
+        to the slots in template order (e.g. person and garment images).
+        Uploaded images become ``subfolder/name`` for ``LoadImage`` and their
+        /view URL for path-or-URL loaders.  Keys
+        without a slot raise ``WorkflowError`` unless listed in ``optional``;
+        nothing is written in that case.
+        """
+        spec = {k: v for k, v in spec.items() if v is not None}
+        targets = self.template.targets
+        self.template.check(spec, optional)
+        writes = []
+        for key, value in spec.items():
+            slots = targets[key]
+            if isinstance(value, (list, tuple)):
+                if len(value) != len(slots):
+                    raise WorkflowError(
+                        f"workflow {self.template.name}: '{key}' expects {len(slots)} values, got {len(value)}"
+                    )
+                writes.extend(zip(slots, value))
+            else:
+                writes.extend((target, value) for target in slots)
+        for (nid, fields), value in writes:
+            value = _loader_value(value, self.template.nodes[nid]["class_type"])
+            inputs = self.inputs(nid)
+            for field in fields:
+                inputs[field] = value
+        return self
+
+
+def _loader_value(value, class_type: str):
+    """Pick the form of an uploaded image (``comfy_client.UploadedImage``) a loader understands."""
+    if not hasattr(value, "ref"):
+        return value
+    return value.ref if class_type in _INPUT_DIR_LOADERS else value.url
+
+
+class WorkflowRegistry:
+    """Loads templates under ``workflows/`` once and reloads them when the file changes."""
+
+    def __init__(self, base_dir: str = WORKFLOWS_DIR, subdirs: Iterable[str] = TEMPLATE_DIRS):
+        self.base_dir = base_dir
+        self.subdirs = tuple(subdirs)
+        self.errors: Dict[str, str] = {}
+        self._templates: Dict[str, WorkflowTemplate] = {}
+        self._lock = threading.Lock()
+
+    def load_all(self) -> Dict[str, WorkflowTemplate]:
+        for sub in self.subdirs:
+            folder = os.path.join(self.base_dir, sub)
+            if not os.path.isdir(folder):
+                continue
+            for fn in sorted(os.listdir(folder)):
+                if not fn.lower().endswith(".json"):
+                    continue
+                name = f"{sub}/{fn}"
+                try:
+                    self.get(name)
+                except (WorkflowError, OSError) as e:
+                    logger.warning("Skipping workflow template %s: %s", name, e)
+        return dict(self._templates)
+
+    def names(self) -> List[str]:
+        return sorted(self._templates)
+
+    def _resolve(self, name: str) -> Tuple[str, str]:
+        name = name.replace("\\", "/")
+        if os.path.isabs(name):
+            path = name
+            rel = os.path.relpath(path, self.base_dir).replace(os.sep, "/")
+            return (rel if not rel.startswith("..") else path), path
+        if name.startswith("workflows/"):
+            name = name[len("workflows/"):]
+        return name, os.path.join(self.base_dir, *name.split("/"))
+
+    def get(self, name: str) -> WorkflowTemplate:
+        """Template by name (``"api/文生圖工作流api.json"``) or path; hot-reloads on mtime change."""
+        key, path = self._resolve(name)
+        try:
+            mtime = os.path.getmtime(path)
+        except OSError:
+            with self._lock:
+                self._templates.pop(key, None)
+            raise
+        tpl = self._templates.get(key)
+        if tpl is not None and tpl.mtime == mtime:
+            return tpl
+        try:
+            tpl = WorkflowTemplate.from_file(path, name=key)
+        except WorkflowError as e:
+            with self._lock:
+                self.errors[key] = str(e)
+            raise
+        with self._lock:
+            self._templates[key] = tpl
+            self.errors.pop(key, None)
+        logger.info("Loaded workflow template %s", key)
+        return tpl
+
+    def instantiate(self, name: str) -> Workflow:
+        return self.get(name).instantiate()
+
+
+registry = WorkflowRegistry()
+
+
+@lru_cache(maxsize=64)
+def template_from_text(text: str, name: str = "<inline>") -> WorkflowTemplate:
+    """Parse an embedded workflow string once (services keep them as constants)."""
+    return WorkflowTemplate(name, json.loads(text))
+
+
+def instantiate_text(text: str, name: str = "<inline>") -> Workflow:
+    """Drop-in for ``json.loads(template_text)`` returning a structural-sharing copy."""
+    return template_from_text(text, name).instantiate()
@@ -4,14 +4,17 @@ import shutil
 import time
 import uuid
 import base64
-import urllib.request
-import urllib.error
-import websocket
 import qrcode
 
 from io import BytesIO
-from flask import Flask, request, jsonify, send_from_directory
+from flask import Flask, request, jsonify
 from flask_cors import CORS
+import sys
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from backend.workflows import instantiate_text
+from comfy_client import output_files
+from comfy_pool import get_pool  # 共用 ComfyUI 連線；設定 COMFY_NODES 時分派到佇列最短的節點
+from file_delivery import send_output  # 依 OUTPUT_DELIVERY 交給 nginx/Apache 或由 Flask 串流（支援 Range）
 
 app = Flask(__name__)
 CORS(app)
@@ -22,9 +25,8 @@ CORS(app)
 
 # ComfyUI 伺服器位址（請確認此位址與埠號正確）
 SERVER_ADDRESS = "127.0.0.1:8188"
+comfy = get_pool(os.getenv("COMFY_NODES") or SERVER_ADDRESS)
 
-# 定義全域 CLIENT_ID，用於識別本服務發送的請求（生成一次即可）
-CLIENT_ID = str(uuid.uuid4())
 
 # ComfyUI 的輸出目錄（儲存生成圖片的目錄）
 COMFYUI_OUTPUT_DIR = r"D:\comfyui\ComfyUI_windows_portable\ComfyUI\output"
@@ -65,62 +67,30 @@ def generate_qr_code(url, output_file):
 # B. 與 ComfyUI 互動的相關函式
 # =============================
 def queue_prompt(prompt):
-    payload = {"prompt": prompt, "client_id": CLIENT_ID}
-    data = json.dumps(payload).encode("utf-8")
-    url = f"http://{SERVER_ADDRESS}/prompt"
     try:
-        req = urllib.request.Request(url, data=data, headers={"Content-Type": "application/json"})
-        with urllib.request.urlopen(req) as resp:
-            result = json.loads(resp.read())
-            result["client_id"] = CLIENT_ID
-            return result
+        prompt_id = comfy.queue_prompt(prompt)
+        return {"prompt_id": prompt_id, "client_id": comfy.client_id}
     except Exception as e:
         print(f"❌ 無法連線至 ComfyUI API: {e}")
         return None
 
-def wait_for_completion(prompt_id):
-    ws_url = f"ws://{SERVER_ADDRESS}/ws?clientId={CLIENT_ID}"
+def wait_for_completion(prompt_id, client_id=None):
     print("🕐 等待 ComfyUI 任務完成...")
     try:
-        ws = websocket.create_connection(ws_url)
-        while True:
-            out = ws.recv()
-            if isinstance(out, str):
-                message = json.loads(out)
-                if message.get("type") == "executing":
-                    data = message.get("data", {})
-                    if data.get("node") is None and data.get("prompt_id") == prompt_id:
-                        print("✅ 任務已完成！")
-                        break
-        ws.close()
+        comfy.wait(prompt_id)
+        print("✅ 任務已完成！")
     except Exception as e:
         print(f"❌ WebSocket 連線錯誤: {e}")
 
 def get_history(prompt_id):
-    url = f"http://{SERVER_ADDRESS}/history/{prompt_id}"
-    try:
-        with urllib.request.urlopen(url) as resp:
-            history_data = json.loads(resp.read())
-        print(f"📜 Debug: history API 回應 = {json.dumps(history_data, indent=4, ensure_ascii=False)}")
-        return history_data.get(prompt_id, {})
-    except Exception as e:
-        print(f"❌ 無法取得歷史紀錄: {e}")
-        return {}
-
-def find_latest_png():
-    png_files = [f for f in os.listdir(COMFYUI_OUTPUT_DIR) if f.lower().endswith(".png")]
-    if not png_files:
-        print("🚫 找不到任何 .png 檔案！")
-        return None
-    latest_png = max(png_files, key=lambda f: os.path.getctime(os.path.join(COMFYUI_OUTPUT_DIR, f)))
-    print(f"🎞 找到最新的 .png 檔案: {latest_png}")
-    return latest_png
+    outputs = comfy.outputs(prompt_id)  # 取自 executed 事件，必要時才查 /history
+    return {"outputs": outputs} if outputs else {}
 
 def get_final_image_filename(prompt_id):
     history = get_history(prompt_id)
     if not history:
-        print("⚠️ /history API 回應為空，改用檔案搜尋。")
-        return find_latest_png()
+        print("⚠️ /history API 回應為空。")
+        return None
     outputs = history.get("outputs", {})
     image_node = outputs.get("31", {})
     if "images" in image_node:
@@ -129,8 +99,9 @@ def get_final_image_filename(prompt_id):
             if filename and filename.lower().endswith(".png"):
                 print(f"🎞 從 API 取得圖片檔名: {filename}")
                 return filename
-    print("⚠️ /history API 未提供圖片檔名，改用檔案搜尋。")
-    return find_latest_png()
+    print("⚠️ /history API 未提供圖片檔名，改用其他輸出節點。")
+    files = output_files(comfy.outputs(prompt_id), exts=(".png",))
+    return files[0]["filename"] if files else None
 
 def move_output_files(prompt_id):
     image_filename = get_final_image_filename(prompt_id)
@@ -228,7 +199,7 @@ def convert_image_endpoint():
     print("====================")
 
     # 4. 載入既有 workflow 模板
-    workflow = json.loads(r"""
+    workflow = instantiate_text(r"""
 {
   "2": {
     "inputs": {
@@ -382,7 +353,7 @@ def convert_image_endpoint():
 
 @app.route("/get_image/<filename>", methods=["GET"])
 def get_image(filename):
-    return send_from_directory(TARGET_DIR, filename)
+    return send_output(TARGET_DIR, filename, cache="revalidate")
 
 # 新增 /image_to_image 路由，供 ComfyUI 在工作流程中讀取圖片檔案
 @app.route("/image_to_image", methods=["POST"])
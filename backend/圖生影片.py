@@ -3,15 +3,22 @@ import os
 import shutil
 import time
 import uuid
-import urllib.request
-import urllib.error
-import websocket  # 請確保 pip install websocket-client
-from flask import Flask, request, jsonify, send_from_directory, Response
+from flask import Flask, request, jsonify, Response
 from flask_cors import CORS
 from werkzeug.middleware.proxy_fix import ProxyFix
 from werkzeug.utils import secure_filename
 import threading
 from collections import OrderedDict
+import sys
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from backend.workflows import instantiate_text
+from comfy_client import output_files
+from comfy_pool import get_pool  # 共用 ComfyUI 連線；設定 COMFY_NODES 時分派到佇列最短的節點
+from file_delivery import send_output  # 依 OUTPUT_DELIVERY 交給 nginx/Apache 或由 Flask 串流（支援 Range）
+from comfy_progress import EventQueue, progress_messages  # ComfyUI 實際步數/節點/排隊位置 → SSE
+from backend.comfy import stage_images  # 輸入圖依內容雜湊上傳到實際執行的節點
+from video_tools import SegmentedRender, crossfade, faststart, plan_segments, poster, poster_path, segment_overlap  # 長影片分段平行生成後以交叉淡化接合
+from werkzeug.exceptions import NotFound
 
 app = Flask(__name__)
 CORS(
@@ -27,7 +34,7 @@ app.wsgi_app = ProxyFix(app.wsgi_app, x_for=1, x_proto=1, x_host=1, x_port=1)
 # ComfyUI 伺服器位址（本機）
 # ------------------------------------------------------
 server_address = "127.0.0.1:8188"
-client_id = str(uuid.uuid4())
+comfy = get_pool(os.getenv("COMFY_NODES") or server_address)
 
 # ------------------------------------------------------
 # 資料夾設定
@@ -35,77 +42,54 @@ client_id = str(uuid.uuid4())
 comfyui_output_dir = r"D:\comfyui\ComfyUI_windows_portable\ComfyUI\output"
 target_dir = r"D:\sd1.5_animediff_img2video_dataset"
 os.makedirs(target_dir, exist_ok=True)
+VIDEO_BASE_URL = "https://imagevideo.picturesmagician.com/get_video"
+
+# 超過 VIDEO_SEGMENT_FRAMES 幀的影片切成互相重疊 VIDEO_SEGMENT_OVERLAP 幀的多段，
+# 同時送到各 ComfyUI 節點生成（0 = 不分段，預設）。各段是獨立生成、不以前一段結尾為條件，
+# 接縫處只是交叉淡化兩段不相關的畫面；長片的連貫性仍由工作流程的 AnimateDiff context 視窗負責
+VIDEO_SEGMENT_FRAMES = int(os.getenv("VIDEO_SEGMENT_FRAMES", "0"))
+VIDEO_SEGMENT_OVERLAP = int(os.getenv("VIDEO_SEGMENT_OVERLAP", "8"))
+# 分段生成時先送出的第一段，在完整影片交付後再保留這麼多秒（讓正在播放的用戶端播完）
+VIDEO_PART_GRACE = float(os.getenv("VIDEO_PART_GRACE", "600"))
 
 # ------------------------------------------------------
 # 輔助函式
 # ------------------------------------------------------
-def queue_prompt(prompt):
+def queue_prompt(prompt, tracker=None):
     """
-    發送 ComfyUI API 請求 (/prompt)，回傳 JSON 結果
+    發送 ComfyUI API 請求 (/prompt)，回傳 JSON 結果；帶 tracker 時轉送進度事件並追蹤排隊位置
     """
-    p = {"prompt": prompt, "client_id": client_id}
-    data = json.dumps(p).encode("utf-8")
-    req = urllib.request.Request(f"http://{server_address}/prompt", data=data,
-                                 headers={"Content-Type": "application/json"})
-    with urllib.request.urlopen(req) as resp:
-        return json.loads(resp.read())
-
-def wait_for_completion(prompt_id):
+    prompt_id = comfy.queue_prompt(prompt, listener=tracker.listener if tracker else None)
+    if tracker:
+        tracker.watch_queue(comfy.client_for(prompt_id), prompt_id)
+    return {"prompt_id": prompt_id, "client_id": comfy.client_id}
+
+def wait_for_completion(prompt_id, client_id=None):
     """
     透過 WebSocket 監聽 ComfyUI 任務進度，直到完成
     """
-    ws_url = f"ws://{server_address}/ws?clientId={client_id}"
-    print("等待 ComfyUI 任務完成...")
+    print("🕐 等待 ComfyUI 任務完成...")
     try:
-        ws = websocket.create_connection(ws_url)
-        while True:
-            out = ws.recv()
-            if isinstance(out, str):
-                msg = json.loads(out)
-                if msg.get("type") == "executing":
-                    data = msg.get("data", {})
-                    # 當 node 為 None，且 prompt_id 相符，表示任務完成
-                    if data.get("node") is None and data.get("prompt_id") == prompt_id:
-                        print("任務已完成！")
-                        break
-        ws.close()
+        comfy.wait(prompt_id)
+        print("✅ 任務已完成！")
     except Exception as e:
-        print(f"WebSocket 連線錯誤: {e}")
+        print(f"❌ WebSocket 連線錯誤: {e}")
 
 def get_history(prompt_id):
     """
     從 ComfyUI /history/{prompt_id} 取得輸出紀錄
     """
-    url = f"http://{server_address}/history/{prompt_id}"
-    try:
-        with urllib.request.urlopen(url) as resp:
-            history_data = json.loads(resp.read())
-        print("[Debug] history API 回應:", json.dumps(history_data, indent=4))
-        return history_data.get(prompt_id, {})
-    except Exception as e:
-        print("無法取得歷史紀錄:", e)
-        return {}
-
-def find_latest_mp4():
-    """
-    在 comfyui_output_dir 中尋找最新的 MP4 檔案
-    """
-    mp4_files = [f for f in os.listdir(comfyui_output_dir) if f.endswith(".mp4")]
-    if not mp4_files:
-        print("找不到 MP4 檔案！")
-        return None
-    latest_mp4 = max(mp4_files, key=lambda f: os.path.getctime(os.path.join(comfyui_output_dir, f)))
-    print("找到最新 MP4:", latest_mp4)
-    return latest_mp4
+    outputs = comfy.outputs(prompt_id)  # 取自 executed 事件，必要時才查 /history
+    return {"outputs": outputs} if outputs else {}
 
 def get_final_video_filename(prompt_id):
     """
-    解析 /history 或 fallback 到檔案搜尋，找出最終生成的 MP4 檔名
+    解析 executed 事件 / history 的輸出紀錄，找出最終生成的 MP4 檔名
     """
     history = get_history(prompt_id)
     if not history:
-        print("history API 回應為空，改用檔案搜尋。")
-        return find_latest_mp4()
+        print("history API 回應為空。")
+        return None
 
     # 依照工作流程中 "video combine" 節點 ID 做調整，這裡假設是 "261"
     node_261 = history.get("outputs", {}).get("261", {})
@@ -116,8 +100,9 @@ def get_final_video_filename(prompt_id):
                 print("API 回傳 MP4 檔案:", filename)
                 return filename
 
-    print("API 未找到 MP4，改用檔案搜尋。")
-    return find_latest_mp4()
+    print("API 未找到 MP4，改用其他輸出節點。")
+    files = output_files(comfy.outputs(prompt_id), exts=(".mp4",))
+    return files[0]["filename"] if files else None
 
 def move_output_files(prompt_id):
     """
@@ -611,78 +596,120 @@ def generate_img2video():
     print("上傳圖片儲存於:", file_path)
 
     result = {}
+    events = EventQueue()
+    cancelled = threading.Event()  # 用戶端斷線時設定
+
+    total_frames = duration * 16
+    segments = plan_segments(total_frames, VIDEO_SEGMENT_FRAMES, VIDEO_SEGMENT_OVERLAP)
+    stem = f"img2vid_{uuid.uuid4().hex[:16]}"
+
+    def build(seg):
+        """單一段落的工作流程：該段幀數，種子依段落遞增（同一張圖不會生成相同片段）"""
+        workflow = instantiate_text(prompt_text)
+        if "61" in workflow and "text" in workflow["61"]["inputs"]:
+            workflow["61"]["inputs"]["text"] = text
+        # 假設 "183" 是控制 multiply_by (這裡依照你的實際 workflow 做修改)
+        if "183" in workflow and "multiply_by" in workflow["183"]["inputs"]:
+            workflow["183"]["inputs"]["multiply_by"] = seg.frames
+        if "261" in workflow and "frame_rate" in workflow["261"]["inputs"]:
+            workflow["261"]["inputs"]["frame_rate"] = frame_rate
+        # 假設 "277" 是 KSampler seed (依你的 workflow ID 修正)
+        if "277" in workflow and "seed" in workflow["277"]["inputs"]:
+            workflow["277"]["inputs"]["seed"] = seed + seg.index
+        return workflow
+
+    def prepare(workflow, client):
+        workflow.patch(stage_images(client, {"image": file_path}))
+
+    final_path = os.path.join(target_dir, f"{stem}.mp4")
+    poster_file = poster_path(final_path)
+
+    def on_segment(seg, path):
+        # 第一段完成即可先播放，其餘段落仍在其他節點生成；接合後的影片以第一段開頭，封面圖可先產生
+        extra = {}
+        if seg.index == 0:
+            try:
+                poster(path, poster_file)
+                extra["poster"] = f"{VIDEO_BASE_URL}/{os.path.basename(poster_file)}?t={int(time.time())}"
+            except Exception as e:
+                print("封面圖產生失敗：", e)
+        events("segment", index=seg.index, segments=len(segments),
+               url=f"{VIDEO_BASE_URL}/{os.path.basename(path)}?t={int(time.time())}", **extra)
+
+    render = SegmentedRender(comfy, segments, build, target_dir, stem, prepare=prepare, emit=events,
+                             on_segment=on_segment if len(segments) > 1 else None)
+    print(f"影片共 {total_frames} 幀，分成 {len(segments)} 段：", segments)
 
     def call_comfyui():
         """
-        生成核心邏輯：更新 workflow → queue_prompt → wait_for_completion → 搬移 → 回傳結果
+        生成核心邏輯：各段落平行生成 → 交叉淡化接合 → 回傳結果
         """
+        parts = []
         try:
-            # 1) 載入基礎工作流程
-            workflow = json.loads(prompt_text)
-
-            # 2) 更新工作流程
-            if "61" in workflow and "text" in workflow["61"]["inputs"]:
-                workflow["61"]["inputs"]["text"] = text
-            # 假設 "183" 是控制 multiply_by (這裡依照你的實際 workflow 做修改)
-            if "183" in workflow and "multiply_by" in workflow["183"]["inputs"]:
-                workflow["183"]["inputs"]["multiply_by"] = duration * 16
-            if "261" in workflow and "frame_rate" in workflow["261"]["inputs"]:
-                workflow["261"]["inputs"]["frame_rate"] = frame_rate
-            # 假設 "277" 是 KSampler seed (依你的 workflow ID 修正)
-            if "277" in workflow and "seed" in workflow["277"]["inputs"]:
-                workflow["277"]["inputs"]["seed"] = seed
-
-            print("最終 workflow =", json.dumps(workflow, indent=2, ensure_ascii=False))
-
-            # 3) 呼叫 ComfyUI
-            resp_json = queue_prompt(workflow)
-            if not resp_json or "prompt_id" not in resp_json:
-                print("ComfyUI API 回應錯誤")
-                result["error"] = "ComfyUI API 回應錯誤"
+            parts = render.run()
+            if cancelled.is_set():
+                result["error"] = "已取消"
                 return
-            prompt_id = resp_json["prompt_id"]
-            print("取得 prompt_id:", prompt_id)
-
-            # 4) 等待完成
-            wait_for_completion(prompt_id)
-            time.sleep(2)  # 給系統一點時間寫檔案
-
-            # 5) 搬移 MP4 檔案
-            mp4_filename = move_output_files(prompt_id)
-            if not mp4_filename:
-                result["error"] = "搬移影片失敗"
+            mp4_filename = os.path.basename(final_path)
+            if len(parts) == 1:
+                os.replace(parts[0], final_path)  # 已在 SegmentedRender 中轉為 faststart
             else:
-                # 回傳對外影片 URL
-                video_url = f"https://imagevideo.picturesmagician.com/get_video/{mp4_filename}?t={int(time.time())}"
-                print("影片生成成功，URL =", video_url)
-                result["video_url"] = video_url
+                crossfade(parts, [seg.frames for seg in segments], final_path, frame_rate, segment_overlap(segments))
+            faststart(final_path)
+            # 封面圖（供 <video poster>）；失敗不影響影片本身
+            try:
+                if not os.path.exists(poster_file):
+                    poster(final_path, poster_file)
+                result["poster_url"] = f"{VIDEO_BASE_URL}/{os.path.basename(poster_file)}?t={int(time.time())}"
+            except Exception as e:
+                print("封面圖產生失敗：", e)
+            # 回傳對外影片 URL
+            video_url = f"{VIDEO_BASE_URL}/{mp4_filename}?t={int(time.time())}"
+            print("影片生成成功，URL =", video_url)
+            result["video_url"] = video_url
 
         except Exception as e:
             print("例外錯誤：", e)
-            result["error"] = str(e)
+            result["error"] = "已取消" if cancelled.is_set() else str(e)
         finally:
-            # 刪除暫存檔
-            try:
-                os.remove(file_path)
-            except Exception as e2:
-                print("刪除暫存檔失敗：", e2)
+            events.close()
+            # 刪除暫存檔與段落檔；成功時第一段可能正被播放，寬限一段時間後再刪
+            leftovers = [file_path]
+            if "video_url" in result and len(parts) > 1:
+                leftovers += parts[1:]
+                timer = threading.Timer(VIDEO_PART_GRACE, remove_files, [parts[:1]])
+                timer.daemon = True
+                timer.start()
+            else:
+                # 單段成功時已改名為最終影片；失敗時全部段落連同封面圖一併刪除
+                leftovers += [p for p in parts if os.path.exists(p)]
+                if "video_url" not in result and os.path.exists(poster_file):
+                    leftovers.append(poster_file)
+            remove_files(leftovers)
 
     # 啟動後台執行緒
     thread = threading.Thread(target=call_comfyui)
     thread.start()
 
-    # 以 SSE 回傳生成進度
+    # 以 SSE 回傳 ComfyUI 的實際進度：排隊位置、執行中節點、步數與預估剩餘秒數 (eta)
     def sse_stream():
-        progress = 0
-        while thread.is_alive():
-            msg = {"progress": progress, "message": "影片生成中..."}
-            yield f"data: {json.dumps(msg)}\n\n"
-            time.sleep(5)
-            progress = min(progress + 10, 90)
+        try:
+            yield f"data: {json.dumps({'progress': 0, 'message': '影片生成中...'}, ensure_ascii=False)}\n\n"
+            for msg in progress_messages(events, "影片生成中..."):
+                # 閒置時送註解行保持連線（也藉此偵測用戶端是否已斷線）
+                yield ": keep-alive\n\n" if msg is None else f"data: {json.dumps(msg, ensure_ascii=False)}\n\n"
+        finally:
+            if "video_url" not in result and "error" not in result:
+                # 還沒有結果就離開串流＝用戶端已斷線（events.close() 後執行緒仍可能存活，不能用 is_alive 判斷）：
+                # 將各段工作移出 ComfyUI 佇列或中斷執行，讓等待中的執行緒結束
+                cancelled.set()
+                render.cancel()
 
         thread.join()
         if "video_url" in result:
             ok = {"progress": 100, "video_url": result["video_url"], "message": "影片生成完成！"}
+            if "poster_url" in result:
+                ok["poster_url"] = result["poster_url"]
             yield f"data: {json.dumps(ok)}\n\n"
         else:
             err = result.get("error", "未知錯誤")
@@ -698,6 +725,15 @@ def generate_img2video():
     }
     return Response(sse_stream(), headers=headers, mimetype="text/event-stream")
 
+def remove_files(paths):
+    """刪除檔案；失敗只記錄，不影響回應"""
+    for path in paths:
+        try:
+            os.remove(path)
+        except Exception as e:
+            print("刪除暫存檔失敗：", e)
+
+
 # ------------------------------------------------------
 # 取回影片檔案
 # ------------------------------------------------------
@@ -706,10 +742,10 @@ def get_video(filename):
     """
     提供最終影片檔下載/播放
     """
-    file_path = os.path.join(target_dir, filename)
-    if not os.path.exists(file_path):
+    try:
+        return send_output(target_dir, filename, cache="revalidate")
+    except NotFound:
         return jsonify({"error": "檔案不存在"}), 404
-    return send_from_directory(target_dir, filename)
 
 if __name__ == "__main__":
     # 後端 Flask 監聽 0.0.0.0:5000
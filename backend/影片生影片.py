@@ -1,7 +1,6 @@
 import json
 import os
 import shutil
-import websocket  # 確保安裝 `websocket-client` 模組
 import urllib.request
 import urllib.error
 import urllib.parse
@@ -11,15 +10,22 @@ import time
 import requests
 import threading
 
-from flask import Flask, request, jsonify, Response, send_from_directory
+from flask import Flask, request, jsonify, Response
 from flask_cors import CORS
 from werkzeug.middleware.proxy_fix import ProxyFix
 from werkzeug.utils import secure_filename
+import sys
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from comfy_client import output_files
+from comfy_pool import get_pool  # 共用 ComfyUI 連線；設定 COMFY_NODES 時分派到佇列最短的節點
+from file_delivery import send_output  # 依 OUTPUT_DELIVERY 交給 nginx/Apache 或由 Flask 串流（支援 Range）
+from comfy_progress import EventQueue, ProgressTracker, progress_messages  # ComfyUI 實際步數/節點/排隊位置 → SSE
+from werkzeug.exceptions import NotFound
 
 # ----------------------------------------------------------------------------
 # ComfyUI 伺服器位址與目標資料夾設定
 server_address = "127.0.0.1:8188"
-client_id = str(uuid.uuid4())  # 產生唯一 client ID
+comfy = get_pool(os.getenv("COMFY_NODES") or server_address)
 
 # ComfyUI 輸出與目標資料夾（請確保這些資料夾存在）
 comfyui_output_dir = "D:/comfyui/ComfyUI_windows_portable/ComfyUI/output/"
@@ -44,46 +50,24 @@ VIDEO_BASE_URL = "https://vid2vid.picturesmagician.com"
 # 以下為原始腳本中的函式定義
 # ----------------------------------------------------------------------------
 
-def queue_prompt(prompt):
-    """發送請求到 ComfyUI API"""
-    p = {
-        "prompt": prompt,
-        "client_id": client_id,
-        "disable_cached_nodes": True  # 強制禁用快取
-    }
-    data = json.dumps(p).encode("utf-8")
-    req = urllib.request.Request(
-        f"http://{server_address}/prompt",
-        data=data,
-        headers={'Content-Type': 'application/json'}
-    )
+def queue_prompt(prompt, tracker=None):
+    """發送請求到 ComfyUI API；帶 tracker 時轉送進度事件並追蹤排隊位置"""
     try:
-        with urllib.request.urlopen(req) as response:
-            return json.loads(response.read())
-    except urllib.error.HTTPError as e:
-        print(f"❌ HTTP 錯誤: {e.code} {e.reason}")
-        return None
-    except urllib.error.URLError as e:
-        print(f"❌ URL 錯誤: {e.reason}")
+        prompt_id = comfy.queue_prompt(prompt, listener=tracker.listener if tracker else None,
+                                       extra={"disable_cached_nodes": True})  # 強制禁用快取
+        if tracker:
+            tracker.watch_queue(comfy.client_for(prompt_id), prompt_id)
+        return {"prompt_id": prompt_id, "client_id": comfy.client_id}
+    except Exception as e:
+        print(f"❌ 無法連線至 ComfyUI API: {e}")
         return None
 
-def wait_for_completion(prompt_id):
+def wait_for_completion(prompt_id, client_id=None):
     """透過 WebSocket 監聽 ComfyUI，直到任務完成"""
-    ws_url = f"ws://{server_address}/ws?clientId={client_id}"
+    print("🕐 等待 ComfyUI 任務完成...")
     try:
-        ws = websocket.create_connection(ws_url)
-        print("🕐 等待 ComfyUI 任務完成...")
-        while True:
-            out = ws.recv()
-            if isinstance(out, str):
-                message = json.loads(out)
-                if message.get("type") == "executing":
-                    data = message.get("data", {})
-                    # 當 node=None 且 prompt_id 對應時代表流程已結束
-                    if data.get("node") is None and data.get("prompt_id") == prompt_id:
-                        print("✅ 任務已完成！")
-                        break
-        ws.close()
+        comfy.wait(prompt_id)
+        print("✅ 任務已完成！")
     except Exception as e:
         print(f"❌ WebSocket 連線錯誤: {e}")
 
@@ -101,38 +85,15 @@ def get_history_all():
 
 def get_history(prompt_id):
     """從 /history/{prompt_id} 取得特定任務的詳細歷史"""
-    url = f"http://{server_address}/history/{prompt_id}"
-    try:
-        with urllib.request.urlopen(url) as response:
-            history_data = json.loads(response.read())
-        print(f"📜 Debug: history API 回應 = {json.dumps(history_data, indent=4, ensure_ascii=False)}")
-        return history_data.get(prompt_id, {})
-    except urllib.error.HTTPError as e:
-        print(f"❌ HTTP 錯誤: {e.code} {e.reason}")
-        return {}
-    except urllib.error.URLError as e:
-        print(f"❌ URL 錯誤: {e.reason}")
-        return {}
-    except Exception as e:
-        print(f"❌ 其他錯誤: {e}")
-        return {}
-
-def find_latest_mp4():
-    """從 ComfyUI 輸出資料夾尋找最新的 MP4 檔案"""
-    mp4_files = [f for f in os.listdir(comfyui_output_dir) if f.endswith(".mp4")]
-    if not mp4_files:
-        print("🚫 找不到 MP4 檔案！")
-        return None
-    latest_mp4 = max(mp4_files, key=lambda f: os.path.getctime(os.path.join(comfyui_output_dir, f)))
-    print(f"🎬 找到最新 MP4: {latest_mp4}")
-    return latest_mp4
+    outputs = comfy.outputs(prompt_id)  # 取自 executed 事件，必要時才查 /history
+    return {"outputs": outputs} if outputs else {}
 
 def get_final_video_filename(prompt_id):
-    """取得 VHS_VideoCombine 產出的 MP4 檔案名稱（先查 /history，再用檔案搜尋）"""
+    """取得 VHS_VideoCombine 產出的 MP4 檔案名稱（取自 executed 事件 / history 的輸出紀錄）"""
     history = get_history(prompt_id)
     if not history:
-        print("⚠️ API 沒回傳任何資訊，改用檔案搜尋。")
-        return find_latest_mp4()
+        print("⚠️ API 沒回傳任何資訊。")
+        return None
     video_node = history.get("outputs", {}).get("102", {})
     if "videos" in video_node:
         for vid in video_node["videos"]:
@@ -149,14 +110,15 @@ def get_final_video_filename(prompt_id):
             filename = g.get("filename", "")
             if filename.endswith(".mp4"):
                 return filename
-    print("⚠️ API 沒找到 MP4，改用檔案搜尋。")
-    return find_latest_mp4()
+    print("⚠️ API 沒找到 MP4，改用其他輸出節點。")
+    files = output_files(comfy.outputs(prompt_id), exts=(".mp4",))
+    return files[0]["filename"] if files else None
 
 def move_output_files(prompt_id):
     """搬移 get_final_video_filename() 找到的 MP4 檔案"""
     mp4_filename = get_final_video_filename(prompt_id)
     if not mp4_filename:
-        print("🚫 無法從 API 或檔案搜尋獲取 MP4 檔案名稱！")
+        print("🚫 無法從 API 獲取 MP4 檔案名稱！")
         return None
     source_path = os.path.join(comfyui_output_dir, mp4_filename)
     target_path = os.path.join(target_dir, mp4_filename)
@@ -455,17 +417,26 @@ def generate_video2video():
     prompt["109"]["inputs"]["video"] = file_path
 
     result = {}
+    events = EventQueue()
+    cancelled = threading.Event()  # 用戶端斷線時設定
 
     def call_comfyui():
+        tracker = ProgressTracker(events, prompt)
         try:
-            response = queue_prompt(prompt)
+            response = queue_prompt(prompt, tracker)
             if response is None or "prompt_id" not in response:
                 result["error"] = "API 回應錯誤，請檢查 ComfyUI 設定"
                 return
             prompt_id = response["prompt_id"]
+            result["prompt_id"] = prompt_id
             print(f"🆔 獲取 prompt_id: {prompt_id}")
+            if cancelled.is_set():
+                comfy.cancel(prompt_id)
 
-            wait_for_completion(prompt_id)
+            wait_for_completion(prompt_id)  # 取消時會立即返回
+            if cancelled.is_set():
+                result["error"] = "已取消"
+                return
             time.sleep(2)
             move_output_files(prompt_id)
             final_video_url = f"{VIDEO_BASE_URL}/get_video/{get_final_video_filename(prompt_id)}?t={int(time.time())}"
@@ -473,17 +444,27 @@ def generate_video2video():
             result["video_url"] = final_video_url
         except Exception as e:
             result["error"] = str(e)
-    
+        finally:
+            tracker.stop()
+            events.close()
+
     thread = threading.Thread(target=call_comfyui)
     thread.start()
 
+    # 以 SSE 回傳 ComfyUI 的實際進度：排隊位置、執行中節點、步數與預估剩餘秒數 (eta)
     def sse_stream():
-        progress = 0
-        while thread.is_alive():
-            msg = {"progress": progress, "message": "影片生成中..."}
-            yield f"data: {json.dumps(msg)}\n\n"
-            time.sleep(5)
-            progress = min(progress + 10, 90)
+        try:
+            yield f"data: {json.dumps({'progress': 0, 'message': '影片生成中...'}, ensure_ascii=False)}\n\n"
+            for msg in progress_messages(events, "影片生成中..."):
+                # 閒置時送註解行保持連線（也藉此偵測用戶端是否已斷線）
+                yield ": keep-alive\n\n" if msg is None else f"data: {json.dumps(msg, ensure_ascii=False)}\n\n"
+        finally:
+            if "video_url" not in result and "error" not in result:
+                # 還沒有結果就離開串流＝用戶端已斷線（events.close() 後執行緒仍可能存活，不能用 is_alive 判斷）：
+                # 將工作移出 ComfyUI 佇列或中斷執行，讓等待中的執行緒結束
+                cancelled.set()
+                if result.get("prompt_id"):
+                    comfy.cancel(result["prompt_id"])
         thread.join()
         if "video_url" in result:
             final_msg = {"progress": 100, "video_url": result["video_url"], "message": "影片生成完成！"}
@@ -508,15 +489,10 @@ def generate_video2video():
 @app.route("/get_video/<path:filename>", methods=["GET"])
 def get_video(filename):
     upload_dir = os.path.join(os.getcwd(), "uploaded_videos")
-    file_path1 = os.path.join(upload_dir, filename)
-    file_path2 = os.path.join(target_dir, filename)
-    print("檢查檔案路徑：", file_path1, "或", file_path2)
-    if os.path.exists(file_path1):
-        response = send_from_directory(upload_dir, filename)
-    elif os.path.exists(file_path2):
-        response = send_from_directory(target_dir, filename)
-    else:
-        return jsonify({"error": "檔案不存在", "paths": [file_path1, file_path2]}), 404
+    try:
+        response = send_output((upload_dir, target_dir), filename, cache="revalidate")
+    except NotFound:
+        return jsonify({"error": "檔案不存在", "paths": [os.path.join(upload_dir, filename), os.path.join(target_dir, filename)]}), 404
     response.headers["Cross-Origin-Resource-Policy"] = "cross-origin"
     response.headers["Access-Control-Allow-Origin"] = "*"
     return response
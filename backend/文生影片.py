@@ -1,13 +1,18 @@
-import json
 import os
 import shutil
 import time
 import uuid
-import urllib.request
-import websocket  # 請先安裝 websocket-client
-from flask import Flask, request, jsonify, send_from_directory
+from flask import Flask, request, jsonify
 from flask_cors import CORS
 from werkzeug.middleware.proxy_fix import ProxyFix
+import sys
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from backend.workflows import instantiate_text
+from comfy_client import output_files
+from comfy_pool import get_pool  # 共用 ComfyUI 連線；設定 COMFY_NODES 時分派到佇列最短的節點
+from file_delivery import send_output  # 依 OUTPUT_DELIVERY 交給 nginx/Apache 或由 Flask 串流（支援 Range）
+from video_tools import SegmentedRender, crossfade, faststart, plan_segments, poster, segment_overlap  # 長影片分段平行生成後以交叉淡化接合
+from werkzeug.exceptions import NotFound
 
 app = Flask(__name__)
 CORS(
@@ -23,7 +28,7 @@ app.wsgi_app = ProxyFix(app.wsgi_app, x_for=1, x_proto=1, x_host=1, x_port=1)
 # ComfyUI 與目標資料夾設定
 # -----------------------------
 server_address = "127.0.0.1:8188"  # ComfyUI 伺服器位址（本機）
-client_id = str(uuid.uuid4())      # 產生唯一 client ID
+comfy = get_pool(os.getenv("COMFY_NODES") or server_address)
 
 # ComfyUI 輸出資料夾 (影片將先產出於此)
 comfyui_output_dir = "D:/comfyui/ComfyUI_windows_portable/ComfyUI/output/"
@@ -31,72 +36,49 @@ comfyui_output_dir = "D:/comfyui/ComfyUI_windows_portable/ComfyUI/output/"
 target_dir = "D:/sd1.5_animediff_txt2video_dataset/"
 os.makedirs(target_dir, exist_ok=True)
 
+# 超過 VIDEO_SEGMENT_FRAMES 幀的影片切成互相重疊 VIDEO_SEGMENT_OVERLAP 幀的多段，
+# 同時送到各 ComfyUI 節點生成（0 = 不分段，預設）。各段是獨立生成、不以前一段結尾為條件，
+# 接縫處只是交叉淡化兩段不相關的畫面；長片的連貫性仍由工作流程的 AnimateDiff context 視窗負責
+VIDEO_SEGMENT_FRAMES = int(os.getenv("VIDEO_SEGMENT_FRAMES", "0"))
+VIDEO_SEGMENT_OVERLAP = int(os.getenv("VIDEO_SEGMENT_OVERLAP", "8"))
+
 # -----------------------------
 # 輔助函式
 # -----------------------------
 def queue_prompt(prompt):
     """發送請求到 ComfyUI /prompt API，並回傳結果"""
-    p = {"prompt": prompt, "client_id": client_id}
-    data = json.dumps(p).encode("utf-8")
-    req = urllib.request.Request(f"http://{server_address}/prompt", data=data, headers={"Content-Type": "application/json"})
-    return json.loads(urllib.request.urlopen(req).read())
+    prompt_id = comfy.queue_prompt(prompt)
+    return {"prompt_id": prompt_id, "client_id": comfy.client_id}
 
-def wait_for_completion(prompt_id):
+def wait_for_completion(prompt_id, client_id=None):
     """透過 WebSocket 監聽 ComfyUI 任務進度，直到完成"""
-    ws_url = f"ws://{server_address}/ws?clientId={client_id}"
     print("🕐 等待 ComfyUI 任務完成...")
     try:
-        ws = websocket.create_connection(ws_url)
-        while True:
-            out = ws.recv()
-            if isinstance(out, str):
-                message = json.loads(out)
-                # 當收到 "executing" 訊息，且 prompt_id 相符且沒有指定 node 時，視為完成
-                if message.get("type") == "executing":
-                    data = message.get("data", {})
-                    if data.get("node") is None and data.get("prompt_id") == prompt_id:
-                        print("✅ 任務已完成！")
-                        break
-        ws.close()
+        comfy.wait(prompt_id)
+        print("✅ 任務已完成！")
     except Exception as e:
         print(f"❌ WebSocket 連線錯誤: {e}")
 
 def get_history(prompt_id):
     """從 ComfyUI /history API 取得任務輸出紀錄"""
-    url = f"http://{server_address}/history/{prompt_id}"
-    try:
-        with urllib.request.urlopen(url) as resp:
-            history_data = json.loads(resp.read())
-        print(f"📜 Debug: history API 回應 = {json.dumps(history_data, indent=4)}")
-        return history_data.get(prompt_id, {})
-    except Exception as e:
-        print(f"❌ 無法取得歷史紀錄: {e}")
-        return {}
-
-def find_latest_mp4():
-    """在 ComfyUI 輸出資料夾中尋找最新的 MP4 檔案"""
-    mp4_files = [f for f in os.listdir(comfyui_output_dir) if f.endswith(".mp4")]
-    if not mp4_files:
-        print("🚫 找不到 MP4 檔案！")
-        return None
-    latest_mp4 = max(mp4_files, key=lambda f: os.path.getctime(os.path.join(comfyui_output_dir, f)))
-    print(f"🎬 找到最新 MP4: {latest_mp4}")
-    return latest_mp4
+    outputs = comfy.outputs(prompt_id)  # 取自 executed 事件，必要時才查 /history
+    return {"outputs": outputs} if outputs else {}
 
 def get_final_video_filename(prompt_id):
-    """從 /history API 或檔案搜尋中取得最終 MP4 檔案名稱"""
+    """從 executed 事件 / history 的輸出紀錄取得最終 MP4 檔案名稱"""
     history = get_history(prompt_id)
     if not history:
-        print("⚠️ history API 回應為空，改用檔案搜尋。")
-        return find_latest_mp4()
+        print("⚠️ history API 回應為空。")
+        return None
     video_node = history.get("outputs", {}).get("52", {})
     if "gifs" in video_node:
         for video in video_node["gifs"]:
             print(f"🎬 Found video from API: {video['filename']}")
             if video["filename"].endswith(".mp4"):
                 return video["filename"]
-    print("⚠️ API 未找到 MP4，改用檔案搜尋。")
-    return find_latest_mp4()
+    print("⚠️ API 未找到 MP4，改用其他輸出節點。")
+    files = output_files(comfy.outputs(prompt_id), exts=(".mp4",))
+    return files[0]["filename"] if files else None
 
 def move_output_files(prompt_id):
     """將生成的 MP4 檔案從 ComfyUI 輸出資料夾搬移到目標資料夾"""
@@ -531,48 +513,64 @@ def generate_video_endpoint():
     except ValueError:
         seed = 103
 
-    # 更新影片生成的工作流程參數
+    # 更新影片生成的工作流程參數（每段一份）
     try:
-        prompt = json.loads(prompt_text)
-    except json.JSONDecodeError as e:
+        instantiate_text(prompt_text)
+    except ValueError as e:
         return jsonify({"error": "工作流程 JSON 格式錯誤", "details": str(e)}), 500
 
-    # 使用翻譯後的描述作為提示詞
-    prompt["88"]["inputs"]["text"] = description
-    prompt["7"]["inputs"]["cfg"] = 7
-    prompt["7"]["inputs"]["sampler_name"] = "euler"
-    prompt["7"]["inputs"]["scheduler"] = "karras"
-    prompt["9"]["inputs"]["batch_size"] = duration * frame_rate
-    prompt["20"]["inputs"]["model_name"] = "mm_sd_v15.ckpt"
-    prompt["54"]["inputs"]["model_name"] = "control_sd15_canny.pth"
-    prompt["7"]["inputs"]["seed"] = seed
-
-    print("🚀 發送工作流程到 ComfyUI...")
-    resp_data = queue_prompt(prompt)
-    if not resp_data or "prompt_id" not in resp_data:
-        return jsonify({"error": "ComfyUI API 回應錯誤"}), 500
-
-    prompt_id = resp_data["prompt_id"]
-    print(f"🔹 取得 prompt_id: {prompt_id}")
+    def build(seg):
+        prompt = instantiate_text(prompt_text)
+        # 使用翻譯後的描述作為提示詞
+        prompt["88"]["inputs"]["text"] = description
+        prompt["7"]["inputs"]["cfg"] = 7
+        prompt["7"]["inputs"]["sampler_name"] = "euler"
+        prompt["7"]["inputs"]["scheduler"] = "karras"
+        prompt["9"]["inputs"]["batch_size"] = seg.frames
+        prompt["20"]["inputs"]["model_name"] = "mm_sd_v15.ckpt"
+        prompt["54"]["inputs"]["model_name"] = "control_sd15_canny.pth"
+        prompt["7"]["inputs"]["seed"] = seed + seg.index
+        return prompt
 
-    wait_for_completion(prompt_id)
-    time.sleep(5)  # 視情況調整等待時間
-
-    print("✅ 任務完成，開始搬移影片檔案...")
-    mp4_filename = move_output_files(prompt_id)
-    if not mp4_filename:
-        return jsonify({"error": "搬移影片失敗"}), 500
+    segments = plan_segments(duration * frame_rate, VIDEO_SEGMENT_FRAMES, VIDEO_SEGMENT_OVERLAP)
+    stem = f"txt2vid_{uuid.uuid4().hex[:16]}"
+    print(f"🚀 發送工作流程到 ComfyUI（{len(segments)} 段）...")
+    parts = []
+    try:
+        parts = SegmentedRender(comfy, segments, build, target_dir, stem).run()
+        mp4_filename = f"{stem}.mp4"
+        print("✅ 任務完成，接合影片段落...")
+        mp4_path = crossfade(parts, [seg.frames for seg in segments], os.path.join(target_dir, mp4_filename),
+                             frame_rate, segment_overlap(segments))
+        # moov 移到檔頭，瀏覽器不必下載完整檔案即可開始播放
+        faststart(mp4_path)
+    except Exception as e:
+        print(f"❌ 影片生成失敗: {e}")
+        return jsonify({"error": "影片生成失敗", "details": str(e)}), 500
+    finally:
+        for path in parts:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
 
     video_url = f"https://textvideo.picturesmagician.com/get_video/{mp4_filename}?t={int(time.time())}"
     print("🔹 回傳影片 URL:", video_url)
-    return jsonify({"video_url": video_url})
+    response = {"video_url": video_url}
+    # 封面圖（供 <video poster>）；失敗不影響影片本身
+    try:
+        poster_filename = os.path.basename(poster(mp4_path))
+        response["poster_url"] = f"https://textvideo.picturesmagician.com/get_video/{poster_filename}?t={int(time.time())}"
+    except Exception as e:
+        print(f"⚠️ 封面圖產生失敗: {e}")
+    return jsonify(response)
 
 @app.route("/get_video/<path:filename>", methods=["GET"])
 def get_video(filename):
-    file_path = os.path.join(target_dir, filename)
-    if not os.path.exists(file_path):
+    try:
+        return send_output(target_dir, filename, cache="revalidate")
+    except NotFound:
         return jsonify({"error": "檔案不存在"}), 404
-    return send_from_directory(target_dir, filename)
 
 if __name__ == "__main__":
     app.run(host="0.0.0.0", port=5008, debug=False)
@@ -2,15 +2,19 @@
 # -*- coding: utf-8 -*-
 
 import os
-import json
 import shutil
 import time
 import uuid
 import base64
-import urllib.request
-import websocket  # 請先安裝 websocket-client: pip install websocket-client
-from flask import Flask, request, jsonify, send_from_directory, make_response
+from flask import Flask, request, jsonify
 from flask_cors import CORS
+import sys
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from backend.workflows import instantiate_text
+from comfy_client import output_files
+from comfy_pool import get_pool  # 共用 ComfyUI 連線；設定 COMFY_NODES 時分派到佇列最短的節點
+from file_delivery import send_output  # 依 OUTPUT_DELIVERY 交給 nginx/Apache 或由 Flask 串流（支援 Range）
+from werkzeug.exceptions import NotFound
 
 app = Flask(__name__)
 CORS(app, resources={r"/*": {"origins": "*"}})
@@ -287,6 +291,7 @@ image_workflow_json = r"""
 # ComfyUI 伺服器與資料夾設定
 # ----------------------------
 server_address     = "127.0.0.1:8188"
+comfy = get_pool(os.getenv("COMFY_NODES") or server_address)
 comfyui_output_dir = r"D:\comfyui\ComfyUI_windows_portable\ComfyUI\output"
 target_dir_text    = r"D:\大模型文生線稿上色圖"
 target_dir_image   = r"D:\大模型圖生線稿上色圖"
@@ -300,44 +305,17 @@ for d in (target_dir_text, target_dir_image, TEMP_IMAGE_DIR):
 # 輔助函式
 # ----------------------------
 def queue_prompt(workflow_dict):
-    client_id = str(uuid.uuid4())
-    payload   = {"prompt": workflow_dict, "client_id": client_id}
-    data      = json.dumps(payload).encode("utf-8")
-    req = urllib.request.Request(
-        f"http://{server_address}/prompt",
-        data=data,
-        headers={"Content-Type":"application/json"}
-    )
-    with urllib.request.urlopen(req, timeout=60) as resp:
-        result = json.loads(resp.read().decode("utf-8"))
-        result["client_id"] = client_id
-        return result
-
-def wait_for_completion(prompt_id, client_id):
-    ws = websocket.create_connection(f"ws://{server_address}/ws?clientId={client_id}", timeout=60)
-    while True:
-        msg = ws.recv()
-        m = json.loads(msg) if isinstance(msg, str) else {}
-        if m.get("type") == "executing":
-            d = m.get("data", {})
-            if d.get("prompt_id") == prompt_id and d.get("node") is None:
-                break
-    ws.close()
-
-def find_latest_png(directory):
-    pngs = [f for f in os.listdir(directory) if f.lower().endswith(".png")]
-    return max(pngs, key=lambda fn: os.path.getctime(os.path.join(directory, fn))) if pngs else None
+    prompt_id = comfy.queue_prompt(workflow_dict)
+    return {"prompt_id": prompt_id, "client_id": comfy.client_id}
+
+def wait_for_completion(prompt_id, client_id=None):
+    comfy.wait(prompt_id)
 
 def get_final_image_filename(prompt_id):
-    url = f"http://{server_address}/history/{prompt_id}"
-    with urllib.request.urlopen(url, timeout=30) as resp:
-        hist = json.loads(resp.read().decode("utf-8")).get(prompt_id, {})
-    for nid in ("7",):
-        for info in hist.get("outputs", {}).get(nid, {}).get("images", []):
-            fn = info.get("filename")
-            if fn and fn.lower().endswith(".png"):
-                return fn
-    return find_latest_png(comfyui_output_dir)
+    # 輸出紀錄取自 executed 事件（必要時查 /history），優先使用 SaveImage 節點 7
+    outputs = comfy.outputs(prompt_id)
+    files = output_files(outputs, exts=(".png",), node_ids=("7",)) or output_files(outputs, exts=(".png",))
+    return files[0]["filename"] if files else None
 
 def move_output_files(prompt_id, target_folder):
     fn = get_final_image_filename(prompt_id)
@@ -382,7 +360,7 @@ def lineart_color_text():
     except Exception as e:
         return jsonify({"error":f"線稿圖解碼失敗: {e}"}), 400
 
-    wf = json.loads(text_workflow_json)
+    wf = instantiate_text(text_workflow_json)
 
     # 區分 checkpoint / vae
     if data.get("ckpt_name"):
@@ -462,7 +440,7 @@ def lineart_color_image():
     else:
         data["line_art_image"] = data["image"]
 
-    wf = json.loads(image_workflow_json)
+    wf = instantiate_text(image_workflow_json)
 
     # 區分 checkpoint / vae
     if data.get("ckpt_name"):
@@ -510,19 +488,10 @@ def lineart_color_image():
 # ----------------------------
 @app.route("/get_image/<path:filename>", methods=["GET"])
 def get_image(filename):
-    t = os.path.join(target_dir_text, filename)
-    i = os.path.join(target_dir_image, filename)
-    if os.path.exists(t):
-        resp = make_response(send_from_directory(target_dir_text, filename))
-    elif os.path.exists(i):
-        resp = make_response(send_from_directory(target_dir_image, filename))
-    else:
+    try:
+        return send_output((target_dir_text, target_dir_image), filename, cache="no-store")
+    except NotFound:
         return jsonify({"error":"檔案不存在"}), 404
-    resp.headers.update({
-        "Cache-Control": "no-store, no-cache, must-revalidate, max-age=0",
-        "Pragma": "no-cache"
-    })
-    return resp
 
 if __name__ == "__main__":
     # 開發測試用，正式部署請改用 gunicorn/uwsgi
@@ -1,14 +1,17 @@
 # image_generation_flask.py
 import os
-import json
 import shutil
 import time
-import uuid
-import base64
-import urllib.request
-import websocket  # pip install websocket-client
-from flask import Flask, request, jsonify, send_from_directory, make_response
+from flask import Flask, request, jsonify
 from flask_cors import CORS
+import sys
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+from backend.workflows import instantiate_text
+from comfy_client import output_files
+from comfy_pool import get_pool  # 共用 ComfyUI 連線；設定 COMFY_NODES 時分派到佇列最短的節點
+from file_delivery import send_output  # 依 OUTPUT_DELIVERY 交給 nginx/Apache 或由 Flask 串流（支援 Range）
+from upload_stream import PayloadError, read_payload  # 邊讀邊解碼 Base64 圖片欄位，不把整個 JSON 載入記憶體
+from werkzeug.exceptions import NotFound
 
 app = Flask(__name__)
 CORS(app)
@@ -17,6 +20,7 @@ CORS(app)
 # ComfyUI 位置 & 資料夾設定 (保持原樣)
 # -----------------------------------
 server_address = "127.0.0.1:8188"  # ComfyUI 伺服器地址
+comfy = get_pool(os.getenv("COMFY_NODES") or server_address)
 comfyui_output_dir = r"D:\comfyui\ComfyUI_windows_portable\ComfyUI\output"
 
 # 生成結果存放（文生與圖生分開）
@@ -341,56 +345,30 @@ WORKFLOW_IMAGE_CN = r"""
 """.strip()
 
 # -----------------------------------
-# 小工具：queue_prompt, wait_for_completion, get_history, find_latest_png,
+# 小工具：queue_prompt, wait_for_completion, get_history,
 #           get_final_image_filename, move_output_files,
 #           apply_controlnet_params_to_workflow_text_cn,
 #           apply_controlnet_params_to_workflow_image_cn
 # -----------------------------------
 def queue_prompt(prompt):
-    client_id = str(uuid.uuid4())
-    payload = {"prompt": prompt, "client_id": client_id}
-    data = json.dumps(payload).encode("utf-8")
-    url = f"http://{server_address}/prompt"
     try:
-        req = urllib.request.Request(url, data=data, headers={"Content-Type": "application/json"})
-        with urllib.request.urlopen(req) as resp:
-            result = json.loads(resp.read())
-            result["client_id"] = client_id
-            return result
+        prompt_id = comfy.queue_prompt(prompt)
+        return {"prompt_id": prompt_id, "client_id": comfy.client_id}
     except Exception as e:
-        print(f"❌ 無法連線至 ComfyUI: {e}")
+        print(f"❌ 無法連線至 ComfyUI API: {e}")
         return None
 
-def wait_for_completion(prompt_id, client_id):
-    ws_url = f"ws://{server_address}/ws?clientId={client_id}"
+def wait_for_completion(prompt_id, client_id=None):
+    print("🕐 等待 ComfyUI 任務完成...")
     try:
-        ws = websocket.create_connection(ws_url)
-        while True:
-            out = ws.recv()
-            if isinstance(out, str):
-                msg = json.loads(out)
-                if msg.get("type") == "executing":
-                    data = msg.get("data", {})
-                    if data.get("node") is None and data.get("prompt_id") == prompt_id:
-                        break
-        ws.close()
+        comfy.wait(prompt_id)
+        print("✅ 任務已完成！")
     except Exception as e:
-        print(f"❌ WebSocket 錯誤: {e}")
-
-def find_latest_png(directory):
-    png_list = [f for f in os.listdir(directory) if f.lower().endswith(".png")]
-    if not png_list:
-        return None
-    return max(png_list, key=lambda x: os.path.getctime(os.path.join(directory, x)))
+        print(f"❌ WebSocket 連線錯誤: {e}")
 
 def get_history(prompt_id):
-    url = f"http://{server_address}/history/{prompt_id}"
-    try:
-        with urllib.request.urlopen(url) as resp:
-            all_data = json.loads(resp.read())
-        return all_data.get(prompt_id, {})
-    except:
-        return {}
+    outputs = comfy.outputs(prompt_id)  # 取自 executed 事件，必要時才查 /history
+    return {"outputs": outputs} if outputs else {}
 
 def get_final_image_filename(prompt_id):
     history = get_history(prompt_id)
@@ -399,7 +377,8 @@ def get_final_image_filename(prompt_id):
             fn = info.get("filename")
             if fn and fn.lower().endswith(".png"):
                 return fn
-    return find_latest_png(comfyui_output_dir)
+    files = output_files(comfy.outputs(prompt_id), exts=(".png",))
+    return files[0]["filename"] if files else None
 
 def move_output_files(prompt_id, target_folder):
     fn = get_final_image_filename(prompt_id)
@@ -450,8 +429,11 @@ def apply_controlnet_params_to_workflow_image_cn(workflow, cn_params):
 # -----------------------------------
 @app.route("/pose_control_text", methods=["POST"])
 def pose_control_text():
-    data = request.get_json()
-    if not data or "prompt" not in data:
+    try:
+        data, images = read_payload(request, {"pose_image": "pose"}, temp_dir)
+    except PayloadError as e:
+        return jsonify({"error": str(e)}), e.status
+    if "prompt" not in data:
         return jsonify({"error": "缺少 prompt 參數"}), 400
 
     # 列出接收到的參數
@@ -462,6 +444,7 @@ def pose_control_text():
         "pose_image", "control_net_params"
     ]
     received_params = {k: data.get(k) for k in expected_keys if k in data}
+    received_params.update({k: f.describe() for k, f in images.items()})
     print("=== Received Params (Text Mode) ===")
     for k, v in received_params.items():
         print(f"{k}: {v}")
@@ -473,11 +456,11 @@ def pose_control_text():
     sampler        = data.get("sampler", "dpmpp_2m_sde")
     scheduler      = data.get("scheduler", "karras")
     seed           = int(data.get("seed", 87))
-    pose_image_b64 = data.get("pose_image", "").strip()
+    pose_image     = images.get("pose_image")
     cn_params      = data.get("control_net_params", {})
 
-    workflow_str = WORKFLOW_TEXT_CN if pose_image_b64 else WORKFLOW_TEXT_BASE
-    workflow     = json.loads(workflow_str)
+    workflow_str = WORKFLOW_TEXT_CN if pose_image else WORKFLOW_TEXT_BASE
+    workflow     = instantiate_text(workflow_str)
 
     workflow["2"]["inputs"]["text"]       = prompt_text
     workflow["4"]["inputs"]["cfg"]        = cfg_scale
@@ -485,14 +468,9 @@ def pose_control_text():
     workflow["4"]["inputs"]["scheduler"]    = scheduler
     workflow["4"]["inputs"]["seed"]         = seed
 
-    if pose_image_b64:
-        _, enc = pose_image_b64.split(",", 1)
-        pose_fn   = f"pose_{uuid.uuid4().hex}.png"
-        pose_path = os.path.join(temp_dir, pose_fn)
-        with open(pose_path, "wb") as f:
-            f.write(base64.b64decode(enc))
-        workflow["48"]["inputs"]["image_path"] = pose_path
-        workflow["50"]["inputs"]["image_path"] = pose_path
+    if pose_image:
+        workflow["48"]["inputs"]["image_path"] = pose_image.path
+        workflow["50"]["inputs"]["image_path"] = pose_image.path
         apply_controlnet_params_to_workflow_text_cn(workflow, cn_params)
 
     resp = queue_prompt(workflow)
@@ -527,8 +505,11 @@ def pose_control_text():
 # -----------------------------------
 @app.route("/pose_control_image", methods=["POST"])
 def pose_control_image():
-    data = request.get_json()
-    if not data or "prompt" not in data or "image" not in data:
+    try:
+        data, images = read_payload(request, {"image": "main", "pose_image": "pose"}, temp_dir)
+    except PayloadError as e:
+        return jsonify({"error": str(e)}), e.status
+    if "prompt" not in data or "image" not in images:
         return jsonify({"error": "缺少 prompt 或 image 參數"}), 400
 
     # 列出接收到的參數
@@ -539,6 +520,7 @@ def pose_control_image():
         "image", "pose_image", "control_net_params"
     ]
     received_params = {k: data.get(k) for k in expected_keys if k in data}
+    received_params.update({k: f.describe() for k, f in images.items()})
     print("=== Received Params (Image Mode) ===")
     for k, v in received_params.items():
         print(f"{k}: {v}")
@@ -546,16 +528,15 @@ def pose_control_image():
 
     # 原有邏輯
     prompt_text = data["prompt"].strip()
-    main_b64    = data["image"].strip()
     cfg_scale   = int(data.get("cfg_scale", 7))
     sampler     = data.get("sampler", "dpmpp_2m_sde")
     scheduler   = data.get("scheduler", "karras")
     seed        = int(data.get("seed", 87))
-    pose_b64    = data.get("pose_image", "").strip()
+    pose_image  = images.get("pose_image")
     cn_params   = data.get("control_net_params", {})
 
-    workflow_str = WORKFLOW_IMAGE_CN if pose_b64 else WORKFLOW_IMAGE_BASE
-    workflow     = json.loads(workflow_str)
+    workflow_str = WORKFLOW_IMAGE_CN if pose_image else WORKFLOW_IMAGE_BASE
+    workflow     = instantiate_text(workflow_str)
 
     workflow["2"]["inputs"]["text"]         = prompt_text
     workflow["4"]["inputs"]["cfg"]          = cfg_scale
@@ -563,23 +544,13 @@ def pose_control_image():
     workflow["4"]["inputs"]["scheduler"]    = scheduler
     workflow["4"]["inputs"]["seed"]         = seed
 
-    # 解碼主圖
-    _, main_enc = main_b64.split(",", 1)
-    main_fn     = f"main_{uuid.uuid4().hex}.png"
-    main_path   = os.path.join(temp_dir, main_fn)
-    with open(main_path, "wb") as f:
-        f.write(base64.b64decode(main_enc))
-    workflow["47"]["inputs"]["image_path"] = main_path
-
-    # 解碼姿勢圖並套用 ControlNet
-    if pose_b64:
-        _, pose_enc = pose_b64.split(",", 1)
-        pose_fn     = f"pose_{uuid.uuid4().hex}.png"
-        pose_path   = os.path.join(temp_dir, pose_fn)
-        with open(pose_path, "wb") as f:
-            f.write(base64.b64decode(pose_enc))
-        workflow["49"]["inputs"]["image_path"] = pose_path
-        workflow["50"]["inputs"]["image_path"] = pose_path
+    # 主圖（已於讀取請求時解碼存檔）
+    workflow["47"]["inputs"]["image_path"] = images["image"].path
+
+    # 姿勢圖並套用 ControlNet
+    if pose_image:
+        workflow["49"]["inputs"]["image_path"] = pose_image.path
+        workflow["50"]["inputs"]["image_path"] = pose_image.path
         apply_controlnet_params_to_workflow_image_cn(workflow, cn_params)
 
     resp = queue_prompt(workflow)
@@ -615,17 +586,10 @@ def pose_control_image():
 # -----------------------------------
 @app.route("/get_image/<path:filename>", methods=["GET"])
 def get_image(filename):
-    t_path = os.path.join(target_dir_text, filename)
-    i_path = os.path.join(target_dir_image, filename)
-    if os.path.exists(t_path):
-        resp = make_response(send_from_directory(target_dir_text, filename))
-    elif os.path.exists(i_path):
-        resp = make_response(send_from_directory(target_dir_image, filename))
-    else:
+    try:
+        return send_output((target_dir_text, target_dir_image), filename, cache="no-store")
+    except NotFound:
         return jsonify({"error": "檔案不存在"}), 404
-    resp.headers["Cache-Control"] = "no-store, no-cache, must-revalidate, max-age=0"
-    resp.headers["Pragma"]        = "no-cache"
-    return resp
 
 if __name__ == "__main__":
     app.run(host="0.0.0.0", port=5005, debug=False)
@@ -3,13 +3,16 @@ import os
 import shutil
 import time
 import uuid
-import websocket  # pip install websocket-client
-import urllib.request
-import urllib.error
-from flask import Flask, request, jsonify, send_from_directory
+from flask import Flask, request, jsonify
 from flask_cors import CORS
 from werkzeug.utils import secure_filename
 import base64
+import sys
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+from backend.workflows import instantiate_text
+from comfy_client import output_files
+from comfy_pool import get_pool  # 共用 ComfyUI 連線；設定 COMFY_NODES 時分派到佇列最短的節點
+from file_delivery import send_output  # 依 OUTPUT_DELIVERY 交給 nginx/Apache 或由 Flask 串流（支援 Range）
 
 app = Flask(__name__)
 CORS(app)
@@ -18,6 +21,7 @@ CORS(app)
 # ComfyUI 伺服器與資料夾設定
 # =============================
 server_address   = "127.0.0.1:8188"  # ComfyUI 伺服器位址（假設在本機）
+comfy = get_pool(os.getenv("COMFY_NODES") or server_address)
 comfyui_output_dir = r"D:\comfyui\ComfyUI_windows_portable\ComfyUI\output"
 target_dir       = r"D:\大模型圖生圖"
 temp_input_dir   = r"D:\大模型圖生圖\temp_input"  # 用於暫存前端繪製圖像
@@ -31,67 +35,30 @@ EXTERNAL_URL     = "https://draw.picturesmagician.com"
 # 工具函數：Queue、等待、歷史紀錄、文件搬移等
 # =============================
 def queue_prompt(prompt):
-    client_id = str(uuid.uuid4())
-    payload   = {"prompt": prompt, "client_id": client_id}
-    data      = json.dumps(payload).encode("utf-8")
-    url       = f"http://{server_address}/prompt"
     try:
-        req = urllib.request.Request(url, data=data, headers={"Content-Type": "application/json"})
-        with urllib.request.urlopen(req) as resp:
-            result = json.loads(resp.read())
-            result["client_id"] = client_id
-            return result
-    except urllib.error.HTTPError as e:
-        error_body = e.read().decode()
-        print(f"❌ HTTPError: {e.code} {error_body}")
-        return None
+        prompt_id = comfy.queue_prompt(prompt)
+        return {"prompt_id": prompt_id, "client_id": comfy.client_id}
     except Exception as e:
         print(f"❌ 無法連線至 ComfyUI API: {e}")
         return None
 
-def wait_for_completion(prompt_id, client_id):
-    ws_url = f"ws://{server_address}/ws?clientId={client_id}"
+def wait_for_completion(prompt_id, client_id=None):
     print("🕐 等待 ComfyUI 任務完成...")
     try:
-        ws = websocket.create_connection(ws_url)
-        while True:
-            out = ws.recv()
-            if isinstance(out, str):
-                message = json.loads(out)
-                if message.get("type") == "executing":
-                    data = message.get("data", {})
-                    if data.get("node") is None and data.get("prompt_id") == prompt_id:
-                        print("✅ 任務已完成！")
-                        break
-        ws.close()
+        comfy.wait(prompt_id)
+        print("✅ 任務已完成！")
     except Exception as e:
         print(f"❌ WebSocket 連線錯誤: {e}")
 
 def get_history(prompt_id):
-    url = f"http://{server_address}/history/{prompt_id}"
-    try:
-        with urllib.request.urlopen(url) as resp:
-            history_data = json.loads(resp.read())
-        print(f"📜 history API 回應:\n{json.dumps(history_data, indent=4, ensure_ascii=False)}")
-        return history_data.get(prompt_id, {})
-    except Exception as e:
-        print(f"❌ 無法取得歷史紀錄: {e}")
-        return {}
-
-def find_latest_png():
-    png_files = [f for f in os.listdir(comfyui_output_dir) if f.lower().endswith(".png")]
-    if not png_files:
-        print("🚫 找不到任何 .png 檔案！")
-        return None
-    latest_png = max(png_files, key=lambda f: os.path.getctime(os.path.join(comfyui_output_dir, f)))
-    print(f"🎞 找到最新的 .png 檔案: {latest_png}")
-    return latest_png
+    outputs = comfy.outputs(prompt_id)  # 取自 executed 事件，必要時才查 /history
+    return {"outputs": outputs} if outputs else {}
 
 def get_final_image_filename(prompt_id):
     history = get_history(prompt_id)
     if not history:
-        print("⚠️ history API 回應为空，改用檔案搜尋。")
-        return find_latest_png()
+        print("⚠️ history API 回應為空。")
+        return None
     outputs    = history.get("outputs", {})
     image_node = outputs.get("7", {})
     if "images" in image_node:
@@ -100,8 +67,9 @@ def get_final_image_filename(prompt_id):
             if filename and filename.lower().endswith(".png"):
                 print(f"🎞 從 API 取得圖片檔名: {filename}")
                 return filename
-    print("⚠️ API 未提供圖片檔名，改用檔案搜尋。")
-    return find_latest_png()
+    print("⚠️ API 未提供圖片檔名，改用其他輸出節點。")
+    files = output_files(comfy.outputs(prompt_id), exts=(".png",))
+    return files[0]["filename"] if files else None
 
 def move_output_files(prompt_id):
     image_filename = get_final_image_filename(prompt_id)
@@ -286,7 +254,7 @@ def convert_image_endpoint():
 }
 """.strip()
     try:
-        workflow = json.loads(workflow_template)
+        workflow = instantiate_text(workflow_template)
     except Exception as e:
         return jsonify({"error": "工作流程 JSON 格式錯誤", "details": str(e)}), 500
 
@@ -327,7 +295,7 @@ def convert_image_endpoint():
 
 @app.route("/get_image/<filename>", methods=["GET"])
 def get_image(filename):
-    return send_from_directory(target_dir, filename)
+    return send_output(target_dir, filename, cache="revalidate")
 
 # 新增 /image_to_image 路由，供 ComfyUI 讀取圖片檔案（若工作流程中 LoadImage 觸發）
 @app.route("/image_to_image", methods=["POST"])
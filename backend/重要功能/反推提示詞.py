@@ -1,14 +1,18 @@
-import json
 import os
 import shutil
 import time
-import websocket  # 請確保已安裝 websocket-client (pip install websocket-client)
-import urllib.request
 import uuid
 import base64  # 新增 base64 模組
-from flask import Flask, request, jsonify, send_from_directory, make_response
+from flask import Flask, request, jsonify
 from flask_cors import CORS
 from PIL import Image, PngImagePlugin  # 用來嵌入 dummy metadata
+import sys
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+from backend.workflows import template_from_text
+from comfy_client import output_files
+from comfy_pool import get_pool  # 共用 ComfyUI 連線；設定 COMFY_NODES 時分派到佇列最短的節點
+from file_delivery import send_output  # 依 OUTPUT_DELIVERY 交給 nginx/Apache 或由 Flask 串流（支援 Range）
+from werkzeug.exceptions import NotFound
 
 app = Flask(__name__)
 CORS(app)
@@ -18,6 +22,7 @@ CORS(app)
 # =============================
 # ComfyUI 伺服器與資料夾設定
 SERVER_ADDRESS = "127.0.0.1:8188"  # ComfyUI 伺服器位址
+comfy = get_pool(os.getenv("COMFY_NODES") or SERVER_ADDRESS)
 COMFYUI_OUTPUT_DIR = r"D:\comfyui\ComfyUI_windows_portable\ComfyUI\output"  # ComfyUI 輸出資料夾路徑
 TARGET_DIR = r"D:\圖像反推"  # 目標資料夾路徑，將搬移 txt 文檔到此處
 os.makedirs(TARGET_DIR, exist_ok=True)
@@ -41,52 +46,26 @@ def queue_prompt(prompt):
     將工作流程 (Workflow) JSON 送往 ComfyUI 的 /prompt API，
     並回傳包含 prompt_id 與任務專用 client_id 的結果。
     """
-    client_id = str(uuid.uuid4())
-    payload = {
-        "prompt": prompt,
-        "client_id": client_id
-    }
-    data = json.dumps(payload).encode("utf-8")
-    url = f"http://{SERVER_ADDRESS}/prompt"
     try:
-        req = urllib.request.Request(url, data=data, headers={"Content-Type": "application/json"})
-        with urllib.request.urlopen(req, timeout=60) as resp:
-            result = json.loads(resp.read())
-            result["client_id"] = client_id
-            return result
+        prompt_id = comfy.queue_prompt(prompt)
+        return {"prompt_id": prompt_id, "client_id": comfy.client_id}
     except Exception as e:
         print(f"❌ 無法連線至 ComfyUI API: {e}")
         return None
 
-def wait_for_completion(prompt_id, client_id):
+def wait_for_completion(prompt_id, client_id=None):
     """
     建立 WebSocket 連線以監聽指定 prompt_id 的執行狀態，
     當收到 'executing' 訊息，且其中的 node 為 None 且 prompt_id 相符時，
     表示該流程已完成。
     加入超時處理避免無限等待。
     """
-    ws_url = f"ws://{SERVER_ADDRESS}/ws?clientId={client_id}"
     print("🕐 等待 ComfyUI 任務完成...")
-    start_time = time.time()
     try:
-        ws = websocket.create_connection(ws_url, timeout=30)
-        while True:
-            if time.time() - start_time > WS_TIMEOUT:
-                print("⚠️ 等待任務超時")
-                break
-            out = ws.recv()
-            if isinstance(out, str):
-                try:
-                    message = json.loads(out)
-                except Exception as e:
-                    print(f"❌ JSON 解碼錯誤: {e}")
-                    continue
-                if message.get("type") == "executing":
-                    data = message.get("data", {})
-                    if data.get("node") is None and data.get("prompt_id") == prompt_id:
-                        print("✅ 任務已完成！")
-                        break
-        ws.close()
+        comfy.wait(prompt_id, timeout=WS_TIMEOUT)
+        print("✅ 任務已完成！")
+    except TimeoutError:
+        print("⚠️ 等待任務超時")
     except Exception as e:
         print(f"❌ WebSocket 連線錯誤: {e}")
 
@@ -95,41 +74,18 @@ def get_history(prompt_id):
     透過 /history/<prompt_id> API 取得該任務的輸出紀錄，
     並回傳相對應的 JSON 資料。
     """
-    url = f"http://{SERVER_ADDRESS}/history/{prompt_id}"
-    try:
-        with urllib.request.urlopen(url, timeout=30) as resp:
-            history_data = json.loads(resp.read())
-        print(f"📜 Debug: history API 回應 = {json.dumps(history_data, indent=4, ensure_ascii=False)}")
-        return history_data.get(prompt_id, {})
-    except Exception as e:
-        print(f"❌ 無法取得歷史紀錄: {e}")
-        return {}
-
-def find_latest_txt():
-    """
-    若 /history API 未提供有效檔名，則於 ComfyUI 輸出資料夾中搜尋最新建立的 .txt 檔案。
-    """
-    try:
-        txt_files = [f for f in os.listdir(COMFYUI_OUTPUT_DIR) if f.lower().endswith(".txt")]
-    except Exception as e:
-        print(f"❌ 無法讀取輸出目錄: {e}")
-        return None
-    if not txt_files:
-        print("🚫 找不到任何 .txt 檔案！")
-        return None
-    latest_txt = max(txt_files, key=lambda f: os.path.getctime(os.path.join(COMFYUI_OUTPUT_DIR, f)))
-    print(f"🎞 找到最新的 .txt 檔案: {latest_txt}")
-    return latest_txt
+    outputs = comfy.outputs(prompt_id)  # 取自 executed 事件，必要時才查 /history
+    return {"outputs": outputs} if outputs else {}
 
 def get_final_text_filename(prompt_id):
     """
     嘗試從 /history/<prompt_id> 的回應中取得最終儲存的文本檔案名稱，
-    若無法取得，則改用檔案搜尋方式取得最新 .txt 檔案。
+    若無法取得則回傳 None（由 save_shown_text 改用節點回傳的文字）。
     """
     history = get_history(prompt_id)
     if not history:
-        print("⚠️ /history API 回應為空，改用檔案搜尋。")
-        return find_latest_txt()
+        print("⚠️ /history API 回應為空。")
+        return None
     outputs = history.get("outputs", {})
     text_node = outputs.get("4", {})
     if "images" in text_node:
@@ -138,8 +94,25 @@ def get_final_text_filename(prompt_id):
             if filename and filename.lower().endswith(".txt"):
                 print(f"🎞 從 API 取得文本檔名: {filename}")
                 return filename
-    print("⚠️ /history API 未提供文本檔名，改用檔案搜尋。")
-    return find_latest_txt()
+    print("⚠️ /history API 未提供文本檔名，改用其他輸出節點。")
+    files = output_files(comfy.outputs(prompt_id), exts=(".txt",))
+    return files[0]["filename"] if files else None
+
+def save_shown_text(prompt_id):
+    """
+    Save Text File 節點不會在 /history 回報檔名；改用 ShowText 節點 ("3") 在
+    executed 事件中回傳的文字直接寫入目標資料夾，不必掃描輸出目錄。
+    """
+    texts = (comfy.outputs(prompt_id).get("3") or {}).get("text") or []
+    if not texts:
+        print("🚫 無法取得文本內容！")
+        return None
+    text_filename = f"ComfyUI_{prompt_id.replace('-', '')[:12]}.txt"
+    target_path = os.path.join(TARGET_DIR, text_filename)
+    with open(target_path, "w", encoding="utf-8") as f:
+        f.write("\n".join(str(t) for t in texts))
+    print(f"✅ 已寫入文本: {target_path}")
+    return text_filename
 
 def move_output_files(prompt_id):
     """
@@ -147,8 +120,7 @@ def move_output_files(prompt_id):
     """
     text_filename = get_final_text_filename(prompt_id)
     if not text_filename:
-        print("🚫 無法取得文本檔案名稱！")
-        return None
+        return save_shown_text(prompt_id)
     source_path = os.path.join(COMFYUI_OUTPUT_DIR, text_filename)
     target_path = os.path.join(TARGET_DIR, text_filename)
     if not os.path.exists(source_path):
@@ -243,17 +215,11 @@ prompt_text = r"""
 """
 
 try:
-    workflow = json.loads(prompt_text)
-except json.decoder.JSONDecodeError as e:
+    WORKFLOW_TEMPLATE = template_from_text(prompt_text, "圖像反推")
+except ValueError as e:
     print(f"❌ JSON 格式錯誤: {e}")
     exit()
 
-# =============================
-# 修改工作流程中的參數
-# =============================
-workflow["2"]["inputs"]["threshold"] = 0.35
-workflow["2"]["inputs"]["character_threshold"] = 0.85
-
 # =============================
 # Flask 路由
 # =============================
@@ -298,7 +264,8 @@ def reverse_prompt():
     except Exception as e:
         return jsonify({"error": "圖像解碼失敗", "details": str(e)}), 400
 
-    # 更新工作流程中節點 "5" 的 image_path
+    # 更新工作流程中節點 "5" 的 image_path（每個請求使用自己的工作流實例）
+    workflow = WORKFLOW_TEMPLATE.instantiate()
     workflow["5"]["inputs"]["image_path"] = image_path
 
     # 若前端有其他參數 (例如 threshold)，可在此更新
@@ -334,13 +301,10 @@ def get_image(filename):
     """
     提供搬移後的檔案下載或顯示 (通常為 .txt)。
     """
-    file_path = os.path.join(TARGET_DIR, filename)
-    if not os.path.exists(file_path):
+    try:
+        return send_output(TARGET_DIR, filename, cache="no-store")
+    except NotFound:
         return jsonify({"error": "檔案不存在"}), 404
-    response = make_response(send_from_directory(TARGET_DIR, filename))
-    response.headers["Cache-Control"] = "no-store, no-cache, must-revalidate, max-age=0"
-    response.headers["Pragma"] = "no-cache"
-    return response
 
 # =============================
 # 啟動 Flask 服務
@@ -3,12 +3,15 @@ import os
 import shutil
 import time
 import uuid
-import websocket  # pip install websocket-client
-import urllib.request
-import urllib.error
-from flask import Flask, request, jsonify, send_from_directory
+from flask import Flask, request, jsonify
 from flask_cors import CORS
 from werkzeug.utils import secure_filename
+import sys
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+from backend.workflows import instantiate_text
+from comfy_client import output_files
+from comfy_pool import get_pool  # 共用 ComfyUI 連線；設定 COMFY_NODES 時分派到佇列最短的節點
+from file_delivery import send_output  # 依 OUTPUT_DELIVERY 交給 nginx/Apache 或由 Flask 串流（支援 Range）
 
 app = Flask(__name__)
 CORS(app)
@@ -30,6 +33,7 @@ CORS(app)
 # ComfyUI 伺服器與資料夾設定
 # ================================
 server_address    = "127.0.0.1:8188"  
+comfy = get_pool(os.getenv("COMFY_NODES") or server_address)
 comfyui_output_dir = r"D:\comfyui\ComfyUI_windows_portable\ComfyUI\output"
 target_dir         = r"D:\大模型圖生圖"
 temp_input_dir     = r"D:\大模型圖生圖\temp_input"
@@ -40,55 +44,24 @@ os.makedirs(temp_input_dir, exist_ok=True)
 EXTERNAL_URL = "https://image.picturesmagician.com"
 
 def queue_prompt(prompt):
-    client_id = str(uuid.uuid4())
-    payload = {"prompt": prompt, "client_id": client_id}
-    data = json.dumps(payload).encode("utf-8")
-    url = f"http://{server_address}/prompt"
     try:
-        req = urllib.request.Request(url, data=data, headers={"Content-Type":"application/json"})
-        with urllib.request.urlopen(req) as resp:
-            result = json.loads(resp.read())
-            result["client_id"] = client_id
-            return result
+        prompt_id = comfy.queue_prompt(prompt)
+        return {"prompt_id": prompt_id, "client_id": comfy.client_id}
     except Exception as e:
         print(f"❌ 無法連線至 ComfyUI API: {e}")
         return None
 
-def wait_for_completion(prompt_id, client_id):
-    ws_url = f"ws://{server_address}/ws?clientId={client_id}"
+def wait_for_completion(prompt_id, client_id=None):
     print("🕐 等待 ComfyUI 任務完成...")
     try:
-        ws = websocket.create_connection(ws_url)
-        while True:
-            out = ws.recv()
-            if isinstance(out, str):
-                msg = json.loads(out)
-                if msg.get("type") == "executing":
-                    data = msg.get("data", {})
-                    if data.get("node") is None and data.get("prompt_id") == prompt_id:
-                        print("✅ 任務已完成！")
-                        break
-        ws.close()
+        comfy.wait(prompt_id)
+        print("✅ 任務已完成！")
     except Exception as e:
-        print(f"❌ WebSocket 錯誤: {e}")
+        print(f"❌ WebSocket 連線錯誤: {e}")
 
 def get_history(prompt_id):
-    url = f"http://{server_address}/history/{prompt_id}"
-    try:
-        with urllib.request.urlopen(url) as resp:
-            history_data = json.loads(resp.read())
-        return history_data.get(prompt_id, {})
-    except Exception as e:
-        print(f"❌ 取得 history 錯誤: {e}")
-        return {}
-
-def find_latest_png():
-    pngs = [f for f in os.listdir(comfyui_output_dir) if f.lower().endswith(".png")]
-    if not pngs:
-        print("🚫 沒有找到 PNG 檔")
-        return None
-    latest = max(pngs, key=lambda f: os.path.getctime(os.path.join(comfyui_output_dir, f)))
-    return latest
+    outputs = comfy.outputs(prompt_id)  # 取自 executed 事件，必要時才查 /history
+    return {"outputs": outputs} if outputs else {}
 
 def get_final_image_filename(prompt_id):
     history = get_history(prompt_id)
@@ -99,7 +72,8 @@ def get_final_image_filename(prompt_id):
             fn = info.get("filename")
             if fn and fn.lower().endswith(".png"):
                 return fn
-    return find_latest_png()
+    files = output_files(comfy.outputs(prompt_id), exts=(".png",))
+    return files[0]["filename"] if files else None
 
 def move_output_files(prompt_id):
     fn = get_final_image_filename(prompt_id)
@@ -176,7 +150,7 @@ def image_to_image():
 }
 """.strip()
 
-    workflow = json.loads(workflow_template)
+    workflow = instantiate_text(workflow_template)
 
     # 套用使用者參數
     workflow["1"]["inputs"]["ckpt_name"]     = ckpt_name
@@ -210,7 +184,7 @@ def image_to_image():
 
 @app.route("/get_image/<filename>", methods=["GET"])
 def get_image(filename):
-    return send_from_directory(target_dir, filename)
+    return send_output(target_dir, filename, cache="revalidate")
 
 if __name__ == "__main__":
     app.run(host="0.0.0.0", port=5001, debug=False)
@@ -5,14 +5,18 @@ import os
 import time
 import uuid
 import json
-import base64
 import shutil
-import io
-import urllib.request
-import websocket  # pip install websocket-client
-from PIL import Image
-from flask import Flask, request, jsonify, send_from_directory
+from flask import Flask, request, jsonify
 from flask_cors import CORS
+import sys
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+from backend.workflows import instantiate_text
+from comfy_client import output_files
+from comfy_pool import get_pool  # 共用 ComfyUI 連線；設定 COMFY_NODES 時分派到佇列最短的節點
+from file_delivery import send_output  # 依 OUTPUT_DELIVERY 交給 nginx/Apache 或由 Flask 串流（支援 Range）
+import mask_crop  # 只把遮罩範圍裁切後送去重繪，完成後羽化貼回原圖
+from upload_stream import PayloadError, read_payload  # 邊讀邊解碼 Base64 圖片欄位，不把整個 JSON 載入記憶體
+from werkzeug.exceptions import NotFound
 
 app = Flask(__name__)
 CORS(app)
@@ -21,10 +25,15 @@ CORS(app)
 # ComfyUI 伺服器與資料夾設定
 # =============================
 server_address     = "127.0.0.1:8188"
+comfy = get_pool(os.getenv("COMFY_NODES") or server_address)
 comfyui_output_dir = r"D:\comfyui\ComfyUI_windows_portable\ComfyUI\output"
 temp_input_dir     = r"D:\大模型局部重繪\temp_input"
 target_dir_redraw  = r"D:\大模型局部重繪"
 EXTERNAL_URL       = "https://inpant.picturesmagician.com"
+# 裁切區域約縮放到模型原生的 INPAINT_RESOLUTION² 像素；邊界多留 padding 像素的上下文
+INPAINT_RESOLUTION   = int(os.getenv("INPAINT_RESOLUTION", "512"))
+INPAINT_CROP_PADDING = int(os.getenv("INPAINT_CROP_PADDING", "32"))
+INPAINT_FEATHER      = int(os.getenv("INPAINT_FEATHER", "8"))
 
 for d in (temp_input_dir, target_dir_redraw):
     os.makedirs(d, exist_ok=True)
@@ -166,99 +175,36 @@ workflow_redraw_template = r"""
 }
 """
 
-# =============================
-# 保存並縮放前端傳來的 Base64 圖片
-# =============================
-def save_base64_image(data_url, folder, prefix):
-    try:
-        header, encoded = data_url.split(",", 1)
-    except Exception:
-        return None, "無效的圖片資料"
-    ext = "png" if "png" in header else "jpg"
-    raw = base64.b64decode(encoded)
-    img = Image.open(io.BytesIO(raw))
-    if img.mode != "RGBA":
-        img = img.convert("RGBA")
-    img = img.resize((512, 512), Image.LANCZOS)
-    filename = f"{prefix}_{uuid.uuid4().hex}.{ext}"
-    path = os.path.join(folder, filename)
-    img.save(path)
-    return path, None
-
 # =============================
 # 排隊到 ComfyUI
 # =============================
 def queue_prompt(workflow):
-    client_id = str(uuid.uuid4())
-    payload   = {"prompt": workflow, "client_id": client_id}
-    data      = json.dumps(payload).encode("utf-8")
-    req = urllib.request.Request(
-        f"http://{server_address}/prompt",
-        data=data,
-        headers={"Content-Type": "application/json"}
-    )
-    with urllib.request.urlopen(req) as resp:
-        result = json.loads(resp.read().decode("utf-8"))
-    result["client_id"] = client_id
-    return result
+    prompt_id = comfy.queue_prompt(workflow)
+    return {"prompt_id": prompt_id, "client_id": comfy.client_id}
 
 # =============================
 # 等待 ComfyUI 完成
 # =============================
-def wait_for_completion(prompt_id, client_id):
-    ws = websocket.create_connection(f"ws://{server_address}/ws?clientId={client_id}")
-    while True:
-        out = ws.recv()
-        if isinstance(out, (bytes, bytearray)):
-            try:
-                out = out.decode("utf-8")
-            except Exception:
-                out = out.decode("latin-1", "ignore")
-        try:
-            msg = json.loads(out)
-        except Exception:
-            # 非 JSON 訊息（如 ping/pong）忽略
-            continue
-        if msg.get("type") == "executing":
-            data = msg.get("data", {})
-            if data.get("prompt_id") == prompt_id and data.get("node") is None:
-                break
-    ws.close()
+def wait_for_completion(prompt_id, client_id=None):
+    comfy.wait(prompt_id)
 
 # =============================
 # 取得 & 搬移結果檔案
 # =============================
-def find_latest_png(directory):
-    pngs = []
-    for root, _, files in os.walk(directory):
-        for fn in files:
-            if fn.lower().endswith(".png"):
-                pngs.append((os.path.getctime(os.path.join(root, fn)), fn))
-    return max(pngs, key=lambda x: x[0])[1] if pngs else None
-
 def get_final_image_filename(prompt_id):
-    url = f"http://{server_address}/history/{prompt_id}"
-    with urllib.request.urlopen(url) as resp:
-        hist = json.loads(resp.read().decode("utf-8")).get(prompt_id, {})
-    for nid in ("7",):
-        for info in hist.get("outputs", {}).get(nid, {}).get("images", []):
-            fn = info.get("filename")
-            if fn and fn.lower().endswith(".png"):
-                return fn
-    return find_latest_png(comfyui_output_dir)
+    """回傳輸出圖相對於 comfyui_output_dir 的路徑（含 subfolder），取自 executed 事件 / history。"""
+    outputs = comfy.outputs(prompt_id)
+    files = output_files(outputs, exts=(".png",), node_ids=("7",)) or output_files(outputs, exts=(".png",))
+    if not files:
+        return None
+    return os.path.join(files[0]["subfolder"], files[0]["filename"])
 
 def move_output_files(prompt_id, target_dir):
-    fn = get_final_image_filename(prompt_id)
-    if not fn:
+    rel = get_final_image_filename(prompt_id)
+    if not rel:
         raise FileNotFoundError("找不到輸出檔案")
-    src = os.path.join(comfyui_output_dir, fn)
-    if not os.path.exists(src):
-        for root, _, files in os.walk(comfyui_output_dir):
-            if fn in files:
-                src = os.path.join(root, fn)
-                break
-    dst = os.path.join(target_dir, fn)
-    shutil.move(src, dst)
+    fn = os.path.basename(rel)
+    shutil.move(os.path.join(comfyui_output_dir, rel), os.path.join(target_dir, fn))
     return fn
 
 # =============================
@@ -266,19 +212,29 @@ def move_output_files(prompt_id, target_dir):
 # =============================
 @app.route("/convert-image", methods=["POST"])
 def convert_image_endpoint():
-    data = request.get_json(force=True)
+    try:
+        data, images = read_payload(request, {"originalImage": "orig", "maskImage": "mask"}, temp_input_dir)
+    except PayloadError as e:
+        return jsonify({"error": str(e)}), e.status
     print("▶ 收到參數：")
-    for k in ("originalImage","maskImage","prompt","vaeName","checkpointName",
+    for k in ("originalImage","maskImage"):
+        print(f"  {k}: {images[k].describe() if k in images else None}")
+    for k in ("prompt","vaeName","checkpointName",
               "cfgScale","samplerName","scheduler","denoiseStrength","seed"):
         print(f"  {k}: {data.get(k)}")
 
-    if not data.get("originalImage") or not data.get("maskImage"):
+    if "originalImage" not in images or "maskImage" not in images:
         return jsonify({"error":"缺少原圖或遮罩圖"}), 400
 
-    orig_path, err = save_base64_image(data["originalImage"], temp_input_dir, "orig")
-    if err: return jsonify({"error": err}), 400
-    mask_path, err = save_base64_image(data["maskImage"],   temp_input_dir, "mask")
-    if err: return jsonify({"error": err}), 400
+    orig_path = images["originalImage"].path
+    mask_path = images["maskImage"].path
+    try:
+        crop = mask_crop.crop_for_inpaint(orig_path, mask_path, temp_input_dir,
+                                          resolution=INPAINT_RESOLUTION, padding=INPAINT_CROP_PADDING)
+    except (OSError, ValueError) as e:
+        return jsonify({"error": "無法讀取圖片或遮罩", "detail": str(e)}), 400
+    if crop is None:
+        return jsonify({"error": "遮罩為空"}), 400
 
     prompt_text  = data.get("prompt","").strip()
     vae_name     = data.get("vaeName","kl-f8-anime2.safetensors")
@@ -296,7 +252,7 @@ def convert_image_endpoint():
     if not prompt_text:
         return jsonify({"error":"提示詞為空"}), 400
 
-    wf = json.loads(workflow_redraw_template)
+    wf = instantiate_text(workflow_redraw_template)
     wf["1"]["inputs"]["ckpt_name"]    = ckpt_name
     wf["9"]["inputs"]["vae_name"]     = vae_name
     wf["2"]["inputs"]["text"]         = prompt_text
@@ -305,8 +261,8 @@ def convert_image_endpoint():
     wf["4"]["inputs"]["scheduler"]    = scheduler
     wf["4"]["inputs"]["denoise"]      = denoise
     wf["4"]["inputs"]["seed"]         = seed
-    wf["28"]["inputs"]["image_path"]  = orig_path
-    wf["29"]["inputs"]["image_path"]  = mask_path
+    wf["28"]["inputs"]["image_path"]  = crop.image_path
+    wf["29"]["inputs"]["image_path"]  = crop.mask_path
 
     print("🚀 發送工作流程至 ComfyUI：")
     print(json.dumps(wf, indent=2, ensure_ascii=False))
@@ -316,6 +272,8 @@ def convert_image_endpoint():
     wait_for_completion(pid, cid)
     time.sleep(2)
     fn = move_output_files(pid, target_dir_redraw)
+    out = os.path.join(target_dir_redraw, fn)
+    mask_crop.composite(crop, out, out, feather=INPAINT_FEATHER)
 
     url = f"{EXTERNAL_URL}/get_image/{fn}?t={int(time.time())}"
     return jsonify({"image_url": url})
@@ -325,10 +283,10 @@ def convert_image_endpoint():
 # =============================
 @app.route("/get_image/<filename>", methods=["GET"])
 def get_image(filename):
-    p = os.path.join(target_dir_redraw, filename)
-    if os.path.exists(p):
-        return send_from_directory(target_dir_redraw, filename)
-    return "檔案不存在", 404
+    try:
+        return send_output(target_dir_redraw, filename, cache="revalidate")
+    except NotFound:
+        return "檔案不存在", 404
 
 if __name__ == "__main__":
     app.run(host="0.0.0.0", port=5002, debug=False)
@@ -1,13 +1,8 @@
-import json
 import os
 import shutil
 import time
-import uuid
-import urllib.request
-from urllib.error import HTTPError
 
-import websocket  # 請先安裝：pip install websocket-client
-from flask import Flask, request, jsonify, send_from_directory, Response
+from flask import Flask, request, jsonify, Response
 from flask_cors import CORS
 from collections import OrderedDict
 from werkzeug.middleware.proxy_fix import ProxyFix
@@ -20,6 +15,13 @@ from config import (
     EXTERNAL_URL,
     ALLOWED_ORIGINS
 )
+import sys
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+from backend.workflows import instantiate_text
+from comfy_client import ComfyError, output_files
+from comfy_pool import get_pool  # 共用 ComfyUI 連線；設定 COMFY_NODES 時分派到佇列最短的節點
+from file_delivery import send_output  # 依 OUTPUT_DELIVERY 交給 nginx/Apache 或由 Flask 串流（支援 Range）
+from werkzeug.exceptions import NotFound
 
 app = Flask(__name__)
 
@@ -68,8 +70,8 @@ processing_requests = OrderedDict()
 # 與 ComfyUI 溝通的函式
 # =============================
 
-# 確保這個 client_id 要能讓 WebSocket 連線使用
-client_id = str(uuid.uuid4())
+# 共用 ComfyUI client：整個程序共用一條 WebSocket 與 HTTP keep-alive 連線
+comfy = get_pool(os.getenv("COMFY_NODES") or COMFYUI_API_URL.split("://", 1)[-1].rstrip("/"))
 
 
 def queue_prompt(user_prompt: str):
@@ -125,48 +127,23 @@ def queue_prompt(user_prompt: str):
         }
     }
 
-    # 2. 包裝成 ComfyUI /prompt API 要求的格式
-    payload = {
-        "prompt": workflow_graph,
-        "client_id": client_id
-    }
-
-    # 3. 送到 ComfyUI
+    # 2. 透過共用連線送到 ComfyUI
     try:
-        req = urllib.request.Request(
-            f"{COMFYUI_API_URL}/prompt",               # 正確端點
-            # 包裹 workflow_graph 與 client_id
-            data=json.dumps(payload).encode("utf-8"),
-            headers={"Content-Type": "application/json"}
-        )
-        with urllib.request.urlopen(req) as resp:
-            result = json.loads(resp.read())
-        # 範例回傳：{"prompt_id":123,"number":1}
-        return result
-    except HTTPError as e:
-        error_body = e.read().decode("utf-8", errors="ignore")
-        app.logger.error(f"ComfyUI 400 回應：{error_body}")
+        prompt_id = comfy.queue_prompt(workflow_graph)
+        return {"prompt_id": prompt_id, "client_id": comfy.client_id}
+    except ComfyError as e:
+        app.logger.error(f"ComfyUI {e.status} 回應：{e.body}")
         return None
 
 
-def wait_for_completion(prompt_id, client_id):
+def wait_for_completion(prompt_id, client_id=None):
     """
-    建立 WebSocket 連線等待指定 prompt_id 任務完成
+    在共用 WebSocket 上等待指定 prompt_id 任務完成
     """
-    ws_url = f"ws://127.0.0.1:8188/ws?clientId={client_id}"
     print("🕐 等待 ComfyUI 任務完成...")
     try:
-        ws = websocket.create_connection(ws_url)
-        while True:
-            out = ws.recv()
-            if isinstance(out, str):
-                message = json.loads(out)
-                if message.get("type") == "executing":
-                    data = message.get("data", {})
-                    if data.get("node") is None and data.get("prompt_id") == prompt_id:
-                        print("✅ 任務已完成！")
-                        break
-        ws.close()
+        comfy.wait(prompt_id)
+        print("✅ 任務已完成！")
     except Exception as e:
         print(f"❌ WebSocket 連線錯誤: {e}")
 
@@ -175,42 +152,19 @@ def get_history(prompt_id):
     """
     透過 /history/<prompt_id> API 取得 ComfyUI 任務輸出紀錄
     """
-    url = f"http://127.0.0.1:8188/history/{prompt_id}"
-    try:
-        with urllib.request.urlopen(url) as resp:
-            history_data = json.loads(resp.read())
-        print(
-            f"📜 history API 回應: {json.dumps(history_data, indent=4, ensure_ascii=False)}")
-        return history_data.get(prompt_id, {})
-    except Exception as e:
-        print(f"❌ 無法取得歷史紀錄: {e}")
-        return {}
-
-
-def find_latest_png():
-    """
-    若 /history API 沒有提供檔名，則在 comfyui_output_dir 搜尋最新的 .png 檔案
-    """
-    png_files = [f for f in os.listdir(
-        comfyui_output_dir) if f.lower().endswith(".png")]
-    if not png_files:
-        print("🚫 找不到任何 .png 檔案！")
-        return None
-    latest_png = max(png_files, key=lambda f: os.path.getctime(
-        os.path.join(comfyui_output_dir, f)))
-    print(f"🎞 找到最新的 .png 檔案: {latest_png}")
-    return latest_png
+    outputs = comfy.outputs(prompt_id)  # 取自 executed 事件，必要時才查 /history
+    return {"outputs": outputs} if outputs else {}
 
 
 def get_final_image_filename(prompt_id):
     """
     從 /history/<prompt_id> 中找出最終輸出的圖片檔名，
-    如未找到則使用 find_latest_png()
+    如未找到則改用其他輸出節點的檔案
     """
     history = get_history(prompt_id)
     if not history:
-        print("⚠️ history API 回應為空，改用檔案搜尋。")
-        return find_latest_png()
+        print("⚠️ history API 回應為空。")
+        return None
 
     outputs = history.get("outputs", {})
     image_node = outputs.get("7", {})
@@ -221,8 +175,9 @@ def get_final_image_filename(prompt_id):
                 print(f"🎞 從 API 取得圖片檔名: {filename}")
                 return filename
 
-    print("⚠️ history API 未提供圖片檔名，改用檔案搜尋。")
-    return find_latest_png()
+    print("⚠️ history API 未提供圖片檔名，改用其他輸出節點。")
+    files = output_files(comfy.outputs(prompt_id), exts=(".png",))
+    return files[0]["filename"] if files else None
 
 
 def move_output_files(prompt_id):
@@ -349,8 +304,8 @@ def generate_image_endpoint():
 }
 """
     try:
-        prompt = json.loads(prompt_text)
-    except json.JSONDecodeError as e:
+        prompt = instantiate_text(prompt_text)
+    except ValueError as e:
         return jsonify({"error": "工作流程 JSON 格式錯誤", "details": str(e)}), 500
 
     # ——— 把映射後的 checkpoint 與 vae 寫入 workflow JSON ———
@@ -368,21 +323,7 @@ def generate_image_endpoint():
     print("🚀 發送工作流程到 ComfyUI...")
 
 
-    # 原本是直接拿到 JSON dict
-    # resp_data = queue_prompt(prompt)
-    # 改成拿到 response 物件
-    response = queue_prompt(prompt)
-
-    # 1. 檢查 HTTP 狀態
-    if response.status_code != 200:
-    # 整包文字一起丟出來看錯誤
-        raise RuntimeError(
-            f"ComfyUI API 錯誤：{response.status_code} {response.text}")
-
-    # 2. 解析 JSON
-    resp_data = response.json()
-
-    # 3. 印出來看看裡面到底長什麼樣
+    resp_data = queue_prompt(prompt)
     print("🔍 ComfyUI 回傳原始資料：", resp_data)
 
     if not resp_data or "prompt_id" not in resp_data:
@@ -411,11 +352,12 @@ def get_image(filename):
     """
     提供搬移後的圖片檔案下載或顯示。如果檔案不存在，回傳 404
     """
-    file_path = os.path.join(target_dir, filename)
-    if not os.path.exists(file_path):
-        print(f"⚠️ 找不到檔案: {file_path}")
+    try:
+        # 檔名含時間戳記，不會重複使用
+        return send_output(target_dir, filename)
+    except NotFound:
+        print(f"⚠️ 找不到檔案: {os.path.join(target_dir, filename)}")
         return jsonify({"error": "檔案不存在"}), 404
-    return send_from_directory(target_dir, filename)
 
 
 if __name__ == "__main__":
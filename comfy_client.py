@@ -1,46 +1,628 @@
 import json
 import uuid
-import urllib.request
-import websocket
+import time
+import hashlib
 import logging
+import mimetypes
 import os
+import shutil
+import struct
+import threading
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional
+from urllib.parse import urlencode
+
+import requests
+import websocket
+
+
+# How many unclaimed prompt ids we keep events for (prompt finished before
+# the submitter registered its waiter, or nobody waits for it at all).
+_ORPHAN_LIMIT = 256
+
+# Output lists that reference files in an ``executed`` payload / /history entry.
+_FILE_KEYS = ("images", "gifs", "videos", "audio", "files")
+
+# Content hashes of images already uploaded to a host (per client).
+_UPLOAD_CACHE_LIMIT = 2048
+# Sub-folder of ComfyUI's input directory used for uploaded images.
+UPLOAD_SUBFOLDER = "web"
+
+# Events that carry a prompt_id and are routed to per-prompt waiters.
+_PROMPT_EVENTS = {
+    "execution_start",
+    "execution_cached",
+    "executing",
+    "progress",
+    "executed",
+    "execution_success",
+    "execution_error",
+    "execution_interrupted",
+}
+
+# Binary WebSocket frames: 4-byte big-endian event type, then the payload.
+# PREVIEW_IMAGE is <4-byte image type><image>; the metadata variant is
+# <4-byte length><JSON with prompt_id/node_id/image_type><image>.
+_BIN_PREVIEW_IMAGE = 1
+_BIN_PREVIEW_IMAGE_WITH_METADATA = 4
+_PREVIEW_FORMATS = {1: "jpeg", 2: "png"}
+
+
+class ComfyError(Exception):
+    """ComfyUI rejected a prompt or reported an execution failure."""
+
+    def __init__(self, message, status=None, reason=None, body=None, detail=None):
+        super().__init__(message)
+        self.status = status
+        self.reason = reason
+        self.body = body
+        self.detail = detail or {}
+
+
+class HostDown(ComfyError):
+    """The ComfyUI host stopped answering while a prompt was in flight."""
+
+
+class UploadedImage:
+    """An image stored in a ComfyUI host's input directory."""
+
+    __slots__ = ("name", "subfolder", "digest", "url")
+
+    def __init__(self, name, subfolder, digest, url):
+        self.name = name
+        self.subfolder = subfolder
+        self.digest = digest
+        self.url = url
+
+    @property
+    def ref(self):
+        """Value for ``LoadImage.image`` (``subfolder/name`` inside the input dir)."""
+        return f"{self.subfolder}/{self.name}" if self.subfolder else self.name
+
+    def __repr__(self):
+        return f"UploadedImage({self.ref!r})"
+
+
+def file_digest(path, chunk_size=1 << 16):
+    """SHA-256 hex digest of a file, read in chunks."""
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class _PromptWaiter:
+    def __init__(self, prompt_id):
+        self.prompt_id = prompt_id
+        self.done = threading.Event()
+        self.wake = threading.Event()  # set on completion or when the socket drops
+        self.outputs: Dict[str, Dict] = {}
+        self.error: Optional[Dict] = None
+        self.last_event: Optional[Dict] = None
+        self.listeners: List[Callable[[str, Dict], None]] = []
+
 
 class ComfyClient:
-    def __init__(self, addr, output_dir):
+    """Process-wide client for a single ComfyUI host.
+
+    One long-lived WebSocket (a single clientId) is shared by every prompt this
+    process submits; a reader thread routes ``executing``/``progress``/
+    ``executed`` events to per-prompt waiters by ``prompt_id``, and binary
+    latent previews to the listeners of the prompt they belong to as
+    ``("preview", {prompt_id, node, format, image})``.  HTTP calls go
+    through a pooled keep-alive ``requests.Session``.  Use ``get_client(addr)``
+    rather than constructing instances directly.
+    """
+
+    def __init__(self, addr, output_dir=None, pool_size=16, ping_interval=30.0, reconnect_delay=2.0,
+                 failover_after=20.0):
         self.addr = addr
         self.output_dir = output_dir
+        self.client_id = str(uuid.uuid4())
+        self.ping_interval = ping_interval
+        self.reconnect_delay = reconnect_delay
+        # A prompt is given up on (HostDown) once the socket has been down this
+        # long and /history is unreachable too.
+        self.failover_after = failover_after
         self.logger = logging.getLogger(__name__)
 
-    def send_prompt(self, workflow):
-        client_id = str(uuid.uuid4())
-        payload = {"prompt": workflow, "client_id": client_id}
-        data = json.dumps(payload).encode("utf-8")
-        req = urllib.request.Request(f"http://{self.addr}/prompt", data=data)
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+        self.queue_remaining: Optional[int] = None
+        # Prompt the host is executing (plain preview frames carry no prompt_id)
+        self._running: Optional[str] = None
+        self._lock = threading.Lock()
+        self._waiters: Dict[str, _PromptWaiter] = {}
+        self._orphans: "OrderedDict[str, List[Dict]]" = OrderedDict()
+        self._results: "OrderedDict[str, Dict[str, Dict]]" = OrderedDict()
+        self._uploads: "OrderedDict[str, UploadedImage]" = OrderedDict()
+        self._ws = None
+        self._connected = threading.Event()
+        self._down_since: Optional[float] = None
+        self._reader: Optional[threading.Thread] = None
+        self._closed = False
+
+    # ------------------------------------------------------------------
+    # HTTP
+    # ------------------------------------------------------------------
+    def url(self, path):
+        return f"http://{self.addr}{path}"
+
+    def get_json(self, path, timeout=8, **kwargs):
+        r = self.session.get(self.url(path), timeout=timeout, **kwargs)
+        r.raise_for_status()
+        return r.json()
+
+    def post_json(self, path, payload, timeout=15):
+        r = self.session.post(self.url(path), json=payload, timeout=timeout)
+        if r.status_code >= 400:
+            raise ComfyError(
+                f"ComfyUI {path} returned {r.status_code}",
+                status=r.status_code,
+                reason=r.reason,
+                body=r.text,
+            )
+        try:
+            return r.json()
+        except ValueError:
+            return {}
+
+    def history(self, prompt_id):
+        return self.get_json(f"/history/{prompt_id}").get(prompt_id, {})
+
+    def object_info(self, timeout=5):
+        return self.get_json("/object_info", timeout=timeout)
+
+    def queue_position(self, prompt_id, timeout=3):
+        """0 while ``prompt_id`` runs, its 1-based place among pending prompts, else None."""
+        q = self.get_json("/queue", timeout=timeout)
+        # Entries are [number, prompt_id, prompt, extra_data, outputs]
+        if any(len(e) > 1 and e[1] == prompt_id for e in q.get("queue_running") or []):
+            return 0
+        pending = sorted((e for e in q.get("queue_pending") or [] if len(e) > 1), key=lambda e: e[0])
+        for i, entry in enumerate(pending, 1):
+            if entry[1] == prompt_id:
+                return i
+        return None
+
+    # ------------------------------------------------------------------
+    # Prompts
+    # ------------------------------------------------------------------
+    def queue_prompt(self, workflow, listener=None, extra=None):
+        """Submit a workflow and register a waiter for it; returns prompt_id."""
+        self.ensure_connected()
+        payload = dict(extra or {}, prompt=workflow, client_id=self.client_id)
         self.logger.debug(">>> ComfyUI payload:\n%s", json.dumps(payload, ensure_ascii=False))
-        resp = urllib.request.urlopen(req)
-        prompt_id = json.loads(resp.read())["prompt_id"]
-        return prompt_id, client_id
+        result = self.post_json("/prompt", payload)
+        prompt_id = result.get("prompt_id")
+        if not prompt_id:
+            raise ComfyError("ComfyUI /prompt returned no prompt_id", body=json.dumps(result, ensure_ascii=False))
+        self._register(prompt_id, listener)
+        return prompt_id
+
+    def cancel(self, prompt_id):
+        """Stop ``prompt_id``: drop it from the queue, or interrupt it if it is running.
+
+        Its waiter is released with an ``execution_interrupted`` error so a
+        blocked ``wait()`` returns at once.  Returns True when ComfyUI was told.
+        """
+        told = False
+        try:
+            self.post_json("/queue", {"delete": [prompt_id]})
+            if self.queue_position(prompt_id) == 0:
+                # Newer ComfyUI only interrupts when prompt_id is the running one
+                self.post_json("/interrupt", {"prompt_id": prompt_id})
+            told = True
+        except Exception as e:
+            self.logger.warning("Cancelling ComfyUI prompt %s on %s failed: %s", prompt_id, self.addr, e)
+        with self._lock:
+            waiter = self._waiters.get(prompt_id)
+        if waiter is not None:
+            waiter.error = {"type": "execution_interrupted", "prompt_id": prompt_id, "exception_message": "cancelled"}
+            waiter.done.set()
+            waiter.wake.set()
+        return told
+
+    def add_listener(self, prompt_id, listener):
+        """Call ``listener(event_type, data)`` for every event of ``prompt_id``."""
+        self._register(prompt_id, listener)
+
+    def wait(self, prompt_id, timeout=None, poll=30.0):
+        """Block until ``prompt_id`` finishes; returns ``{prompt_id, outputs}``.
+
+        Outputs are collected from ``executed`` events (node id -> output).  If
+        the socket dropped while waiting, ``/history`` is consulted instead so a
+        completion delivered during the gap is not lost.  Raises ``HostDown``
+        when the host stays unreachable for ``failover_after`` seconds.
+        """
+        waiter = self._register(prompt_id)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        last_sync = time.monotonic()
+        try:
+            while not waiter.done.is_set():
+                slice_ = poll if self.connected else min(poll, self.reconnect_delay)
+                if deadline is not None:
+                    slice_ = max(0.0, min(slice_, deadline - time.monotonic()))
+                waiter.wake.wait(slice_)
+                waiter.wake.clear()
+                if waiter.done.is_set():
+                    break
+                # Before the poll shortcut: once slice_ is 0 it would otherwise spin until the next sync
+                timed_out = deadline is not None and time.monotonic() >= deadline
+                if self.connected and not timed_out and time.monotonic() - last_sync < poll:
+                    continue
+                last_sync = time.monotonic()
+                if not self._resync_one(waiter) and self.down_for() >= self.failover_after:
+                    raise HostDown(
+                        f"ComfyUI {self.addr} unreachable for {self.down_for():.0f}s",
+                        detail={"prompt_id": prompt_id, "addr": self.addr, "last_event": waiter.last_event},
+                    )
+                if timed_out and not waiter.done.is_set():
+                    err = TimeoutError(f"ComfyUI prompt {prompt_id} did not finish in {timeout}s")
+                    err.last_event = waiter.last_event
+                    raise err
+            if waiter.error is not None:
+                raise ComfyError(
+                    waiter.error.get("exception_message") or "ComfyUI execution failed",
+                    detail=waiter.error,
+                )
+            outputs = dict(waiter.outputs)
+            with self._lock:
+                self._results[prompt_id] = outputs
+                while len(self._results) > _ORPHAN_LIMIT:
+                    self._results.popitem(last=False)
+            return {"prompt_id": prompt_id, "outputs": outputs}
+        finally:
+            self.release(prompt_id)
+
+    def outputs(self, prompt_id):
+        """Node outputs of a finished prompt (from ``executed`` events, else /history)."""
+        with self._lock:
+            cached = self._results.get(prompt_id)
+        if cached:
+            return cached
+        try:
+            return self.history(prompt_id).get("outputs") or {}
+        except Exception:
+            return {}
+
+    def output_path(self, record):
+        """Local path of an output file record, or None if it lives elsewhere."""
+        if not self.output_dir or (record.get("type") or "output") != "output":
+            return None
+        return os.path.join(self.output_dir, record.get("subfolder") or "", record["filename"])
+
+    def fetch_output(self, record, dest):
+        """Move an output file to ``dest``; downloads it via /view if it is not local."""
+        src = self.output_path(record)
+        if src and os.path.exists(src):
+            shutil.move(src, dest)
+            return dest
+        params = {
+            "filename": record["filename"],
+            "subfolder": record.get("subfolder") or "",
+            "type": record.get("type") or "output",
+        }
+        with self.session.get(self.url("/view"), params=params, stream=True, timeout=60) as r:
+            r.raise_for_status()
+            with open(dest, "wb") as f:
+                for chunk in r.iter_content(chunk_size=1 << 16):
+                    f.write(chunk)
+        return dest
+
+    # ------------------------------------------------------------------
+    # Inputs
+    # ------------------------------------------------------------------
+    def upload_image(self, path, subfolder=UPLOAD_SUBFOLDER, digest=None):
+        """Store a local image in ComfyUI's input directory via /upload/image.
+
+        Files are named by their SHA-256, so an image this host already has
+        (e.g. a person photo reused across try-ons) is not sent again.
+        """
+        digest = digest or file_digest(path)
+        with self._lock:
+            cached = self._uploads.get(digest)
+            if cached is not None:
+                self._uploads.move_to_end(digest)
+                return cached
+
+        ext = os.path.splitext(path)[1].lower() or ".png"
+        name = f"{digest}{ext}"
+        image = UploadedImage(name, subfolder, digest, self._input_url(name, subfolder))
+        if not self._input_exists(name, subfolder):
+            mime = mimetypes.guess_type(name)[0] or "application/octet-stream"
+            with open(path, "rb") as f:
+                r = self.session.post(
+                    self.url("/upload/image"),
+                    files={"image": (name, f, mime)},
+                    data={"subfolder": subfolder, "type": "input", "overwrite": "true"},
+                    timeout=60,
+                )
+            if r.status_code >= 400:
+                raise ComfyError(
+                    f"ComfyUI /upload/image returned {r.status_code}",
+                    status=r.status_code,
+                    reason=r.reason,
+                    body=r.text,
+                )
+            stored = r.json()
+            name, subfolder = stored.get("name") or name, stored.get("subfolder", subfolder)
+            image = UploadedImage(name, subfolder, digest, self._input_url(name, subfolder))
+
+        with self._lock:
+            self._uploads[digest] = image
+            while len(self._uploads) > _UPLOAD_CACHE_LIMIT:
+                self._uploads.popitem(last=False)
+        return image
+
+    def _input_url(self, name, subfolder):
+        query = urlencode({"filename": name, "subfolder": subfolder, "type": "input"})
+        return f"{self.url('/view')}?{query}"
+
+    def _input_exists(self, name, subfolder):
+        """True if the input file is already on the host (other worker, earlier run)."""
+        try:
+            params = {"filename": name, "subfolder": subfolder, "type": "input"}
+            with self.session.get(self.url("/view"), params=params, stream=True, timeout=5) as r:
+                return r.status_code == 200
+        except requests.RequestException:
+            return False
+
+    def release(self, prompt_id):
+        with self._lock:
+            self._waiters.pop(prompt_id, None)
+
+    def _register(self, prompt_id, listener=None):
+        with self._lock:
+            waiter = self._waiters.get(prompt_id)
+            if waiter is None:
+                waiter = self._waiters[prompt_id] = _PromptWaiter(prompt_id)
+            if listener is not None:
+                waiter.listeners.append(listener)
+            backlog = self._orphans.pop(prompt_id, [])
+        for msg in backlog:
+            self._apply(waiter, msg)
+        return waiter
+
+    # ------------------------------------------------------------------
+    # WebSocket reader
+    # ------------------------------------------------------------------
+    def ensure_connected(self, timeout=10.0):
+        with self._lock:
+            if self._reader is None or not self._reader.is_alive():
+                self._closed = False
+                self._reader = threading.Thread(
+                    target=self._read_loop, name=f"comfy-ws-{self.addr}", daemon=True
+                )
+                self._reader.start()
+        if not self._connected.wait(timeout):
+            raise ConnectionError(f"ComfyUI WebSocket {self.addr} not reachable")
+
+    @property
+    def connected(self):
+        return self._connected.is_set()
+
+    def down_for(self):
+        """Seconds since the WebSocket was lost (0 while connected)."""
+        since = self._down_since
+        return 0.0 if since is None or self.connected else time.monotonic() - since
+
+    def close(self):
+        self._closed = True
+        ws = self._ws
+        if ws is not None:
+            try:
+                ws.close()
+            except Exception:
+                pass
+        self.session.close()
+
+    def _read_loop(self):
+        ws_url = f"ws://{self.addr}/ws?clientId={self.client_id}"
+        while not self._closed:
+            try:
+                ws = websocket.create_connection(ws_url, timeout=10)
+                ws.settimeout(self.ping_interval)
+                self._ws = ws
+                self._connected.set()
+                self._down_since = None
+                self.logger.info("ComfyUI WebSocket connected: %s", self.addr)
+                self._resync_all()
+                while not self._closed:
+                    try:
+                        frame = ws.recv()
+                    except websocket.WebSocketTimeoutException:
+                        ws.ping()
+                        continue
+                    if isinstance(frame, str):
+                        self._dispatch(json.loads(frame))
+                    elif frame:
+                        self._dispatch_binary(frame)
+            except Exception as e:
+                if not self._closed:
+                    log = self.logger.warning if self._connected.is_set() or self._down_since is None else self.logger.debug
+                    log("ComfyUI WebSocket %s dropped: %s", self.addr, e)
+            finally:
+                if self._connected.is_set() or self._down_since is None:
+                    self._down_since = time.monotonic()
+                self._connected.clear()
+                with self._lock:
+                    pending = list(self._waiters.values())
+                for waiter in pending:
+                    waiter.wake.set()
+                ws, self._ws = self._ws, None
+                if ws is not None:
+                    try:
+                        ws.close()
+                    except Exception:
+                        pass
+            if not self._closed:
+                time.sleep(self.reconnect_delay)
+
+    def _dispatch(self, msg):
+        mtype = msg.get("type")
+        data = msg.get("data") or {}
+        if mtype == "status":
+            try:
+                self.queue_remaining = int(data["status"]["exec_info"]["queue_remaining"])
+            except Exception:
+                pass
+            return
+        if mtype not in _PROMPT_EVENTS:
+            return
+        prompt_id = data.get("prompt_id")
+        if not prompt_id:
+            return
+        if mtype == "execution_start" or (mtype == "executing" and data.get("node") is not None):
+            self._running = prompt_id
+        elif self._running == prompt_id and mtype in ("executing", "execution_success", "execution_error",
+                                                       "execution_interrupted"):
+            self._running = None
+        with self._lock:
+            waiter = self._waiters.get(prompt_id)
+            if waiter is None:
+                self._orphans.setdefault(prompt_id, []).append(msg)
+                self._orphans.move_to_end(prompt_id)
+                while len(self._orphans) > _ORPHAN_LIMIT:
+                    self._orphans.popitem(last=False)
+                return
+        self._apply(waiter, msg)
+
+    def _dispatch_binary(self, frame):
+        """Hand a latent preview to its prompt's listeners; other binary frames are ignored."""
+        if len(frame) < 8:
+            return
+        (etype,) = struct.unpack(">I", frame[:4])
+        node = None
+        prompt_id = self._running
+        if etype == _BIN_PREVIEW_IMAGE:
+            fmt = _PREVIEW_FORMATS.get(struct.unpack(">I", frame[4:8])[0], "jpeg")
+            image = frame[8:]
+        elif etype == _BIN_PREVIEW_IMAGE_WITH_METADATA:
+            (size,) = struct.unpack(">I", frame[4:8])
+            try:
+                meta = json.loads(frame[8:8 + size])
+            except ValueError:
+                return
+            prompt_id = meta.get("prompt_id") or prompt_id
+            node = meta.get("node_id")
+            fmt = str(meta.get("image_type") or "image/jpeg").rpartition("/")[2]
+            image = frame[8 + size:]
+        else:
+            return
+        with self._lock:
+            waiter = self._waiters.get(prompt_id) if prompt_id else None
+        if waiter is None or not image:
+            return
+        data = {"prompt_id": prompt_id, "node": node, "format": fmt, "image": image}
+        for fn in list(waiter.listeners):
+            try:
+                fn("preview", data)
+            except Exception:
+                self.logger.exception("ComfyUI preview listener failed for %s", prompt_id)
+
+    def _apply(self, waiter, msg):
+        mtype = msg.get("type")
+        data = msg.get("data") or {}
+        waiter.last_event = msg
+        if mtype == "executed" and data.get("node") is not None:
+            waiter.outputs[str(data["node"])] = data.get("output") or {}
+        elif mtype in ("execution_error", "execution_interrupted"):
+            waiter.error = dict(data, type=mtype)
+        for fn in list(waiter.listeners):
+            try:
+                fn(mtype, data)
+            except Exception:
+                self.logger.exception("ComfyUI listener failed for %s", waiter.prompt_id)
+        finished = (
+            (mtype == "executing" and data.get("node") is None)
+            or mtype in ("execution_success", "execution_error", "execution_interrupted")
+        )
+        if finished:
+            waiter.done.set()
+            waiter.wake.set()
+
+    def _resync_all(self):
+        with self._lock:
+            pending = [w for w in self._waiters.values() if not w.done.is_set()]
+        for waiter in pending:
+            self._resync_one(waiter)
+
+    def _resync_one(self, waiter):
+        """Complete ``waiter`` from /history if ComfyUI already finished it.
+
+        Returns False if the host could not be reached.
+        """
+        try:
+            entry = self.history(waiter.prompt_id)
+        except Exception:
+            return False
+        if not entry:
+            return True
+        status = entry.get("status") or {}
+        if status and not status.get("completed", True) and status.get("status_str") == "error":
+            waiter.error = {"type": "execution_error", "prompt_id": waiter.prompt_id, "status": status}
+        for nid, out in (entry.get("outputs") or {}).items():
+            waiter.outputs.setdefault(str(nid), out or {})
+        waiter.done.set()
+        waiter.wake.set()
+        return True
+
+    # ------------------------------------------------------------------
+    # Legacy per-call API
+    # ------------------------------------------------------------------
+    def send_prompt(self, workflow):
+        return self.queue_prompt(workflow), self.client_id
 
     def wait_done(self, client_id, prompt_id):
-        ws = websocket.create_connection(f"ws://{self.addr}/ws?clientId={client_id}")
-        while True:
-            msg = json.loads(ws.recv())
-            data = msg.get("data", {})
-            if msg.get("type") == "executing" \
-               and data.get("node") is None \
-               and data.get("prompt_id") == prompt_id:
-                break
-        ws.close()
-
-    def fetch_latest(self, since_ts):
-        new_files = []
-        for fn in os.listdir(self.output_dir):
-            if not fn.lower().endswith(".png"):
-                continue
-            full = os.path.join(self.output_dir, fn)
-            if os.path.getctime(full) >= since_ts:
-                new_files.append(full)
-        if not new_files:
-            raise FileNotFoundError("找不到本次執行的輸出圖")
-        return max(new_files, key=lambda p: os.path.getctime(p))
+        self.wait(prompt_id)
+
+
+def output_files(outputs, exts=None, node_ids=None):
+    """Flatten node outputs into ``{node, filename, subfolder, type}`` records.
+
+    Saved (``type == "output"``) files come before previews/temp files, and
+    within each group the most recently executed node comes first, so
+    ``records[0]`` is the final result of a workflow.
+    """
+    records = []
+    for nid, out in (outputs or {}).items():
+        if node_ids is not None and str(nid) not in node_ids:
+            continue
+        for key in _FILE_KEYS:
+            for item in (out or {}).get(key) or []:
+                if not isinstance(item, dict) or not item.get("filename"):
+                    continue
+                if exts and not item["filename"].lower().endswith(tuple(exts)):
+                    continue
+                records.append({
+                    "node": str(nid),
+                    "filename": item["filename"],
+                    "subfolder": item.get("subfolder") or "",
+                    "type": item.get("type") or "output",
+                })
+    records.reverse()
+    return [r for r in records if r["type"] == "output"] + [r for r in records if r["type"] != "output"]
+
+
+_clients: Dict[str, ComfyClient] = {}
+_clients_lock = threading.Lock()
+
+
+def get_client(addr, output_dir=None):
+    """Return the shared ``ComfyClient`` for ``addr``, creating it on first use.
 
+    Clients are created lazily so each pre-forked gunicorn worker opens its
+    own socket after the fork.
+    """
+    with _clients_lock:
+        client = _clients.get(addr)
+        if client is None:
+            client = _clients[addr] = ComfyClient(addr, output_dir)
+        elif output_dir and not client.output_dir:
+            client.output_dir = output_dir
+        return client
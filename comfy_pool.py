@@ -0,0 +1,336 @@
+"""Pool of ComfyUI hosts with capability-aware, queue-depth-aware scheduling.
+
+Nodes are configured as ``addr`` or ``addr=tag+tag`` entries, comma separated
+(``COMFY_NODES="10.0.0.2:8188=animatediff+controlnet,10.0.0.3:8188"``).  A
+background thread polls every node's ``/queue`` (and, less often,
+``/object_info``) so the scheduler can send a workflow to the healthy host
+with the shortest queue that has every node class and model it uses.  If a
+host drops while a prompt is running, the prompt is resubmitted elsewhere.
+"""
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, FrozenSet, Iterable, List, Optional, Tuple
+
+import requests
+
+from comfy_client import ComfyClient, ComfyError, HostDown, get_client
+
+
+logger = logging.getLogger(__name__)
+
+_LOOPBACK_HOSTS = ("127.0.0.1", "localhost", "::1")
+# Prompts submitted through the ComfyClient-style facade we keep routing for
+_ROUTE_LIMIT = 1024
+
+
+class NoNodeAvailable(ComfyError):
+    """No healthy ComfyUI host can run the workflow."""
+
+
+def parse_nodes(spec: str) -> List[Tuple[str, FrozenSet[str]]]:
+    """``"a:8188=animatediff+controlnet,b:8188"`` -> ``[(addr, tags), ...]``."""
+    nodes = []
+    for entry in (spec or "").split(","):
+        entry = entry.strip()
+        if not entry:
+            continue
+        addr, _, tags = entry.partition("=")
+        nodes.append((addr.strip(), frozenset(t.strip().lower() for t in tags.split("+") if t.strip())))
+    return nodes
+
+
+def workflow_requirements(workflow: Dict) -> Tuple[FrozenSet[str], Dict[Tuple[str, str], str]]:
+    """Node classes a workflow uses and the model names (``*_name`` inputs) it selects."""
+    classes = set()
+    models = {}
+    for node in workflow.values():
+        if not isinstance(node, dict) or "class_type" not in node:
+            continue
+        ctype = node["class_type"]
+        classes.add(ctype)
+        for key, value in (node.get("inputs") or {}).items():
+            if key.endswith("_name") and isinstance(value, str):
+                models[(ctype, key)] = value
+    return frozenset(classes), models
+
+
+class ComfyNode:
+    """One ComfyUI host as seen by the scheduler."""
+
+    def __init__(self, client: ComfyClient, tags: Iterable[str] = ()):
+        self.client = client
+        self.addr = client.addr
+        self.tags = frozenset(tags)
+        self.healthy = False
+        self.checked_at = 0.0
+        self.error: Optional[str] = None
+        self.queue_depth = 0
+        self.submitted = 0  # prompts sent since the last /queue poll
+        self.class_types: Optional[FrozenSet[str]] = None
+        self.choices: Dict[Tuple[str, str], FrozenSet[str]] = {}
+        self.caps_at = 0.0
+
+    @property
+    def load(self) -> int:
+        return self.queue_depth + self.submitted
+
+    def can_run(self, classes: FrozenSet[str], models: Dict[Tuple[str, str], str], tags: FrozenSet[str]) -> bool:
+        if not tags <= self.tags:
+            return False
+        if self.class_types is None:
+            # Capabilities unknown (object_info failed); let ComfyUI decide.
+            return True
+        if not classes <= self.class_types:
+            return False
+        for key, value in models.items():
+            options = self.choices.get(key)
+            if options is not None and value not in options:
+                return False
+        return True
+
+    def status(self) -> Dict:
+        return {
+            "addr": self.addr,
+            "tags": sorted(self.tags),
+            "healthy": self.healthy,
+            "connected": self.client.connected,
+            "queue_depth": self.queue_depth,
+            "submitted": self.submitted,
+            "error": self.error,
+        }
+
+
+class ComfyPool:
+    """Schedules prompts over several ``ComfyClient`` hosts.
+
+    ``run()`` is the full submit/wait cycle with failover.  ``queue_prompt()``,
+    ``wait()`` and ``outputs()`` mirror ``ComfyClient`` so the standalone
+    services can swap a single client for the pool.
+    """
+
+    def __init__(self, nodes: Iterable[Tuple[str, Iterable[str]]], output_dir=None,
+                 check_interval=5.0, caps_ttl=300.0, attempts=3):
+        self.nodes: List[ComfyNode] = []
+        for addr, tags in nodes:
+            tags = frozenset(tags)
+            host = addr.rsplit(":", 1)[0]
+            # Only hosts sharing our disk may have outputs moved locally
+            local = host in _LOOPBACK_HOSTS or "local" in tags
+            self.nodes.append(ComfyNode(get_client(addr, output_dir if local else None), tags))
+        if not self.nodes:
+            raise ValueError("ComfyPool needs at least one node")
+        self.check_interval = check_interval
+        self.caps_ttl = caps_ttl
+        self.attempts = attempts
+        self._lock = threading.Lock()
+        self._monitor: Optional[threading.Thread] = None
+        self._monitor_lock = threading.Lock()
+        self._routes: "OrderedDict[str, Tuple[ComfyNode, Dict, Optional[Callable], Optional[Dict]]]" = OrderedDict()
+        self._aliases: Dict[str, str] = {}
+
+    # ------------------------------------------------------------------
+    # Health
+    # ------------------------------------------------------------------
+    def check(self, node: ComfyNode) -> None:
+        """Refresh one node's health, queue depth and (when stale) capabilities."""
+        try:
+            q = node.client.get_json("/queue", timeout=3)
+            depth = len(q.get("queue_running") or []) + len(q.get("queue_pending") or [])
+            if node.class_types is None or time.monotonic() - node.caps_at >= self.caps_ttl:
+                self._load_caps(node)
+            with self._lock:
+                node.queue_depth = depth
+                node.submitted = 0
+                node.healthy = True
+                node.error = None
+        except Exception as e:
+            if node.healthy:
+                logger.warning("ComfyUI node %s unhealthy: %s", node.addr, e)
+            with self._lock:
+                node.healthy = False
+                node.error = str(e)
+        node.checked_at = time.monotonic()
+
+    def _load_caps(self, node: ComfyNode) -> None:
+        try:
+            info = node.client.object_info(timeout=10)
+        except (requests.RequestException, ValueError) as e:
+            logger.warning("object_info from %s failed: %s", node.addr, e)
+            return
+        choices = {}
+        for ctype, spec in info.items():
+            inputs = (spec or {}).get("input") or {}
+            for group in ("required", "optional"):
+                for key, meta in (inputs.get(group) or {}).items():
+                    if key.endswith("_name") and isinstance(meta, (list, tuple)) and meta and isinstance(meta[0], list):
+                        choices[(ctype, key)] = frozenset(str(v) for v in meta[0])
+        node.class_types = frozenset(info)
+        node.choices = choices
+        node.caps_at = time.monotonic()
+
+    def _monitor_loop(self) -> None:
+        while True:
+            time.sleep(self.check_interval)
+            for node in self.nodes:
+                self.check(node)
+
+    def _ensure_monitor(self) -> None:
+        # Started lazily so every forked worker runs its own monitor; the first
+        # caller checks all nodes inline so scheduling has data to work with.
+        with self._monitor_lock:
+            if self._monitor is not None and self._monitor.is_alive():
+                return
+            for node in self.nodes:
+                self.check(node)
+            self._monitor = threading.Thread(target=self._monitor_loop, name="comfy-pool-health", daemon=True)
+            self._monitor.start()
+
+    def status(self) -> List[Dict]:
+        return [node.status() for node in self.nodes]
+
+    # ------------------------------------------------------------------
+    # Scheduling
+    # ------------------------------------------------------------------
+    def pick(self, workflow: Dict, tags: Iterable[str] = (), exclude: Iterable[ComfyNode] = ()) -> ComfyNode:
+        """Healthy node with the shortest queue that can run ``workflow``."""
+        self._ensure_monitor()
+        classes, models = workflow_requirements(workflow)
+        tags = frozenset(t.lower() for t in tags)
+        excluded = set(id(n) for n in exclude)
+        with self._lock:
+            capable = [n for n in self.nodes if id(n) not in excluded and n.can_run(classes, models, tags)]
+            healthy = [n for n in capable if n.healthy]
+            if not healthy:
+                raise NoNodeAvailable(
+                    "No healthy ComfyUI node can run this workflow",
+                    detail={
+                        "capable": [n.addr for n in capable],
+                        "nodes": [n.status() for n in self.nodes],
+                        "tags": sorted(tags),
+                    },
+                )
+            node = min(healthy, key=lambda n: n.load)
+            node.submitted += 1
+        return node
+
+    def _mark_down(self, node: ComfyNode, reason) -> None:
+        logger.warning("ComfyUI node %s failed, rescheduling: %s", node.addr, reason)
+        with self._lock:
+            node.healthy = False
+            node.error = str(reason)
+
+    def submit(self, workflow: Dict, listener=None, tags: Iterable[str] = (), exclude: Iterable[ComfyNode] = (),
+               prepare: Optional[Callable[[ComfyClient], None]] = None, extra=None) -> Tuple[ComfyNode, str]:
+        """Queue ``workflow`` on the best node, moving on to the next if a host is unreachable.
+
+        ``prepare(client)`` runs before queueing on the chosen host (e.g. to
+        upload input images there).  ComfyUI rejecting the prompt is not retried.
+        """
+        tried: List[ComfyNode] = list(exclude)
+        while True:
+            node = self.pick(workflow, tags, tried)
+            try:
+                if prepare is not None:
+                    prepare(node.client)
+                return node, node.client.queue_prompt(workflow, listener=listener, extra=extra)
+            except ComfyError as e:
+                if e.status is not None:
+                    raise
+                self._mark_down(node, e)
+            except (ConnectionError, requests.ConnectionError, requests.Timeout) as e:
+                self._mark_down(node, e)
+            tried.append(node)
+
+    def run(self, workflow: Dict, listener=None, tags: Iterable[str] = (), timeout=None,
+            prepare: Optional[Callable[[ComfyClient], None]] = None,
+            on_submit: Optional[Callable[[str, ComfyNode], None]] = None) -> Tuple[ComfyNode, Dict]:
+        """Submit and wait for ``workflow``; returns ``(node, {prompt_id, outputs})``.
+
+        When the executing host goes away (``HostDown``) the prompt is
+        resubmitted on another capable node, up to ``attempts`` times.
+        """
+        tried: List[ComfyNode] = []
+        for attempt in range(self.attempts):
+            node, prompt_id = self.submit(workflow, listener, tags, tried, prepare)
+            if on_submit is not None:
+                on_submit(prompt_id, node)
+            try:
+                return node, node.client.wait(prompt_id, timeout=timeout)
+            except HostDown as e:
+                self._mark_down(node, e)
+                tried.append(node)
+                if attempt + 1 >= self.attempts:
+                    raise
+
+    # ------------------------------------------------------------------
+    # ComfyClient-compatible facade (standalone services)
+    # ------------------------------------------------------------------
+    @property
+    def client_id(self) -> str:
+        """Client id on the first node (kept for legacy JSON responses)."""
+        return self.nodes[0].client.client_id
+
+    def client_for(self, prompt_id: str) -> ComfyClient:
+        route = self._routes.get(self._aliases.get(prompt_id, prompt_id))
+        return route[0].client if route else self.nodes[0].client
+
+    def _route(self, prompt_id: str, node: ComfyNode, workflow: Dict, listener, extra) -> None:
+        with self._lock:
+            self._routes[prompt_id] = (node, workflow, listener, extra)
+            while len(self._routes) > _ROUTE_LIMIT:
+                old, _ = self._routes.popitem(last=False)
+                self._aliases = {k: v for k, v in self._aliases.items() if v != old}
+
+    def queue_prompt(self, workflow: Dict, listener=None, extra=None, tags: Iterable[str] = ()) -> str:
+        node, prompt_id = self.submit(workflow, listener, tags, extra=extra)
+        self._route(prompt_id, node, workflow, listener, extra)
+        return prompt_id
+
+    def wait(self, prompt_id: str, timeout=None, poll=30.0) -> Dict:
+        current = self._aliases.get(prompt_id, prompt_id)
+        tried: List[ComfyNode] = []
+        for attempt in range(self.attempts):
+            node, workflow, listener, extra = self._routes.get(current) or (self.nodes[0], None, None, None)
+            try:
+                return node.client.wait(current, timeout=timeout, poll=poll)
+            except HostDown as e:
+                self._mark_down(node, e)
+                tried.append(node)
+                if workflow is None or attempt + 1 >= self.attempts:
+                    raise
+                new_node, current = self.submit(workflow, listener, exclude=tried, extra=extra)
+                self._route(current, new_node, workflow, listener, extra)
+                with self._lock:
+                    self._aliases[prompt_id] = current
+
+    def cancel(self, prompt_id: str) -> bool:
+        """Dequeue or interrupt ``prompt_id`` (or its resubmission) on the node running it."""
+        return self.client_for(prompt_id).cancel(self._aliases.get(prompt_id, prompt_id))
+
+    def outputs(self, prompt_id: str) -> Dict:
+        """Outputs of ``prompt_id`` (or of its resubmission after a failover)."""
+        return self.client_for(prompt_id).outputs(self._aliases.get(prompt_id, prompt_id))
+
+
+_pools: Dict[Tuple, ComfyPool] = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(nodes=None, output_dir=None) -> ComfyPool:
+    """Shared pool for ``nodes`` (a ``COMFY_NODES``-style string or parsed list).
+
+    Defaults to ``$COMFY_NODES``, then ``$COMFY_ADDR``, then ``127.0.0.1:8188``.
+    """
+    if nodes is None:
+        nodes = os.getenv("COMFY_NODES") or os.getenv("COMFY_ADDR") or "127.0.0.1:8188"
+    if isinstance(nodes, str):
+        nodes = parse_nodes(nodes)
+    key = tuple((addr, frozenset(tags)) for addr, tags in nodes)
+    with _pools_lock:
+        pool = _pools.get(key)
+        if pool is None:
+            pool = _pools[key] = ComfyPool(key, output_dir=output_dir)
+        return pool
@@ -0,0 +1,227 @@
+"""Per-prompt progress for ComfyUI jobs: real step counts, node, queue place and ETA.
+
+``ProgressTracker`` turns the WebSocket events a ``ComfyClient`` routes to a
+prompt's listener into a small set of events for SSE consumers, and polls
+``/queue`` while the prompt is still waiting so viewers see where it stands:
+
+``queued``     ``position`` (1 = next to run)
+``started``    execution began on the host
+``executing``  ``node``, ``class_type``, ``title``, ``nodes_done``, ``nodes_total``
+``progress``   ``value``, ``max``, ``node``, ``eta`` (seconds left in this node's
+               steps, from the observed step rate; None until two samples)
+``preview``    ``image`` (JPEG data: URI, long side <= ``preview_size``), ``node``;
+               only with ``preview_size`` > 0, at most one per ``preview_interval``
+
+``emit(event, **data)`` is called from the client's reader thread and the queue
+watcher thread; it must not block.  ``EventQueue`` is such a target for the
+standalone services, and ``progress_messages`` folds its events into the
+cumulative ``{"progress": percent, "message": ...}`` objects their SSE
+endpoints have always sent (plus ``segments`` / ``segments_done`` /
+``first_segment_url`` once a ``segment`` event, ``index``, ``segments``,
+``url``, reports a finished part of a segmented video, and ``poster_url``
+when an event carries a ``poster``).
+"""
+import base64
+import io
+import logging
+import queue
+import threading
+import time
+from typing import Callable, Dict, Iterator, Optional
+
+
+logger = logging.getLogger(__name__)
+
+
+def downscale_preview(image: bytes, size: int, quality: int = 70) -> bytes:
+    """Re-encode a ComfyUI preview frame as a JPEG no larger than ``size`` on its long side."""
+    from PIL import Image
+
+    with Image.open(io.BytesIO(image)) as im:
+        im.draft("RGB", (size, size))
+        im.thumbnail((size, size), Image.BILINEAR)
+        if im.mode != "RGB":
+            im = im.convert("RGB")
+        out = io.BytesIO()
+        im.save(out, "JPEG", quality=quality)
+    return out.getvalue()
+
+
+class ProgressTracker:
+    def __init__(self, emit: Callable[..., None], workflow: Optional[Dict] = None, poll: float = 2.0,
+                 preview_size: int = 0, preview_interval: float = 0.5):
+        self.emit = emit
+        self.poll = poll
+        self.preview_size = preview_size
+        self.preview_interval = preview_interval
+        self._last_preview = 0.0
+        self._workflow = workflow if isinstance(workflow, dict) else {}
+        self._lock = threading.Lock()
+        self._started = threading.Event()
+        self._stopped = threading.Event()
+        self._cached = 0
+        self._seen = set()
+        self._node = None
+        self._rate_start = None  # (node, monotonic, value) of the first progress sample
+
+    # ------------------------------------------------------------------
+    # WebSocket events
+    # ------------------------------------------------------------------
+    def listener(self, mtype: str, data: Dict) -> None:
+        """``ComfyClient`` listener: ``listener(event_type, data)``."""
+        if mtype in ("execution_start", "execution_cached", "executing", "progress"):
+            self._mark_started()
+        if mtype == "execution_cached":
+            with self._lock:
+                self._cached = len(data.get("nodes") or ())
+        elif mtype == "executing" and data.get("node") is not None:
+            self._on_executing(str(data["node"]))
+        elif mtype == "progress":
+            self._on_progress(data)
+        elif mtype == "preview":
+            self._on_preview(data)
+
+    def _mark_started(self) -> None:
+        if not self._started.is_set():
+            self._started.set()
+            self.emit("started")
+
+    def _node_info(self, node: str) -> Dict:
+        # dict.get: read the template node without Workflow's copy-on-access
+        spec = dict.get(self._workflow, node) or {}
+        return {"class_type": spec.get("class_type"), "title": (spec.get("_meta") or {}).get("title")}
+
+    def _on_executing(self, node: str) -> None:
+        with self._lock:
+            if node == self._node:
+                return
+            self._node = node
+            self._seen.add(node)
+            done = len(self._seen) - 1 + self._cached
+            total = len(self._workflow) or None
+        self.emit("executing", node=node, nodes_done=done, nodes_total=total, **self._node_info(node))
+
+    def _on_progress(self, data: Dict) -> None:
+        value, maximum, node = data.get("value"), data.get("max"), data.get("node")
+        now = time.monotonic()
+        eta = None
+        with self._lock:
+            start = self._rate_start
+            if start is None or start[0] != node or value is None or value < start[2]:
+                self._rate_start = (node, now, value)
+            elif value > start[2] and maximum:
+                rate = (value - start[2]) / max(now - start[1], 1e-6)
+                eta = round(max(0.0, (maximum - value) / rate), 1)
+        self.emit("progress", value=value, max=maximum, node=node, eta=eta)
+
+    def _on_preview(self, data: Dict) -> None:
+        # Runs on the client's reader thread: drop frames before decoding anything
+        if self.preview_size <= 0:
+            return
+        now = time.monotonic()
+        with self._lock:
+            if now - self._last_preview < self.preview_interval:
+                return
+            self._last_preview = now
+        try:
+            jpeg = downscale_preview(data["image"], self.preview_size)
+        except Exception as e:
+            logger.debug("Dropping undecodable preview frame: %s", e)
+            return
+        self.emit("preview", image="data:image/jpeg;base64," + base64.b64encode(jpeg).decode("ascii"),
+                  node=data.get("node"))
+
+    # ------------------------------------------------------------------
+    # Queue position
+    # ------------------------------------------------------------------
+    def watch_queue(self, client, prompt_id: str) -> threading.Thread:
+        """Report ``prompt_id``'s place in ``client``'s queue until it starts running."""
+        t = threading.Thread(target=self._watch, args=(client, prompt_id), name=f"comfy-queue-{prompt_id[:8]}",
+                             daemon=True)
+        t.start()
+        return t
+
+    def _watch(self, client, prompt_id: str) -> None:
+        last = None
+        misses = 0
+        while not (self._started.is_set() or self._stopped.is_set()):
+            try:
+                position = client.queue_position(prompt_id)
+            except Exception as e:
+                logger.debug("Queue poll for %s failed: %s", prompt_id, e)
+                position = last
+            if position == 0:
+                return
+            if position is None:
+                # Not queued yet, or already finished between polls
+                misses += 1
+                if misses >= 3:
+                    return
+            elif position != last:
+                last = position
+                self.emit("queued", position=position)
+            self._stopped.wait(self.poll)
+
+    def stop(self) -> None:
+        self._stopped.set()
+
+
+class EventQueue:
+    """``emit`` target that a response generator drains; ``close()`` ends the stream."""
+
+    def __init__(self):
+        self._q: "queue.Queue" = queue.Queue()
+
+    def __call__(self, event: str, **data) -> None:
+        self._q.put((event, data))
+
+    def close(self) -> None:
+        self._q.put(None)
+
+    def drain(self, heartbeat: float = 15.0) -> Iterator[tuple]:
+        """``(event, data)`` as they arrive, ``(None, None)`` after ``heartbeat`` idle seconds."""
+        while True:
+            try:
+                item = self._q.get(timeout=heartbeat)
+            except queue.Empty:
+                yield None, None
+                continue
+            if item is None:
+                return
+            yield item
+
+
+def progress_messages(events: EventQueue, message: str = "生成中...", heartbeat: float = 15.0) -> Iterator[Optional[Dict]]:
+    """Cumulative status objects for legacy SSE clients; None marks an idle heartbeat."""
+    state: Dict = {"progress": 0, "message": message}
+    for event, data in events.drain(heartbeat):
+        if event is None:
+            yield None
+            continue
+        if event == "queued":
+            ahead = data["position"] - 1
+            state.update(queue_position=data["position"],
+                         message=f"排隊中，前面還有 {ahead} 個任務" if ahead > 0 else "排隊中，下一個就輪到您")
+        elif event == "started":
+            state.update(queue_position=0, message=message)
+        elif event == "executing":
+            label = data.get("title") or data.get("class_type") or data["node"]
+            state.update(node=data["node"], nodes_done=data.get("nodes_done"), nodes_total=data.get("nodes_total"),
+                         message=f"{message}（{label}）")
+        elif event == "segment":
+            # Long videos render in segments (video_tools); the first one can play already
+            state.update(segments=data["segments"], segments_done=data["index"] + 1)
+            state.setdefault("first_segment_url", data.get("url"))
+            if data.get("poster"):
+                state["poster_url"] = data["poster"]
+        elif event == "progress" and data.get("max"):
+            state.update(
+                progress=min(99, int(100 * data["value"] / data["max"])),
+                value=data["value"],
+                max=data["max"],
+                node=data.get("node"),
+                eta=data.get("eta"),
+            )
+        else:
+            continue
+        yield dict(state)
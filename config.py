@@ -5,6 +5,9 @@ UPLOAD1     = os.path.join(BASE_DIR, "received1")
 UPLOAD2     = os.path.join(BASE_DIR, "received2")
 OUTPUT_DIR  = os.path.join(BASE_DIR, "output")
 COMFY_ADDR  = os.getenv("COMFY_ADDR", "127.0.0.1:8188")
+# ComfyUI worker pool: comma-separated "addr" or "addr=tag+tag" entries, e.g.
+# "10.0.0.2:8188=animatediff+controlnet,10.0.0.3:8188" (defaults to COMFY_ADDR alone)
+COMFY_NODES = os.getenv("COMFY_NODES", COMFY_ADDR)
 
 SECRET_KEY = os.getenv("SECRET_KEY", "dev-change-this")
 
@@ -36,8 +39,71 @@ if RECAPTCHA_USE_TEST_KEYS:
 
 MAX_CONTENT_LENGTH = int(os.getenv("MAX_CONTENT_LENGTH_MB", "20")) * 1024 * 1024
 
+# Uploaded images are validated, EXIF-oriented and downscaled before use (image_ingest):
+# decode threads per process, pixel cap checked before decoding, and per-workflow
+# "kind=max_side/multiple" overrides of image_ingest.DEFAULT_LIMITS
+INGEST_WORKERS = int(os.getenv("INGEST_WORKERS", "2"))
+INGEST_MAX_PIXELS = int(os.getenv("INGEST_MAX_PIXELS", "50000000"))
+INGEST_LIMITS = os.getenv("INGEST_LIMITS", "")
+
+# Background generation jobs (threads per worker process that wait on ComfyUI)
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "4"))
+
+# Latent previews pushed to a job's SSE stream: long side in px (0 = off) and minimum
+# seconds between frames.  ComfyUI only sends them when started with --preview-method.
+JOB_PREVIEW_SIZE = int(os.getenv("JOB_PREVIEW_SIZE", "256"))
+JOB_PREVIEW_INTERVAL = float(os.getenv("JOB_PREVIEW_INTERVAL", "0.5"))
+
+# A job whose last SSE viewer disconnected is cancelled (prompt dequeued / interrupted,
+# nothing charged) unless a viewer reconnects within this many seconds; 0 = never.
+JOB_ABANDON_GRACE = float(os.getenv("JOB_ABANDON_GRACE", "20"))
+
+# /img2vid Ken Burns clips: render processes per app process, host-wide cap shared by
+# all app processes through lock files (0 = no cap), and default x264 preset / CRF
+IMG2VID_WORKERS = int(os.getenv("IMG2VID_WORKERS", "2"))
+IMG2VID_MAX_PER_NODE = int(os.getenv("IMG2VID_MAX_PER_NODE", str(max(1, (os.cpu_count() or 2) // 2))))
+IMG2VID_LOCK_DIR = os.getenv("IMG2VID_LOCK_DIR", os.path.join(BASE_DIR, "cache", "locks"))
+IMG2VID_PRESET = os.getenv("IMG2VID_PRESET", "veryfast")
+IMG2VID_CRF = int(os.getenv("IMG2VID_CRF", "23"))
+IMG2VID_TIMEOUT = int(os.getenv("IMG2VID_TIMEOUT", "600"))
+
+# /inpaint diffuses only the mask's bounding box (plus padding px of context), rescaled
+# to about INPAINT_RESOLUTION² px, and blends it back with a feathered edge (0 = hard)
+INPAINT_CROP = os.getenv("INPAINT_CROP", "1") == "1"
+INPAINT_CROP_PADDING = int(os.getenv("INPAINT_CROP_PADDING", "32"))
+INPAINT_RESOLUTION = int(os.getenv("INPAINT_RESOLUTION", "512"))
+INPAINT_FEATHER = int(os.getenv("INPAINT_FEATHER", "8"))
+
+# Identical (same workflow + same input images) generations are served from this
+# content-addressed cache; least recently used entries are evicted past the limit (0 disables)
+RESULT_CACHE_DIR = os.getenv("RESULT_CACHE_DIR", os.path.join(BASE_DIR, "cache", "results"))
+RESULT_CACHE_MAX_MB = int(os.getenv("RESULT_CACHE_MAX_MB", "2048"))
+
+# Resized WebP/JPEG variants of outputs (/outputs/<file>?w=&fmt=): allowed widths,
+# Pillow worker threads and a content-addressed disk cache (LRU past the limit, 0 = unbounded)
+THUMB_WIDTHS = os.getenv("THUMB_WIDTHS", "128,256,384,512,768,1024")
+THUMB_WORKERS = int(os.getenv("THUMB_WORKERS", "2"))
+THUMB_CACHE_DIR = os.getenv("THUMB_CACHE_DIR", os.path.join(BASE_DIR, "cache", "thumbs"))
+THUMB_CACHE_MAX_MB = int(os.getenv("THUMB_CACHE_MAX_MB", "512"))
+
+# Delivery copies of image outputs (metadata-stripped PNG, WebP, AVIF) encoded by a
+# process pool after each job; serve_output picks one from the Accept header (0 workers disables)
+ENCODE_WORKERS = int(os.getenv("ENCODE_WORKERS", "2"))
+ENCODE_FORMATS = os.getenv("ENCODE_FORMATS", "png,webp,avif")
+ENCODE_WEBP_QUALITY = int(os.getenv("ENCODE_WEBP_QUALITY", "85"))
+ENCODE_AVIF_QUALITY = int(os.getenv("ENCODE_AVIF_QUALITY", "60"))
+
+# How /outputs (and the backend get_image/get_video routes) send files: "python" streams
+# from Flask (ETag + Range), "x-accel" hands off to nginx via X-Accel-Redirect using
+# X_ACCEL_MAP ("<dir>=<internal location>,..."; e.g. OUTPUT_DIR and THUMB_CACHE_DIR),
+# "x-sendfile" emits X-Sendfile for Apache/lighttpd.  Unmapped files fall back to python.
+OUTPUT_DELIVERY = os.getenv("OUTPUT_DELIVERY", "python")
+X_ACCEL_MAP = os.getenv("X_ACCEL_MAP", "")
+
 CKPT_NAME = os.getenv("CKPT_NAME", "meinamix_v12Final.safetensors")
 VAE_NAME = os.getenv("VAE_NAME")
+# Seconds the cached ComfyUI /object_info (model lists) is served before a background refresh
+OBJECT_INFO_TTL = int(os.getenv("OBJECT_INFO_TTL", "300"))
 
 MAIL_SERVER = os.getenv("MAIL_SERVER", "localhost")
 MAIL_PORT = int(os.getenv("MAIL_PORT", "25"))
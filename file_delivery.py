@@ -0,0 +1,131 @@
+"""Sending generated files to clients, optionally through the front proxy.
+
+``OUTPUT_DELIVERY`` selects how the bytes leave the server:
+
+``python`` (default)
+    Flask streams the file itself, with ETag / Last-Modified validation and
+    ``Range`` requests (206) so videos can seek.
+``x-accel``
+    nginx ``X-Accel-Redirect``.  ``X_ACCEL_MAP`` maps directories to
+    ``internal`` locations (``"/srv/app/output=/_protected/output,..."``); a
+    file outside every mapped directory falls back to ``python``.
+``x-sendfile``
+    Apache mod_xsendfile / lighttpd ``X-Sendfile`` with the absolute path.
+
+In the proxy modes the proxy handles Range, ETag and 304s for the internal
+location; this module only sets the content type, disposition and
+``Cache-Control`` per the caller's ``cache`` policy:
+
+``immutable``
+    ``public, max-age=<1 year>, immutable`` for files whose name is never
+    reused (timestamp/uuid or content-hash names).
+``revalidate``
+    ``no-cache``: browsers keep the file but check its ETag / Last-Modified
+    (304) before reuse; for names that can come back with new content.
+``no-store``
+    nothing is cached.
+"""
+import os
+from typing import Iterable, List, Optional, Tuple, Union
+
+from flask import current_app, request
+from werkzeug.exceptions import NotFound
+from werkzeug.security import safe_join
+from werkzeug.utils import send_file
+
+
+MODES = ("python", "x-accel", "x-sendfile")
+CACHE_POLICIES = ("immutable", "revalidate", "no-store")
+IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+
+
+def _setting(name: str, default: str = "") -> str:
+    # The main app reads config.py; the standalone backend services only have env vars
+    try:
+        value = current_app.config.get(name)
+    except RuntimeError:
+        value = None
+    return str(value if value is not None else os.getenv(name, default))
+
+
+def delivery_mode() -> str:
+    mode = _setting("OUTPUT_DELIVERY", "python").strip().lower()
+    return mode if mode in MODES else "python"
+
+
+def _accel_map() -> List[Tuple[str, str]]:
+    pairs = []
+    for entry in _setting("X_ACCEL_MAP").split(","):
+        directory, sep, prefix = entry.strip().partition("=")
+        if sep and directory and prefix:
+            pairs.append((os.path.realpath(directory), "/" + prefix.strip("/")))
+    # Most specific directory first
+    return sorted(pairs, key=lambda p: len(p[0]), reverse=True)
+
+
+def accel_uri(path: str) -> Optional[str]:
+    """Internal nginx URI for ``path``, or None when no mapped directory contains it."""
+    real = os.path.realpath(path)
+    for directory, prefix in _accel_map():
+        if real.startswith(directory + os.sep):
+            rel = os.path.relpath(real, directory).replace(os.sep, "/")
+            return f"{prefix}/{rel}"
+    return None
+
+
+def find_file(directories: Union[str, Iterable[str]], filename: str) -> Optional[str]:
+    """First ``directory/filename`` that exists (path traversal safe), else None."""
+    if isinstance(directories, str):
+        directories = (directories,)
+    for directory in directories:
+        path = safe_join(directory, filename)
+        if path is not None and os.path.isfile(path):
+            return path
+    return None
+
+
+def send_output(
+    directories: Union[str, Iterable[str]],
+    filename: str,
+    *,
+    mimetype: Optional[str] = None,
+    as_attachment: bool = False,
+    download_name: Optional[str] = None,
+    etag: Union[bool, str] = True,
+    cache: str = "immutable",
+):
+    """Respond with ``filename`` from the first of ``directories`` that has it (404 otherwise)."""
+    if cache not in CACHE_POLICIES:
+        raise ValueError(f"unknown cache policy {cache!r}")
+    path = find_file(directories, filename)
+    if path is None:
+        raise NotFound()
+    mode = delivery_mode()
+    uri = accel_uri(path) if mode == "x-accel" else None
+    proxied = mode == "x-sendfile" or uri is not None
+    resp = send_file(
+        path,
+        request.environ,
+        mimetype=mimetype,
+        as_attachment=as_attachment,
+        download_name=download_name,
+        conditional=not proxied,
+        etag=etag,
+        max_age=IMMUTABLE_MAX_AGE if cache == "immutable" else None,
+        use_x_sendfile=proxied,
+        response_class=current_app.response_class,
+    )
+    if uri is not None:
+        del resp.headers["X-Sendfile"]
+        resp.headers["X-Accel-Redirect"] = uri
+    if proxied:
+        # The proxy sends the body (and its length)
+        resp.headers.pop("Content-Length", None)
+    if cache == "immutable":
+        resp.cache_control.immutable = True
+    elif cache == "no-store":
+        resp.cache_control.no_store = True
+        resp.cache_control.must_revalidate = True
+        resp.cache_control.max_age = 0
+        resp.headers["Pragma"] = "no-cache"
+    return resp
@@ -0,0 +1,173 @@
+"""Normalizing uploaded images before they reach ComfyUI.
+
+Uploads used to be stored byte-for-byte, so a 4000×3000 phone photo went
+straight into VAE encode.  ``normalize(path, kind)`` rewrites an upload in
+place (on a small thread pool, so at most ``INGEST_WORKERS`` images per process
+are decoded at once):
+
+* the format must be one of ``FORMATS`` and the file must decode;
+* anything over ``INGEST_MAX_PIXELS`` is rejected from the header, before any
+  pixel data is decompressed (decompression bombs);
+* the EXIF orientation is applied, so ComfyUI sees what the browser showed;
+* the image is scaled down to the workflow's maximum long side and its sides
+  snapped to the workflow's multiple (8 for SD latents, 64 for some models).
+  An image that already fits is only trimmed to the multiple, not resampled.
+
+Per-workflow limits come from ``INGEST_LIMITS`` (``"kind=max_side/multiple,..."``),
+with ``default`` for kinds that are not listed.  Settings are read from the
+Flask config in the main app and from environment variables in the standalone
+backend services.  Failures raise ``IngestError`` with a message for the client.
+"""
+import os
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Optional, Tuple
+
+from PIL import Image, UnidentifiedImageError
+
+
+FORMATS = ("PNG", "JPEG", "MPO", "WEBP", "BMP")
+DEFAULT_LIMITS = "default=1536/8,img2img=1024/8,inpaint=2048/8,tryon=1280/8,sketch=1024/8,interrogate=1024/8"
+DEFAULT_MAX_PIXELS = 50_000_000
+
+# EXIF orientation -> transpose that brings the pixels upright
+_ORIENTATION = {
+    2: Image.Transpose.FLIP_LEFT_RIGHT,
+    3: Image.Transpose.ROTATE_180,
+    4: Image.Transpose.FLIP_TOP_BOTTOM,
+    5: Image.Transpose.TRANSPOSE,
+    6: Image.Transpose.ROTATE_270,
+    7: Image.Transpose.TRANSVERSE,
+    8: Image.Transpose.ROTATE_90,
+}
+_EXIF_ORIENTATION = 0x0112
+
+_lock = threading.Lock()
+_executor: Optional[ThreadPoolExecutor] = None
+
+
+class IngestError(ValueError):
+    """An upload that is not an acceptable image."""
+
+
+def _setting(name: str, default: str = "") -> str:
+    # The main app reads config.py; the standalone backend services only have env vars
+    try:
+        from flask import current_app
+
+        value = current_app.config.get(name)
+    except (ImportError, RuntimeError):
+        value = None
+    return str(value if value is not None else os.getenv(name, default))
+
+
+def limits(kind: str) -> Tuple[int, int]:
+    """``(max_side, multiple)`` for workflow ``kind``."""
+    table: Dict[str, Tuple[int, int]] = {}
+    for raw in (DEFAULT_LIMITS, _setting("INGEST_LIMITS")):
+        for entry in raw.split(","):
+            name, sep, value = entry.strip().partition("=")
+            side, _, multiple = value.partition("/")
+            if sep and side.strip().isdigit():
+                table[name.strip()] = (int(side), int(multiple) if multiple.strip().isdigit() else 8)
+    return table.get(kind) or table["default"]
+
+
+def target_size(size: Tuple[int, int], max_side: int, multiple: int = 8) -> Tuple[Tuple[int, int], bool]:
+    """Size to store ``size`` at, and whether that needs resampling (else it is a trim)."""
+    w, h = size
+    scale = min(1.0, max_side / float(max(w, h))) if max_side > 0 else 1.0
+    multiple = max(1, multiple)
+    snapped = (max(multiple, int(w * scale) // multiple * multiple),
+               max(multiple, int(h * scale) // multiple * multiple))
+    return snapped, scale < 1.0 or snapped[0] > w or snapped[1] > h
+
+
+def _pool() -> ThreadPoolExecutor:
+    global _executor
+    with _lock:
+        if _executor is None:
+            workers = max(1, int(_setting("INGEST_WORKERS", "2") or 2))
+            _executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="ingest")
+        return _executor
+
+
+def normalize(path: str, kind: str = "default") -> str:
+    """Normalize the image at ``path`` for workflow ``kind`` on the ingest pool; returns the stored path."""
+    max_side, multiple = limits(kind)
+    max_pixels = int(_setting("INGEST_MAX_PIXELS", str(DEFAULT_MAX_PIXELS)) or DEFAULT_MAX_PIXELS)
+    return _pool().submit(normalize_file, path, max_side, multiple, max_pixels).result()
+
+
+def normalize_file(path: str, max_side: int, multiple: int = 8, max_pixels: int = DEFAULT_MAX_PIXELS) -> str:
+    """Validate, orient, downscale and snap ``path``; returns where the result is stored.
+
+    A file that is already upright, within ``max_side`` and on the multiple is
+    left untouched.  Otherwise the normalized copy replaces it (as JPEG for
+    opaque JPEG sources, PNG for everything else, so the extension may change).
+    The upload is removed when it cannot be used.
+    """
+    try:
+        return _normalize(path, max_side, multiple, max_pixels)
+    except IngestError:
+        _discard(path)
+        raise
+
+
+def _normalize(path: str, max_side: int, multiple: int, max_pixels: int) -> str:
+    try:
+        im = Image.open(path)
+    except Image.DecompressionBombError:
+        raise IngestError("圖片像素過多")
+    except (UnidentifiedImageError, OSError):
+        raise IngestError("無法辨識的圖片格式")
+    with im:
+        if im.format not in FORMATS:
+            raise IngestError(f"不支援的圖片格式：{im.format}")
+        if im.width * im.height > max_pixels:
+            raise IngestError(f"圖片像素過多（{im.width}×{im.height}）")
+        orientation = im.getexif().get(_EXIF_ORIENTATION, 1)
+        transpose = _ORIENTATION.get(orientation)
+        # Sizes are worked out in stored orientation; the transpose comes last
+        size, resample = target_size(im.size, max_side, multiple)
+        if not transpose and size == im.size and im.mode in ("RGB", "RGBA", "L") and im.format != "BMP":
+            return path
+        fmt = "JPEG" if im.format in ("JPEG", "MPO") and im.mode in ("RGB", "L") else "PNG"
+        try:
+            if resample and im.format in ("JPEG", "MPO"):
+                im.draft(im.mode, size)  # decode at 1/2, 1/4 or 1/8 scale when that still covers size
+            im.load()
+            out = im
+            if out.mode not in ("RGB", "RGBA", "L"):
+                out = out.convert("RGBA" if "A" in out.getbands() or "transparency" in out.info else "RGB")
+            if resample:
+                out = out.resize(size, Image.LANCZOS, reducing_gap=3.0)
+            elif size != out.size:
+                left, top = (out.width - size[0]) // 2, (out.height - size[1]) // 2
+                out = out.crop((left, top, left + size[0], top + size[1]))
+            if transpose:
+                out = out.transpose(transpose)
+        except OSError as e:
+            raise IngestError(f"圖片檔損毀：{e}")
+    stem = os.path.splitext(path)[0]
+    dst = stem + (".jpg" if fmt == "JPEG" else ".png")
+    tmp = f"{dst}.{uuid.uuid4().hex[:8]}.tmp"
+    try:
+        if fmt == "JPEG":
+            out.save(tmp, "JPEG", quality=95)
+        else:
+            out.save(tmp, "PNG", compress_level=1)
+        os.replace(tmp, dst)
+    finally:
+        _discard(tmp)
+    if dst != path:
+        _discard(path)
+    return dst
+
+
+def _discard(path: str) -> None:
+    try:
+        os.remove(path)
+    except OSError:
+        pass
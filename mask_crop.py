@@ -0,0 +1,147 @@
+"""Crop-to-mask ("only masked region") inpainting.
+
+Instead of diffusing the whole frame, ``crop_for_inpaint`` finds the mask's
+bounding box (NumPy), pads it, widens very thin boxes, and writes that region
+of the image and the mask rescaled to about ``resolution``² pixels (sides
+multiples of 8) -- the model's native size.  The crop is what gets sent to
+ComfyUI.  ``composite`` scales the generated crop back to the box, feathers the
+mask edge and blends it into the original full-resolution image, so pixels
+outside the mask are untouched and keep their resolution.
+
+A mask is the image's alpha channel when that varies (strokes painted on a
+transparent canvas), otherwise its luminance; white / opaque = repaint.
+"""
+import os
+import uuid
+from typing import Optional, Tuple
+
+import numpy as np
+from PIL import Image, ImageFilter
+
+
+Box = Tuple[int, int, int, int]  # left, top, right, bottom (exclusive)
+
+_THRESHOLD = 0.04  # mask values above this count as "painted" for the bounding box
+_MAX_ASPECT = 2.0  # boxes are widened so long side / short side stays below this
+
+
+class MaskCrop:
+    """Where a crop came from and the files sent to ComfyUI in its place."""
+
+    __slots__ = ("source", "mask", "box", "size", "image_path", "mask_path")
+
+    def __init__(self, source, mask, box, size, image_path, mask_path):
+        self.source = source          # original image path
+        self.mask = mask              # original mask path
+        self.box = box                # region of the original that was cropped
+        self.size = size              # (w, h) the crop was rescaled to
+        self.image_path = image_path
+        self.mask_path = mask_path
+
+    @property
+    def pixels_saved(self) -> float:
+        """Fraction of the original frame's pixels that no longer go through diffusion."""
+        with Image.open(self.source) as im:
+            full = im.width * im.height
+        return max(0.0, 1.0 - self.size[0] * self.size[1] / float(full))
+
+    def __repr__(self):
+        return f"MaskCrop(box={self.box}, size={self.size})"
+
+
+def mask_values(mask: Image.Image) -> np.ndarray:
+    """Mask as float32 in [0, 1] (alpha if it varies, else luminance)."""
+    if "A" in mask.getbands():
+        alpha = np.asarray(mask.getchannel("A"), dtype=np.float32)
+        if alpha.min() < 255:
+            return alpha / 255.0
+    return np.asarray(mask.convert("L"), dtype=np.float32) / 255.0
+
+
+def mask_box(values: np.ndarray, padding: int) -> Optional[Box]:
+    """Padded bounding box of the painted area, or None for an empty mask."""
+    rows = np.flatnonzero((values > _THRESHOLD).any(axis=1))
+    if rows.size == 0:
+        return None
+    cols = np.flatnonzero((values > _THRESHOLD).any(axis=0))
+    h, w = values.shape
+    left, right = _grow(int(cols[0]) - padding, int(cols[-1]) + 1 + padding, w)
+    top, bottom = _grow(int(rows[0]) - padding, int(rows[-1]) + 1 + padding, h)
+    # Very thin boxes give the model too little context and odd latent shapes
+    bw, bh = right - left, bottom - top
+    if bw * _MAX_ASPECT < bh:
+        left, right = _grow(left - (int(bh / _MAX_ASPECT) - bw) // 2, right + (int(bh / _MAX_ASPECT) - bw + 1) // 2, w)
+    elif bh * _MAX_ASPECT < bw:
+        top, bottom = _grow(top - (int(bw / _MAX_ASPECT) - bh) // 2, bottom + (int(bw / _MAX_ASPECT) - bh + 1) // 2, h)
+    return left, top, right, bottom
+
+
+def _grow(lo: int, hi: int, limit: int) -> Tuple[int, int]:
+    """Clamp [lo, hi) into [0, limit), shifting rather than shrinking where possible."""
+    if lo < 0:
+        hi, lo = hi - lo, 0
+    if hi > limit:
+        lo, hi = max(0, lo - (hi - limit)), limit
+    return lo, hi
+
+
+def target_size(box: Box, resolution: int, multiple: int = 8) -> Tuple[int, int]:
+    """Crop size with about ``resolution``² pixels, the box's aspect and sides snapped to ``multiple``."""
+    bw, bh = box[2] - box[0], box[3] - box[1]
+    scale = resolution / float(np.sqrt(bw * bh))
+    return (max(multiple, int(round(bw * scale / multiple)) * multiple),
+            max(multiple, int(round(bh * scale / multiple)) * multiple))
+
+
+def crop_for_inpaint(image_path: str, mask_path: str, out_dir: str, *, resolution: int = 512,
+                     padding: int = 32) -> Optional[MaskCrop]:
+    """Write the masked region of ``image_path`` / ``mask_path`` at model size into ``out_dir``.
+
+    Returns None when the mask is empty.
+    """
+    with Image.open(image_path) as im, Image.open(mask_path) as mk:
+        im.load()
+        if mk.size != im.size:
+            mk = mk.resize(im.size, Image.BILINEAR)
+        box = mask_box(mask_values(mk), padding)
+        if box is None:
+            return None
+        size = target_size(box, resolution)
+        os.makedirs(out_dir, exist_ok=True)
+        stem = uuid.uuid4().hex
+        crop_path = os.path.join(out_dir, f"crop_{stem}.png")
+        crop_mask_path = os.path.join(out_dir, f"cropmask_{stem}.png")
+        im.crop(box).resize(size, Image.LANCZOS).save(crop_path)
+        mk.crop(box).resize(size, Image.BILINEAR).save(crop_mask_path)
+    return MaskCrop(image_path, mask_path, box, size, crop_path, crop_mask_path)
+
+
+def composite(crop: MaskCrop, result_path: str, out_path: str, feather: int = 8) -> str:
+    """Blend the generated crop back into the full-resolution original; writes ``out_path``."""
+    left, top, right, bottom = crop.box
+    box_size = (right - left, bottom - top)
+    with Image.open(crop.source) as original, Image.open(crop.mask) as mk, Image.open(result_path) as gen:
+        original.load()
+        mode = original.mode if original.mode in ("RGB", "RGBA") else "RGB"
+        base = original.convert(mode)
+        if mk.size != base.size:
+            mk = mk.resize(base.size, Image.BILINEAR)
+        region = mk.crop(crop.box)
+        alpha = Image.fromarray((mask_values(region) * 255).astype(np.uint8))
+        if feather > 0:
+            # Grow by the feather width first so the whole painted area stays fully replaced
+            alpha = alpha.filter(ImageFilter.MaxFilter(2 * feather + 1)).filter(ImageFilter.GaussianBlur(feather / 2.0))
+        patch = gen.convert(mode).resize(box_size, Image.LANCZOS)
+    a = np.asarray(alpha, dtype=np.float32)[..., None] / 255.0
+    old = np.asarray(base.crop(crop.box), dtype=np.float32)
+    new = np.asarray(patch, dtype=np.float32)
+    blended = np.clip(old * (1.0 - a) + new * a + 0.5, 0, 255).astype(np.uint8)
+    base.paste(Image.fromarray(blended), (left, top))
+    fmt = os.path.splitext(out_path)[1].lstrip(".").upper().replace("JPG", "JPEG") or "PNG"
+    if fmt == "JPEG" and base.mode != "RGB":
+        base = base.convert("RGB")
+    # Write aside and rename: out_path may be a hard link into the result cache
+    tmp = f"{out_path}.{uuid.uuid4().hex[:8]}.tmp"
+    base.save(tmp, format=fmt)
+    os.replace(tmp, out_path)
+    return out_path
@@ -0,0 +1,25 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+# The shared modules (comfy_client, upload_stream, ...) live at the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# config.py reads these at import time; keep the test database out of the repository
+os.environ.setdefault("DATABASE_URL", f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'test.db')}")
+os.environ.setdefault("ENCODE_WORKERS", "0")
+
+
+@pytest.fixture
+def app(tmp_path, monkeypatch):
+    """The Flask app inside a request context, with OUTPUT_DIR redirected to ``tmp_path``."""
+    import config
+    from app import create_app
+
+    monkeypatch.setattr(config, "OUTPUT_DIR", str(tmp_path))
+    app = create_app()
+    app.config["TESTING"] = True
+    with app.test_request_context():
+        yield app
@@ -0,0 +1,92 @@
+import json
+
+from backend.comfy import run_prompt
+from comfy_client import ComfyError
+from comfy_pool import NoNodeAvailable
+
+
+class FakeClient:
+    def __init__(self, addr):
+        self.addr = addr
+        self.cancelled = []
+
+    def queue_position(self, prompt_id):
+        return 0
+
+    def outputs(self, prompt_id):
+        return {}
+
+    def cancel(self, prompt_id):
+        self.cancelled.append(prompt_id)
+        return True
+
+    def fetch_output(self, record, dst):
+        with open(dst, "wb") as f:
+            f.write(b"png:" + record["filename"].encode())
+
+
+class FakeNode:
+    def __init__(self, addr):
+        self.addr = addr
+        self.client = FakeClient(addr)
+
+
+class FakePool:
+    def __init__(self, outputs=None, error=None, submit=True):
+        self.nodes = [FakeNode("10.0.0.1:8188"), FakeNode("10.0.0.2:8188")]
+        self.outputs = outputs or {}
+        self.error = error
+        self.submit = submit
+        self.prepared = []
+
+    def run(self, workflow, listener=None, prepare=None, on_submit=None):
+        node = self.nodes[1]
+        prepare(node.client)
+        self.prepared.append(node.addr)
+        if self.submit:
+            on_submit("pid-1", node)
+        if self.error is not None:
+            raise self.error
+        return node, {"prompt_id": "pid-1", "outputs": self.outputs}
+
+
+class Report:
+    def __init__(self):
+        self.events = []
+        self.cancels = []
+
+    def __call__(self, event, **data):
+        self.events.append((event, data))
+
+    def on_cancel(self, fn):
+        self.cancels.append(fn)
+
+
+def test_run_prompt_fetches_the_first_image(app, tmp_path):
+    pool = FakePool(outputs={"9": {"images": [{"filename": "ComfyUI_0001.png", "type": "output"}]}})
+    report = Report()
+
+    newfn, err = run_prompt(pool, {}, str(tmp_path / "out"), report)
+
+    assert err is None
+    assert (tmp_path / "out" / newfn).read_bytes() == b"png:ComfyUI_0001.png"
+    assert ("submitted", {"prompt_id": "pid-1", "node": "10.0.0.2:8188"}) in report.events
+    report.cancels[0]()
+    assert pool.nodes[1].client.cancelled == ["pid-1"]
+
+
+def test_run_prompt_maps_errors_to_responses(app, tmp_path):
+    out = str(tmp_path)
+
+    _, (status, body) = run_prompt(FakePool(error=NoNodeAvailable("none", detail={"missing": ["X"]})), {}, out)
+    assert status == 503 and json.loads(body)["detail"] == {"missing": ["X"]}
+
+    http = ComfyError("bad", status=400, reason="Bad Request", body="{}")
+    _, (status, body) = run_prompt(FakePool(error=http), {}, out)
+    assert status == 502 and json.loads(body)["detail"]["comfy_addr"] == "10.0.0.2:8188"
+
+    _, (status, body) = run_prompt(FakePool(error=OSError("refused"), submit=False), {}, out)
+    assert status == 502 and json.loads(body)["detail"]["comfy_addr"] == ["10.0.0.1:8188", "10.0.0.2:8188"]
+
+    _, (status, body) = run_prompt(FakePool(), {}, out)
+    assert status == 500 and json.loads(body)["error"] == "沒有產生任何輸出圖片"
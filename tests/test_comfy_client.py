@@ -0,0 +1,42 @@
+import time
+
+import pytest
+
+from comfy_client import ComfyClient, output_files
+
+
+def _connected_client(monkeypatch):
+    client = ComfyClient("127.0.0.1:1")
+    client._connected.set()
+    # /history never reports the prompt: it is still running
+    monkeypatch.setattr(client, "history", lambda prompt_id: {})
+    return client
+
+
+def test_wait_times_out_on_deadline_while_connected(monkeypatch):
+    client = _connected_client(monkeypatch)
+    wall, cpu = time.monotonic(), time.process_time()
+    with pytest.raises(TimeoutError):
+        client.wait("p1", timeout=0.5, poll=5)
+    assert time.monotonic() - wall < 1.5
+    assert time.process_time() - cpu < 0.5
+
+
+def test_wait_returns_outputs_from_events(monkeypatch):
+    client = _connected_client(monkeypatch)
+    waiter = client._register("p2")
+    waiter.outputs["9"] = {"images": [{"filename": "a.png"}]}
+    waiter.done.set()
+    assert client.wait("p2", timeout=1) == {"prompt_id": "p2", "outputs": {"9": {"images": [{"filename": "a.png"}]}}}
+
+
+def test_output_files_puts_saved_outputs_of_the_last_node_first():
+    outputs = {
+        "3": {"images": [{"filename": "early.png", "type": "output"}]},
+        "7": {"images": [{"filename": "preview.png", "type": "temp"}]},
+        "9": {"gifs": [{"filename": "clip.mp4", "subfolder": "vid"}]},
+    }
+    records = output_files(outputs)
+    assert [r["filename"] for r in records] == ["clip.mp4", "early.png", "preview.png"]
+    assert records[0] == {"node": "9", "filename": "clip.mp4", "subfolder": "vid", "type": "output"}
+    assert [r["filename"] for r in output_files(outputs, exts=(".mp4",))] == ["clip.mp4"]
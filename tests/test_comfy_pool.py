@@ -0,0 +1,145 @@
+import pytest
+import requests
+
+import comfy_pool
+from comfy_client import ComfyError, HostDown
+from comfy_pool import ComfyPool, NoNodeAvailable, parse_nodes, workflow_requirements
+
+WORKFLOW = {
+    "4": {"class_type": "CheckpointLoaderSimple", "inputs": {"ckpt_name": "a.safetensors"}},
+    "3": {"class_type": "KSampler", "inputs": {"seed": 1, "model": ["4", 0]}},
+}
+
+
+class FakeClient:
+    def __init__(self, addr, output_dir=None):
+        self.addr = addr
+        self.client_id = f"cid-{addr}"
+        self.connected = True
+        self.depth = 0
+        self.unreachable = False   # /queue and /prompt fail to connect
+        self.dies_while_running = False
+        self.checkpoints = ["a.safetensors"]
+        self.queued = []
+
+    def get_json(self, path, timeout=8, **kwargs):
+        if self.unreachable:
+            raise requests.ConnectionError("refused")
+        return {"queue_running": [], "queue_pending": [[i, f"p{i}"] for i in range(self.depth)]}
+
+    def object_info(self, timeout=5):
+        return {
+            "KSampler": {"input": {"required": {"seed": ["INT", {}]}}},
+            "CheckpointLoaderSimple": {"input": {"required": {"ckpt_name": [self.checkpoints]}}},
+        }
+
+    def queue_prompt(self, workflow, listener=None, extra=None):
+        if self.unreachable:
+            raise requests.ConnectionError("refused")
+        prompt_id = f"{self.addr}#{len(self.queued)}"
+        self.queued.append(prompt_id)
+        return prompt_id
+
+    def wait(self, prompt_id, timeout=None, poll=30.0):
+        if self.dies_while_running:
+            raise HostDown(f"{self.addr} gone")
+        return {"prompt_id": prompt_id, "outputs": {"9": {"images": [{"filename": f"{self.addr}.png"}]}}}
+
+    def outputs(self, prompt_id):
+        return {"from": self.addr, "prompt_id": prompt_id}
+
+    def cancel(self, prompt_id):
+        return True
+
+
+@pytest.fixture
+def make_pool(monkeypatch):
+    monkeypatch.setattr(comfy_pool, "get_client", lambda addr, output_dir=None: FakeClient(addr, output_dir))
+
+    def make(spec, setup=None):
+        pool = ComfyPool(parse_nodes(spec), check_interval=3600)
+        clients = {n.addr: n.client for n in pool.nodes}
+        if setup:
+            setup(clients)
+        return pool, clients
+
+    return make
+
+
+def test_parse_nodes_and_requirements():
+    assert parse_nodes(" a:1=AnimateDiff+controlnet , b:2,, ") == [
+        ("a:1", frozenset({"animatediff", "controlnet"})), ("b:2", frozenset())]
+    classes, models = workflow_requirements(dict(WORKFLOW, extra={"not": "a node"}))
+    assert classes == {"CheckpointLoaderSimple", "KSampler"}
+    assert models == {("CheckpointLoaderSimple", "ckpt_name"): "a.safetensors"}
+
+
+def test_pick_prefers_short_queues_and_spreads_back_to_back_submits(make_pool):
+    def setup(clients):
+        clients["a:1"].depth = 2
+
+    pool, _ = make_pool("a:1,b:2", setup)
+    picked = [pool.pick(WORKFLOW).addr for _ in range(4)]
+    assert picked[:2] == ["b:2", "b:2"]
+    assert sorted(picked[2:]) == ["a:1", "b:2"]
+
+
+def test_pick_honours_models_and_tags(make_pool):
+    def setup(clients):
+        clients["a:1"].checkpoints = ["other.safetensors"]
+
+    pool, _ = make_pool("a:1,b:2=animatediff", setup)
+    assert pool.pick(WORKFLOW).addr == "b:2"
+    assert pool.pick(WORKFLOW, tags=["AnimateDiff"]).addr == "b:2"
+    with pytest.raises(NoNodeAvailable):
+        pool.pick(WORKFLOW, tags=["controlnet"])
+
+
+def test_submit_moves_on_from_an_unreachable_host(make_pool):
+    pool, clients = make_pool("a:1,b:2")
+    clients["b:2"].unreachable = True  # healthy at the first check, refuses the prompt
+    pool.nodes[0].queue_depth = 5
+    node, prompt_id = pool.submit(WORKFLOW)
+    assert node.addr == "a:1" and prompt_id == "a:1#0"
+    assert not pool.nodes[1].healthy
+
+
+def test_submit_does_not_retry_a_rejected_prompt(make_pool):
+    pool, clients = make_pool("a:1,b:2")
+
+    def reject(workflow, listener=None, extra=None):
+        raise ComfyError("bad prompt", status=400)
+
+    clients["a:1"].queue_prompt = clients["b:2"].queue_prompt = reject
+    with pytest.raises(ComfyError):
+        pool.submit(WORKFLOW)
+    assert all(n.healthy for n in pool.nodes)
+
+
+def test_run_resubmits_when_the_host_dies(make_pool):
+    pool, clients = make_pool("a:1,b:2")
+    pool.nodes[1].queue_depth = 5
+    clients["a:1"].dies_while_running = True
+    submits = []
+    node, result = pool.run(WORKFLOW, on_submit=lambda pid, n: submits.append((pid, n.addr)))
+    assert submits == [("a:1#0", "a:1"), ("b:2#0", "b:2")]
+    assert node.addr == "b:2" and result["prompt_id"] == "b:2#0"
+
+
+def test_run_gives_up_when_no_other_host_is_left(make_pool):
+    pool, clients = make_pool("a:1")
+    clients["a:1"].dies_while_running = True
+    with pytest.raises(NoNodeAvailable):
+        pool.run(WORKFLOW)
+    assert clients["a:1"].queued == ["a:1#0"]
+
+
+def test_facade_wait_follows_the_resubmitted_prompt(make_pool):
+    pool, clients = make_pool("a:1,b:2")
+    pool.nodes[1].queue_depth = 5
+    prompt_id = pool.queue_prompt(WORKFLOW)
+    assert prompt_id == "a:1#0"
+    clients["a:1"].dies_while_running = True
+    assert pool.wait(prompt_id)["prompt_id"] == "b:2#0"
+    assert pool.outputs(prompt_id) == {"from": "b:2", "prompt_id": "b:2#0"}
+    assert pool.client_for(prompt_id) is clients["b:2"]
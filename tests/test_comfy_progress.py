@@ -0,0 +1,87 @@
+import base64
+import io
+
+from PIL import Image
+
+from comfy_progress import EventQueue, ProgressTracker, downscale_preview, progress_messages
+
+WORKFLOW = {
+    "4": {"class_type": "CheckpointLoaderSimple", "inputs": {}},
+    "3": {"class_type": "KSampler", "inputs": {}, "_meta": {"title": "Sampler"}},
+    "9": {"class_type": "SaveImage", "inputs": {}},
+}
+
+
+class Recorder(list):
+    def __call__(self, event, **data):
+        self.append((event, data))
+
+
+def test_tracker_reports_start_nodes_and_eta():
+    events = Recorder()
+    tracker = ProgressTracker(events, WORKFLOW)
+    tracker.listener("execution_cached", {"nodes": ["4"]})
+    tracker.listener("executing", {"node": "3"})
+    tracker.listener("executing", {"node": "3"})  # repeats are not re-announced
+    tracker.listener("progress", {"value": 1, "max": 20, "node": "3"})
+    tracker.listener("progress", {"value": 5, "max": 20, "node": "3"})
+    assert [e for e, _ in events] == ["started", "executing", "progress", "progress"]
+    assert events[1][1] == {"node": "3", "nodes_done": 1, "nodes_total": 3, "class_type": "KSampler",
+                            "title": "Sampler"}
+    assert events[2][1]["eta"] is None
+    assert events[3][1]["eta"] >= 0
+
+
+def test_previews_are_off_by_default_and_downscaled_when_on():
+    buf = io.BytesIO()
+    Image.new("RGB", (512, 256), (9, 9, 9)).save(buf, "PNG")
+    events = Recorder()
+    ProgressTracker(events, WORKFLOW).listener("preview", {"image": buf.getvalue(), "node": "3"})
+    assert events == []
+
+    ProgressTracker(events, WORKFLOW, preview_size=64, preview_interval=0).listener(
+        "preview", {"image": buf.getvalue(), "node": "3"})
+    (event, data), = events
+    assert event == "preview" and data["node"] == "3"
+    jpeg = base64.b64decode(data["image"].split(",", 1)[1])
+    assert Image.open(io.BytesIO(jpeg)).size == (64, 32)
+    assert Image.open(io.BytesIO(downscale_preview(buf.getvalue(), 128))).size == (128, 64)
+
+
+def test_queue_watcher_reports_position_changes_until_running():
+    class Client:
+        positions = iter([3, 3, 2, 0])
+
+        def queue_position(self, prompt_id):
+            return next(self.positions)
+
+    events = Recorder()
+    tracker = ProgressTracker(events, WORKFLOW, poll=0.01)
+    tracker.watch_queue(Client(), "prompt-1").join(2)
+    assert events == [("queued", {"position": 3}), ("queued", {"position": 2})]
+
+
+def test_progress_messages_fold_events_into_legacy_objects():
+    events = EventQueue()
+    events("queued", position=2)
+    events("started")
+    events("executing", node="3", class_type="KSampler", title=None, nodes_done=1, nodes_total=3)
+    events("progress", value=10, max=20, node="3", eta=4.0)
+    events("segment", index=0, segments=2, url="u0", poster="p.jpg")
+    events("segment", index=1, segments=2, url="u1")
+    events("preview", image="data:...")  # not part of the legacy stream
+    events.close()
+    messages = list(progress_messages(events, "生成中..."))
+    assert [m["message"] for m in messages[:3]] == ["排隊中，前面還有 1 個任務", "生成中...", "生成中...（KSampler）"]
+    assert messages[3]["progress"] == 50 and messages[3]["eta"] == 4.0
+    last = messages[-1]
+    assert len(messages) == 6
+    assert last["segments_done"] == 2 and last["first_segment_url"] == "u0" and last["poster_url"] == "p.jpg"
+
+
+def test_progress_messages_heartbeat():
+    events = EventQueue()
+    stream = progress_messages(events, heartbeat=0.01)
+    assert next(stream) is None
+    events.close()
+    assert list(stream) == []
@@ -0,0 +1,50 @@
+from PIL import Image, PngImagePlugin
+from werkzeug.datastructures import MIMEAccept
+
+from app import encode
+
+VARIANTS = {"image/avif": "a.avif", "image/webp": "a.webp", "image/png": "a.clean.png"}
+
+
+def _accept(header: str) -> MIMEAccept:
+    values = []
+    for part in header.split(","):
+        value, _, q = part.strip().partition(";q=")
+        values.append((value, float(q) if q else 1.0))
+    return MIMEAccept(values)
+
+
+def test_negotiate_prefers_explicitly_accepted_formats():
+    assert encode.negotiate(VARIANTS, _accept("image/avif,image/webp,*/*;q=0.8")) == "a.avif"
+    assert encode.negotiate(VARIANTS, _accept("image/webp,*/*")) == "a.webp"
+    assert encode.negotiate(VARIANTS, _accept("image/avif;q=0,image/webp")) == "a.webp"
+
+
+def test_negotiate_wildcards_only_get_png():
+    assert encode.negotiate(VARIANTS, _accept("*/*")) == "a.clean.png"
+    assert encode.negotiate(VARIANTS, _accept("image/*")) == "a.clean.png"
+    assert encode.negotiate({"image/webp": "a.webp"}, _accept("*/*")) is None
+    assert encode.negotiate({}, _accept("image/webp")) is None
+
+
+def test_variants_of_tolerates_missing_or_bad_json():
+    class Rec:
+        variants = '{"image/webp": "a.webp"}'
+
+    assert encode.variants_of(Rec()) == {"image/webp": "a.webp"}
+    Rec.variants = "{broken"
+    assert encode.variants_of(Rec()) == {}
+    assert encode.variants_of(None) == {}
+
+
+def test_encode_variants_strips_metadata(tmp_path):
+    src = tmp_path / "out.png"
+    info = PngImagePlugin.PngInfo()
+    info.add_text("workflow", "x" * 20000)
+    Image.new("RGB", (64, 64), (10, 20, 30)).save(src, pnginfo=info)
+    made = encode.encode_variants(str(src), {"formats": ["png", "webp"], "webp_quality": 80, "avif_quality": 60})
+    assert made, "expected at least one smaller delivery copy"
+    for mimetype, fn in made.items():
+        with Image.open(tmp_path / fn) as im:
+            assert "workflow" not in im.info
+            assert im.size == (64, 64)
@@ -0,0 +1,63 @@
+import pytest
+from flask import Flask
+from werkzeug.exceptions import NotFound
+
+import file_delivery
+
+
+@pytest.fixture
+def served(tmp_path):
+    (tmp_path / "out").mkdir()
+    (tmp_path / "out" / "clip.mp4").write_bytes(bytes(range(256)) * 4)
+    app = Flask(__name__)
+
+    @app.route("/f/<path:filename>")
+    def get(filename):
+        try:
+            return file_delivery.send_output(str(tmp_path / "out"), filename,
+                                             cache=app.config.get("CACHE", "immutable"))
+        except NotFound:
+            return "missing", 404
+
+    return app, tmp_path
+
+
+def test_python_mode_serves_ranges_and_revalidates(served):
+    app, _ = served
+    client = app.test_client()
+    full = client.get("/f/clip.mp4")
+    assert full.status_code == 200 and len(full.data) == 1024
+    assert "immutable" in full.headers["Cache-Control"]
+    part = client.get("/f/clip.mp4", headers={"Range": "bytes=10-19"})
+    assert part.status_code == 206 and part.data == bytes(range(10, 20))
+    assert client.get("/f/clip.mp4", headers={"If-None-Match": full.headers["ETag"]}).status_code == 304
+
+
+def test_missing_and_traversal_are_404(served):
+    app, tmp_path = served
+    (tmp_path / "secret.txt").write_text("x")
+    client = app.test_client()
+    assert client.get("/f/nope.mp4").status_code == 404
+    assert client.get("/f/../secret.txt").status_code == 404
+    assert file_delivery.find_file([str(tmp_path / "out")], "../secret.txt") is None
+
+
+def test_x_accel_hands_off_mapped_files_only(served, monkeypatch):
+    app, tmp_path = served
+    monkeypatch.setenv("OUTPUT_DELIVERY", "x-accel")
+    monkeypatch.setenv("X_ACCEL_MAP", f"{tmp_path}=/_protected/, {tmp_path / 'out'}=/_out")
+    app.config["CACHE"] = "revalidate"
+    resp = app.test_client().get("/f/clip.mp4")
+    assert resp.headers["X-Accel-Redirect"] == "/_out/clip.mp4"
+    assert "X-Sendfile" not in resp.headers and resp.data == b""
+    assert resp.headers["Cache-Control"] == "no-cache"
+    monkeypatch.setenv("X_ACCEL_MAP", "/elsewhere=/_x")
+    resp = app.test_client().get("/f/clip.mp4")
+    assert "X-Accel-Redirect" not in resp.headers and len(resp.data) == 1024
+
+
+def test_no_store_policy(served):
+    app, _ = served
+    app.config["CACHE"] = "no-store"
+    resp = app.test_client().get("/f/clip.mp4")
+    assert "no-store" in resp.headers["Cache-Control"] and resp.headers["Pragma"] == "no-cache"
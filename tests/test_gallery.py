@@ -0,0 +1,46 @@
+from datetime import datetime
+
+import pytest
+
+from app.routes.gallery import CursorError, decode_cursor, encode_cursor
+
+
+class _Row:
+    def __init__(self, created_at, id):
+        self.created_at = created_at
+        self.id = id
+
+
+@pytest.mark.parametrize("created", [datetime(2026, 1, 2, 3, 4, 5), datetime(2026, 1, 2, 3, 4, 5, 678901)])
+def test_cursor_round_trip(created):
+    cursor = encode_cursor(_Row(created, 42))
+    assert "=" not in cursor
+    assert decode_cursor(cursor) == (created, 42)
+
+
+@pytest.mark.parametrize("cursor", ["", "!!!", "bm90LWEtZGF0ZXwx", "MjAyNi0wMS0wMnxhYmM"])
+def test_bad_cursor_raises_cursor_error(cursor):
+    with pytest.raises(CursorError):
+        decode_cursor(cursor)
+
+
+def test_pages_seek_past_ties_without_gaps_or_repeats(app):
+    from app.extensions import db
+    from app.models import ImageResult
+    from app.routes.gallery import gallery_page_of
+
+    ImageResult.query.filter_by(kind="pagetest").delete()
+    same = datetime(2026, 5, 1, 12, 0, 0)
+    for i in range(7):
+        db.session.add(ImageResult(filename=f"p{i}.png", kind="pagetest", output_path=f"/x/p{i}.png",
+                                   created_at=same if i < 4 else datetime(2026, 5, 1, 12, 0, i)))
+    db.session.commit()
+
+    seen, cursor = [], None
+    while True:
+        rows, cursor = gallery_page_of(cursor=cursor, limit=3, kind="pagetest")
+        seen += [r.filename for r in rows]
+        if cursor is None:
+            break
+    assert sorted(seen) == [f"p{i}.png" for i in range(7)]
+    assert seen[:3] == ["p6.png", "p5.png", "p4.png"]
@@ -0,0 +1,79 @@
+import io
+
+import pytest
+from PIL import Image
+
+import image_ingest
+from image_ingest import IngestError, normalize_file
+
+
+def test_target_size_scales_down_and_snaps():
+    assert image_ingest.target_size((4000, 3000), 1024, 8) == ((1024, 768), True)
+    # Already within the limit: only trimmed to the multiple
+    assert image_ingest.target_size((1001, 703), 1024, 8) == ((1000, 696), False)
+    assert image_ingest.target_size((512, 512), 1024, 64) == ((512, 512), False)
+    assert image_ingest.target_size((3, 3), 1024, 8) == ((8, 8), True)
+
+
+def test_limits_defaults_and_overrides(monkeypatch):
+    assert image_ingest.limits("img2img") == (1024, 8)
+    assert image_ingest.limits("unknown") == image_ingest.limits("default")
+    monkeypatch.setenv("INGEST_LIMITS", "img2img=768/64, broken, default=2048")
+    assert image_ingest.limits("img2img") == (768, 64)
+    assert image_ingest.limits("other") == (2048, 8)
+
+
+def test_large_jpeg_is_resized_and_stays_jpeg(tmp_path):
+    path = tmp_path / "a.jpg"
+    Image.new("RGB", (3000, 2000), (200, 10, 10)).save(path, "JPEG")
+    out = normalize_file(str(path), 1024, 8)
+    with Image.open(out) as im:
+        assert im.format == "JPEG" and im.size == (1024, 680)
+
+
+def test_fitting_png_is_left_untouched(tmp_path):
+    path = tmp_path / "a.png"
+    Image.new("RGB", (64, 48)).save(path)
+    before = path.read_bytes()
+    assert normalize_file(str(path), 1024, 8) == str(path)
+    assert path.read_bytes() == before
+
+
+def test_exif_orientation_is_applied(tmp_path):
+    path = tmp_path / "phone.jpg"
+    exif = Image.Exif()
+    exif[0x0112] = 6  # rotated 90° clockwise
+    Image.new("RGB", (64, 32)).save(path, "JPEG", exif=exif)
+    with Image.open(normalize_file(str(path), 1024, 8)) as im:
+        assert im.size == (32, 64)
+        assert im.getexif().get(0x0112, 1) == 1
+
+
+def test_bmp_becomes_png(tmp_path):
+    path = tmp_path / "a.bmp"
+    Image.new("RGB", (16, 16)).save(path)
+    out = normalize_file(str(path), 1024, 8)
+    assert out.endswith(".png") and not path.exists()
+
+
+@pytest.mark.parametrize("name, data", [
+    ("junk.png", b"not an image"),
+    ("anim.gif", None),
+])
+def test_unusable_uploads_are_rejected_and_removed(tmp_path, name, data):
+    path = tmp_path / name
+    if data is None:
+        buf = io.BytesIO()
+        Image.new("P", (8, 8)).save(buf, "GIF")
+        data = buf.getvalue()
+    path.write_bytes(data)
+    with pytest.raises(IngestError):
+        normalize_file(str(path), 1024, 8)
+    assert not path.exists()
+
+
+def test_pixel_cap_is_checked_from_the_header(tmp_path):
+    path = tmp_path / "big.png"
+    Image.new("L", (200, 200)).save(path)
+    with pytest.raises(IngestError, match="像素過多"):
+        normalize_file(str(path), 1024, 8, max_pixels=10_000)
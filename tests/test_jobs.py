@@ -0,0 +1,49 @@
+import json
+
+from app import jobs
+
+
+def _runner(tmp_path, name="out.png"):
+    def run(report):
+        (tmp_path / name).write_bytes(b"png")
+        return name, None
+    return run
+
+
+def test_done_job_is_recorded(app, tmp_path):
+    job = jobs.wait(jobs.submit("img2img", _runner(tmp_path), billing={"ip": "1.2.3.4"}).id)
+    assert job.status == "done" and job.filename == "out.png" and job.image_id
+    assert jobs.job_payload(job)["download"].endswith("/out.png")
+
+
+def test_failed_charge_fails_the_job_and_drops_the_output(app, tmp_path, monkeypatch):
+    def broken(*args, **kwargs):
+        raise RuntimeError("ledger locked")
+
+    monkeypatch.setattr(jobs, "record_usage", broken)
+    job = jobs.wait(jobs.submit("img2img", _runner(tmp_path, "unpaid.png"), billing={"ip": "1.2.3.4"}).id)
+    assert job.status == "error" and job.error_code == 500
+    assert job.filename is None and job.image_id is None
+    assert "ledger locked" in json.loads(job.error)["detail"]
+    assert not (tmp_path / "unpaid.png").exists()
+
+
+def test_runner_error_is_reported(app, tmp_path):
+    def run(report):
+        return None, (400, json.dumps({"error": "bad"}))
+
+    job = jobs.wait(jobs.submit("img2img", run, billing={"ip": "1.2.3.4"}).id)
+    assert job.status == "error" and job.error_code == 400
+    assert jobs.job_payload(job)["error"] == "bad"
+
+
+def test_video_job_links_its_poster_and_discards_it_with_the_clip(app, tmp_path):
+    def run(report):
+        (tmp_path / "clip.mp4").write_bytes(b"mp4")
+        (tmp_path / "clip.jpg").write_bytes(b"jpg")
+        return "clip.mp4", None
+
+    job = jobs.wait(jobs.submit("img2vid", run, billing={"ip": "1.2.3.4"}, record=False).id)
+    assert jobs.job_payload(job)["poster"].endswith("/clip.jpg")
+    jobs._discard_output("clip.mp4")
+    assert not (tmp_path / "clip.mp4").exists() and not (tmp_path / "clip.jpg").exists()
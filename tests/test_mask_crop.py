@@ -0,0 +1,74 @@
+import numpy as np
+from PIL import Image
+
+import mask_crop
+
+
+def _mask(size, box, mode="L"):
+    values = np.zeros((size[1], size[0]), dtype=np.float32)
+    left, top, right, bottom = box
+    values[top:bottom, left:right] = 1.0
+    if mode == "RGBA":
+        rgba = np.zeros((size[1], size[0], 4), dtype=np.uint8)
+        rgba[..., 3] = (values * 255).astype(np.uint8)
+        return Image.fromarray(rgba)
+    return Image.fromarray((values * 255).astype(np.uint8))
+
+
+def test_mask_values_prefers_varying_alpha():
+    strokes = _mask((8, 8), (2, 2, 4, 4), "RGBA")
+    assert mask_crop.mask_values(strokes)[3, 3] == 1.0 and mask_crop.mask_values(strokes)[0, 0] == 0.0
+    opaque = Image.new("RGBA", (8, 8), (255, 255, 255, 255))
+    assert mask_crop.mask_values(opaque).min() == 1.0
+
+
+def test_mask_box_pads_clamps_and_handles_empty():
+    values = mask_crop.mask_values(_mask((100, 100), (40, 40, 60, 60)))
+    assert mask_crop.mask_box(values, 10) == (30, 30, 70, 70)
+    # Near the edge the box shifts inwards instead of shrinking
+    values = mask_crop.mask_values(_mask((100, 100), (0, 0, 10, 10)))
+    assert mask_crop.mask_box(values, 10) == (0, 0, 30, 30)
+    assert mask_crop.mask_box(np.zeros((10, 10), dtype=np.float32), 4) is None
+
+
+def test_mask_box_widens_thin_boxes():
+    values = mask_crop.mask_values(_mask((200, 200), (98, 20, 102, 180)))
+    left, top, right, bottom = mask_crop.mask_box(values, 0)
+    assert (bottom - top) <= 2.0 * (right - left) + 1
+    assert left <= 98 and right >= 102
+
+
+def test_target_size_keeps_area_and_aspect_on_multiples_of_8():
+    for box in ((0, 0, 100, 100), (0, 0, 1000, 400), (10, 10, 50, 170)):
+        w, h = mask_crop.target_size(box, 512)
+        assert w % 8 == 0 and h % 8 == 0
+        assert abs(w * h / 512.0 ** 2 - 1) < 0.1
+        bw, bh = box[2] - box[0], box[3] - box[1]
+        assert abs(w / h - bw / bh) < 0.1
+
+
+def test_crop_and_composite_only_change_the_masked_region(tmp_path):
+    rng = np.random.default_rng(0)
+    original = rng.integers(0, 255, (120, 160, 3), dtype=np.uint8)
+    Image.fromarray(original).save(tmp_path / "src.png")
+    _mask((160, 120), (60, 40, 90, 70)).save(tmp_path / "mask.png")
+
+    crop = mask_crop.crop_for_inpaint(str(tmp_path / "src.png"), str(tmp_path / "mask.png"), str(tmp_path),
+                                      resolution=128, padding=8)
+    assert crop.box == (52, 32, 98, 78)
+    assert Image.open(crop.image_path).size == crop.size
+    Image.new("RGB", crop.size, (0, 255, 0)).save(tmp_path / "gen.png")
+
+    out = mask_crop.composite(crop, str(tmp_path / "gen.png"), str(tmp_path / "out.png"), feather=2)
+    result = np.asarray(Image.open(out))
+    assert result.shape == original.shape
+    outside = np.ones(original.shape[:2], dtype=bool)
+    outside[32:78, 52:98] = False
+    assert (result[outside] == original[outside]).all()
+    assert (result[45:65, 65:85] == (0, 255, 0)).all()
+
+
+def test_empty_mask_gives_no_crop(tmp_path):
+    Image.new("RGB", (32, 32)).save(tmp_path / "src.png")
+    Image.new("L", (32, 32), 0).save(tmp_path / "mask.png")
+    assert mask_crop.crop_for_inpaint(str(tmp_path / "src.png"), str(tmp_path / "mask.png"), str(tmp_path)) is None
@@ -0,0 +1,53 @@
+import os
+import time
+
+from app import result_cache
+from app.models import ResultCacheEntry
+
+WORKFLOW = {
+    "3": {"class_type": "KSampler", "inputs": {"seed": 7, "steps": 20}, "_meta": {"title": "Sampler"}},
+    "10": {"class_type": "LoadImage", "inputs": {"image": "PLACEHOLDER"}},
+}
+
+
+def _with_image(path):
+    wf = {k: dict(v, inputs=dict(v["inputs"])) for k, v in WORKFLOW.items()}
+    wf["10"]["inputs"]["image"] = path
+    return wf
+
+
+def test_key_ignores_ui_metadata_and_key_order(tmp_path):
+    reordered = {"10": dict(WORKFLOW["10"]), "3": {"inputs": {"steps": 20, "seed": 7}, "class_type": "KSampler"}}
+    assert result_cache.cache_key(WORKFLOW) == result_cache.cache_key(reordered)
+    changed = dict(WORKFLOW, **{"3": {"class_type": "KSampler", "inputs": {"seed": 8, "steps": 20}}})
+    assert result_cache.cache_key(WORKFLOW) != result_cache.cache_key(changed)
+
+
+def test_key_follows_image_content_not_path(tmp_path):
+    a, b, c = tmp_path / "a.png", tmp_path / "b.png", tmp_path / "c.png"
+    a.write_bytes(b"same")
+    b.write_bytes(b"same")
+    c.write_bytes(b"different")
+    key = lambda p: result_cache.cache_key(_with_image(str(p)), {"image": str(p)})
+    assert key(a) == key(b)
+    assert key(a) != key(c)
+
+
+def test_store_lookup_and_lru_eviction(app, tmp_path):
+    app.config["RESULT_CACHE_DIR"] = str(tmp_path / "cache")
+    app.config["RESULT_CACHE_MAX_MB"] = 1
+    ResultCacheEntry.query.delete()
+    keys = []
+    for i in range(3):
+        src = tmp_path / f"out{i}.png"
+        src.write_bytes(os.urandom(400 * 1024))
+        key = f"{i:02d}" + "0" * 62
+        result_cache.store(key, "img2img", str(src))
+        keys.append(key)
+        time.sleep(0.01)
+        if i == 1:
+            assert result_cache.lookup(keys[0])  # refreshes entry 0, so entry 1 is the oldest
+    assert result_cache.lookup(keys[1]) is None
+    assert result_cache.lookup(keys[0]) and result_cache.lookup(keys[2])
+    copy = result_cache.copy_to(result_cache.lookup(keys[2]), str(tmp_path / "served"), "x.png")
+    assert open(copy, "rb").read() == (tmp_path / "out2.png").read_bytes()
@@ -0,0 +1,55 @@
+import threading
+
+import pytest
+from PIL import Image
+
+from app import thumbs
+from app.thumbs import VariantError
+
+
+@pytest.fixture
+def thumb_app(app, tmp_path):
+    app.config.update(THUMB_WIDTHS="128,256,512", THUMB_CACHE_DIR=str(tmp_path / "thumbs"), THUMB_CACHE_MAX_MB=0)
+    return app
+
+
+def test_normalize_snaps_widths_and_formats(thumb_app):
+    assert thumbs.normalize(100, None)[0] == 128
+    assert thumbs.normalize(300, "jpg") == (512, "jpeg")
+    assert thumbs.normalize(9999, "jpeg") == (512, "jpeg")
+    assert thumbs.normalize(None, "jpeg") == (512, "jpeg")
+    for width, fmt in ((0, "jpeg"), (128, "tiff")):
+        with pytest.raises(VariantError):
+            thumbs.normalize(width, fmt)
+
+
+def test_variant_renders_once_and_is_content_addressed(thumb_app, tmp_path):
+    src = tmp_path / "out.png"
+    Image.new("RGBA", (1000, 500), (255, 0, 0, 128)).save(src)
+    results = []
+
+    def request():
+        with thumb_app.app_context():
+            results.append(thumbs.variant(str(src), 200, "jpeg"))
+
+    threads = [threading.Thread(target=request) for _ in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert len(results) == 4 and len({r[1] for r in results}) == 1
+    path, etag, mimetype = results[0]
+    assert mimetype == "image/jpeg"
+    with Image.open(path) as im:
+        assert im.size == (256, 128) and im.mode == "RGB"
+    # Same pixels under another name share the cached variant
+    copy = tmp_path / "copy.png"
+    copy.write_bytes(src.read_bytes())
+    assert thumbs.variant(str(copy), 256, "jpeg")[1] == etag
+
+
+def test_variant_rejects_non_images(thumb_app, tmp_path):
+    clip = tmp_path / "clip.mp4"
+    clip.write_bytes(b"mp4")
+    with pytest.raises(VariantError):
+        thumbs.variant(str(clip), 128, "jpeg")
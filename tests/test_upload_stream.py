@@ -0,0 +1,106 @@
+import base64
+import hashlib
+import io
+import json
+import os
+
+import pytest
+from werkzeug.test import EnvironBuilder
+from werkzeug.wrappers import Request
+
+from upload_stream import CHUNK, PayloadError, _Base64Sink, read_payload
+
+FIELDS = {"image": "img", "mask": "mask"}
+
+
+def _json_request(body: bytes) -> Request:
+    return Request(EnvironBuilder(method="POST", data=body, content_type="application/json").get_environ())
+
+
+def _form_request(data) -> Request:
+    return Request(EnvironBuilder(method="POST", data=data, content_type="multipart/form-data").get_environ())
+
+
+def _read(path: str) -> bytes:
+    with open(path, "rb") as fh:
+        return fh.read()
+
+
+def test_json_image_field_is_decoded_to_a_file(tmp_path):
+    raw = os.urandom(3 * CHUNK + 7)
+    body = json.dumps({"prompt": "a cat", "image": "data:image/png;base64," + base64.b64encode(raw).decode(),
+                       "steps": 20, "extra": {"a": [1, "}"]}}).encode()
+    fields, files = read_payload(_json_request(body), FIELDS, str(tmp_path))
+    assert fields == {"prompt": "a cat", "steps": 20, "extra": {"a": [1, "}"]}}
+    assert set(files) == {"image"}
+    f = files["image"]
+    assert _read(f.path) == raw
+    assert f.size == len(raw) and f.sha256 == hashlib.sha256(raw).hexdigest()
+    assert f.mimetype == "image/png" and f.path.endswith(".png")
+
+
+def test_json_escaped_slashes_and_line_breaks(tmp_path):
+    raw = os.urandom(2000)
+    encoded = base64.encodebytes(raw).decode()  # "\n" every 76 chars -> "\\n" in JSON
+    body = json.dumps({"image": encoded}).replace("/", "\\/").encode()
+    _, files = read_payload(_json_request(body), FIELDS, str(tmp_path))
+    assert _read(files["image"].path) == raw
+
+
+def test_empty_image_field_counts_as_absent(tmp_path):
+    fields, files = read_payload(_json_request(b'{"image": "", "n": 1}'), FIELDS, str(tmp_path))
+    assert fields == {"n": 1} and files == {}
+    assert os.listdir(tmp_path) == []
+
+
+@pytest.mark.parametrize("body, message", [
+    (b"", "未提供資料"),
+    (b"[1, 2]", "請以 JSON 物件傳送資料"),
+    (b'{"image": "QUJD', "JSON 資料不完整"),
+    (b'{"image": "QU!D"}', "Base64"),
+    (b'{"image": "data:image/png;base64"}', "無效的圖片資料"),
+])
+def test_json_errors_remove_partial_files(tmp_path, body, message):
+    with pytest.raises(PayloadError) as exc:
+        read_payload(_json_request(body), FIELDS, str(tmp_path))
+    assert message in str(exc.value) and exc.value.status == 400
+    assert os.listdir(tmp_path) == []
+
+
+def test_size_limits_answer_413(tmp_path, monkeypatch):
+    monkeypatch.setenv("UPLOAD_MAX_MB", "0.01")
+    body = json.dumps({"image": base64.b64encode(os.urandom(20000)).decode()}).encode()
+    with pytest.raises(PayloadError) as exc:
+        read_payload(_json_request(body), FIELDS, str(tmp_path))
+    assert exc.value.status == 413
+    monkeypatch.setenv("UPLOAD_MAX_FIELDS_KB", "1")
+    with pytest.raises(PayloadError) as exc:
+        read_payload(_json_request(json.dumps({"prompt": "x" * 2048}).encode()), FIELDS, str(tmp_path))
+    assert exc.value.status == 413
+    assert os.listdir(tmp_path) == []
+
+
+def test_multipart_file_part_and_json_form_value(tmp_path):
+    raw = b"\x89PNG\r\n\x1a\n" + os.urandom(CHUNK + 1)
+    req = _form_request({"image": (io.BytesIO(raw), "a.png", "image/png"), "opts": '{"steps": 4}', "prompt": "x"})
+    fields, files = read_payload(req, FIELDS, str(tmp_path))
+    assert fields == {"opts": {"steps": 4}, "prompt": "x"}
+    assert _read(files["image"].path) == raw and files["image"].path.endswith(".png")
+
+
+def test_multipart_mime_wrapped_base64_form_field(tmp_path):
+    raw = os.urandom(2 * CHUNK)  # line breaks shift the 4-char groups across chunk boundaries
+    req = _form_request({"image": "data:image/jpeg;base64," + base64.encodebytes(raw).decode(),
+                         "mask": base64.encodebytes(raw[:100]).decode().replace("\n", "\r\n")})
+    _, files = read_payload(req, FIELDS, str(tmp_path))
+    assert _read(files["image"].path) == raw and files["image"].path.endswith(".jpg")
+    assert _read(files["mask"].path) == raw[:100]
+
+
+def test_sink_ignores_whitespace_between_fed_pieces(tmp_path):
+    raw = os.urandom(3000)
+    text = base64.encodebytes(raw)
+    sink = _Base64Sink(str(tmp_path), "img", 1 << 20)
+    for i in range(0, len(text), 77):
+        sink.feed(text[i:i + 77])
+    assert _read(sink.close().path) == raw
@@ -0,0 +1,31 @@
+import pytest
+
+from app import video_render
+
+
+def test_clip_options_defaults_and_optional_size():
+    assert video_render.clip_options(None, None, None, None) == (4.0, 24, None)
+    assert video_render.clip_options("2.5", "30", "640", "") == (2.5, 30, None)
+    assert video_render.clip_options("30", "60", "1920", "1080") == (30.0, 60, (1920, 1080))
+
+
+@pytest.mark.parametrize("duration, fps, width, height", [
+    ("0", "24", None, None),
+    ("31", "24", None, None),
+    ("4", "0", None, None),
+    ("4", "61", None, None),
+    ("4", "12.5", None, None),
+    ("abc", "24", None, None),
+    ("4", "24", "20000", "20000"),
+    ("4", "24", "8", "512"),
+    ("4", "24", "640", "x"),
+])
+def test_clip_options_rejects_out_of_range(duration, fps, width, height):
+    with pytest.raises(ValueError):
+        video_render.clip_options(duration, fps, width, height)
+
+
+def test_pick_output_size_is_even():
+    assert video_render.pick_output_size(1000, 500, None) == (720, 360)
+    assert video_render.pick_output_size(333, 1000, None) == (240, 720)
+    assert video_render.pick_output_size(10, 10, (641, 481)) == (640, 480)
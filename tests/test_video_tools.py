@@ -0,0 +1,183 @@
+import os
+import shutil
+import subprocess
+import threading
+import time
+
+import pytest
+
+import video_tools
+from video_tools import (Segment, SegmentedRender, crossfade, faststart, moov_first, plan_segments, poster,
+                         segment_overlap)
+
+
+def test_short_clip_or_disabled_is_one_segment():
+    assert plan_segments(64, 64, 8) == [Segment(0, 0, 64)]
+    assert plan_segments(320, 0, 8) == [Segment(0, 0, 320)]
+    assert plan_segments(0, 64, 8) == [Segment(0, 0, 1)]
+
+
+def test_segments_overlap_and_cover_the_clip():
+    for total, max_frames, overlap in ((160, 64, 8), (320, 64, 8), (65, 64, 8), (1000, 48, 0), (200, 16, 40)):
+        segments = plan_segments(total, max_frames, overlap)
+        used = max(0, min(overlap, max_frames // 2))
+        assert [s.index for s in segments] == list(range(len(segments)))
+        assert segments[0].start == 0
+        assert segments[-1].start + segments[-1].frames == total
+        assert all(0 < s.frames <= max_frames for s in segments)
+        for prev, cur in zip(segments, segments[1:]):
+            assert prev.start + prev.frames - cur.start == used
+        assert segment_overlap(segments) == (used if len(segments) > 1 else 0)
+
+
+def test_segment_overlap_is_the_clamped_value():
+    # 12-frame windows can overlap by at most 6, whatever was asked for
+    assert segment_overlap(plan_segments(40, 12, 8)) == 6
+    assert segment_overlap(plan_segments(40, 64, 8)) == 0
+
+
+def test_segments_are_about_equal_length():
+    frames = [s.frames for s in plan_segments(160, 64, 8)]
+    assert max(frames) - min(frames) <= 1
+
+
+# ----------------------------------------------------------------------
+# ffmpeg helpers
+# ----------------------------------------------------------------------
+@pytest.fixture(scope="module")
+def clip_factory(tmp_path_factory):
+    try:
+        video_tools.ffmpeg_exe()
+    except Exception:
+        pytest.skip("ffmpeg not available")
+    folder = tmp_path_factory.mktemp("clips")
+
+    def make(name, frames, fps=16):
+        path = str(folder / name)
+        # No +faststart: the moov box ends up after mdat, like VHS_VideoCombine output
+        video_tools.run_ffmpeg(["-f", "lavfi", "-i", f"testsrc=size=64x64:rate={fps}", "-frames:v", str(frames),
+                                "-pix_fmt", "yuv420p", path])
+        return path
+
+    return make
+
+
+def _frame_count(path):
+    err = subprocess.run([video_tools.ffmpeg_exe(), "-i", path, "-map", "0:v", "-f", "null", "-"],
+                         capture_output=True, text=True).stderr
+    return int([line for line in err.splitlines() if "frame=" in line][-1].split("frame=")[1].split()[0])
+
+
+def test_faststart_moves_moov_in_place(clip_factory, tmp_path):
+    path = clip_factory("late_moov.mp4", 8)
+    assert not moov_first(path)
+    faststart(path)
+    assert moov_first(path)
+    before = os.path.getmtime(path)
+    faststart(path)  # already fast-start: untouched
+    assert os.path.getmtime(path) == before
+    assert not [f for f in os.listdir(os.path.dirname(path)) if f.endswith(".tmp")]
+
+
+def test_moov_first_on_truncated_or_foreign_files(tmp_path):
+    junk = tmp_path / "junk.mp4"
+    junk.write_bytes(b"\x00\x00")
+    assert not moov_first(str(junk))
+    junk.write_bytes(b"\x00\x00\x00\x04free")  # box size smaller than its header
+    assert not moov_first(str(junk))
+
+
+def test_poster_is_the_first_frame(clip_factory):
+    from PIL import Image
+
+    path = clip_factory("posterclip.mp4", 4)
+    out = poster(path)
+    assert out == os.path.splitext(path)[0] + ".jpg"
+    with Image.open(out) as im:
+        assert im.format == "JPEG" and im.size == (64, 64)
+
+
+def test_crossfade_joins_overlapping_segments(clip_factory, tmp_path):
+    segments = plan_segments(100, 40, 8)
+    paths = [clip_factory(f"seg{s.index}.mp4", s.frames) for s in segments]
+    out = crossfade(paths, [s.frames for s in segments], str(tmp_path / "joined.mp4"), 16, 8)
+    assert _frame_count(out) == 100
+    assert moov_first(out)
+    single = crossfade(paths[:1], [segments[0].frames], str(tmp_path / "single.mp4"), 16, 8)
+    assert _frame_count(single) == segments[0].frames
+
+
+# ----------------------------------------------------------------------
+# SegmentedRender
+# ----------------------------------------------------------------------
+class FakeClient:
+    def __init__(self, clip):
+        self.clip = clip
+        self.cancelled = []
+
+    def fetch_output(self, record, dest):
+        shutil.copyfile(self.clip, dest)
+
+    def cancel(self, prompt_id):
+        self.cancelled.append(prompt_id)
+
+
+class FakeNode:
+    def __init__(self, client):
+        self.client = client
+
+
+class FakePool:
+    """Runs segment i after delays[i] seconds; segments listed in ``fail`` raise."""
+
+    def __init__(self, clip, delays, fail=()):
+        self.node = FakeNode(FakeClient(clip))
+        self.delays = delays
+        self.fail = set(fail)
+        self.prepared = []
+
+    def run(self, workflow, listener=None, prepare=None, on_submit=None, timeout=None):
+        index = workflow["index"]
+        if prepare is not None:
+            prepare(self.node.client)
+        on_submit(f"p{index}", self.node)
+        listener("progress", {"value": 5, "max": 10, "node": "3"})
+        time.sleep(self.delays[index])
+        if index in self.fail:
+            raise RuntimeError(f"segment {index} failed")
+        return self.node, {"prompt_id": f"p{index}", "outputs": {"9": {"gifs": [{"filename": f"{index}.mp4"}]}}}
+
+
+def test_segments_are_announced_in_order_and_remuxed(clip_factory, tmp_path):
+    clip = clip_factory("part.mp4", 8)
+    segments = plan_segments(100, 40, 8)
+    pool = FakePool(clip, delays=[0.3, 0.0, 0.1])
+    announced, progress = [], []
+    lock = threading.Lock()
+
+    def emit(event, **data):
+        if event == "progress":
+            with lock:
+                progress.append(data["value"])
+
+    render = SegmentedRender(pool, segments, lambda seg: {"index": seg.index}, str(tmp_path), "clip",
+                             prepare=lambda workflow, client: pool.prepared.append(workflow["index"]), emit=emit,
+                             on_segment=lambda seg, path: announced.append((seg.index, os.path.basename(path))))
+    parts = render.run()
+    assert [os.path.basename(p) for p in parts] == ["clip_part0.mp4", "clip_part1.mp4", "clip_part2.mp4"]
+    assert announced == [(0, "clip_part0.mp4"), (1, "clip_part1.mp4"), (2, "clip_part2.mp4")]
+    assert all(moov_first(p) for p in parts)
+    assert sorted(pool.prepared) == [0, 1, 2]
+    assert max(progress) <= 100 and progress[-1] >= progress[0]
+
+
+def test_a_failed_segment_cancels_the_rest_and_removes_parts(clip_factory, tmp_path):
+    clip = clip_factory("part_fail.mp4", 8)
+    segments = plan_segments(100, 40, 8)
+    pool = FakePool(clip, delays=[0.0, 0.2, 0.0], fail={1})
+    render = SegmentedRender(pool, segments, lambda seg: {"index": seg.index}, str(tmp_path), "bad")
+    with pytest.raises(RuntimeError, match="segment 1 failed"):
+        render.run()
+    assert render.cancelled
+    assert sorted(pool.node.client.cancelled) == ["p0", "p1", "p2"]
+    assert not [f for f in os.listdir(tmp_path) if f.startswith("bad_part")]
@@ -0,0 +1,105 @@
+import copy
+import importlib.util
+import json
+import os
+
+import pytest
+
+# backend/ is not a package and has its own config.py; load the module by path
+_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "backend", "workflows.py")
+_spec = importlib.util.spec_from_file_location("backend_workflows", _PATH)
+workflows = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(workflows)
+
+TEXT = json.dumps({
+    "3": {"class_type": "KSampler", "inputs": {
+        "seed": 1, "steps": 20, "cfg": 7, "denoise": 1.0,
+        "model": ["4", 0], "positive": ["6", 0], "negative": ["7", 0], "latent_image": ["5", 0]}},
+    "4": {"class_type": "CheckpointLoaderSimple", "inputs": {"ckpt_name": "base.safetensors"}},
+    "5": {"class_type": "EmptyLatentImage", "inputs": {"width": 512, "height": 512, "batch_size": 1}},
+    "6": {"class_type": "CLIPTextEncode", "inputs": {"text": "", "clip": ["4", 1]}},
+    "7": {"class_type": "CLIPTextEncode", "inputs": {"text": "", "clip": ["4", 1]}},
+    "10": {"class_type": "LoadImage", "inputs": {"image": "a.png"}},
+    "11": {"class_type": "LoadImage", "inputs": {"image": "b.png"}},
+    "9": {"class_type": "SaveImage", "inputs": {"images": ["3", 0], "filename_prefix": "out"}},
+})
+
+
+class Uploaded:
+    ref = "sub/name.png"
+    url = "http://comfy/view?filename=name.png"
+
+
+def test_validate_rejects_ui_format_and_dangling_links():
+    with pytest.raises(workflows.WorkflowError, match="UI-format"):
+        workflows.validate({"nodes": [], "links": []})
+    with pytest.raises(workflows.WorkflowError, match="missing node 99"):
+        workflows.validate({"1": {"class_type": "X", "inputs": {"a": ["99", 0]}}})
+    with pytest.raises(workflows.WorkflowError, match="missing class_type"):
+        workflows.validate({"1": {"inputs": {}}})
+    with pytest.raises(workflows.WorkflowError):
+        workflows.validate([])
+
+
+def test_slots_follow_the_sampler_to_its_encoders():
+    template = workflows.template_from_text(TEXT)
+    assert [s.node_id for s in template.slot("prompt")] == ["6"]
+    assert [s.node_id for s in template.slot("negative")] == ["7"]
+    assert [s.node_id for s in template.slot("image")] == ["10", "11"]
+    assert template.slot("mask", required=False) == ()
+    with pytest.raises(workflows.WorkflowError):
+        template.slot("mask")
+
+
+def test_template_is_read_only():
+    template = workflows.template_from_text(TEXT)
+    with pytest.raises(TypeError):
+        template.nodes["3"]["inputs"]["seed"] = 2
+    assert copy.deepcopy(template.nodes)["3"]["inputs"]["seed"] == 1
+
+
+def test_instances_copy_only_the_nodes_they_write():
+    template = workflows.template_from_text(TEXT)
+    first, second = template.instantiate(), template.instantiate()
+
+    first.inputs("3")["seed"] = 42
+
+    assert template.nodes["3"]["inputs"]["seed"] == 1
+    assert second["3"]["inputs"]["seed"] == 1
+    assert dict.__getitem__(first, "5") is template.nodes["5"]
+    assert json.loads(json.dumps(first))["3"]["inputs"]["seed"] == 42
+
+
+def test_patch_writes_every_slot_in_one_pass():
+    wf = workflows.instantiate_text(TEXT).patch({
+        "prompt": "a cat", "negative": "blurry", "seed": 7, "width": 768, "height": None,
+        "image": (Uploaded(), "plain.png"),
+    })
+    assert wf["6"]["inputs"]["text"] == "a cat"
+    assert wf["7"]["inputs"]["text"] == "blurry"
+    assert wf["3"]["inputs"]["seed"] == 7
+    assert wf["5"]["inputs"]["width"] == 768
+    assert wf["5"]["inputs"]["height"] == 512
+    assert wf["10"]["inputs"]["image"] == Uploaded.ref
+    assert wf["11"]["inputs"]["image"] == "plain.png"
+
+
+def test_patch_rejects_bad_keys_without_writing():
+    wf = workflows.instantiate_text(TEXT)
+    with pytest.raises(workflows.WorkflowError, match="unknown patch keys"):
+        wf.patch({"seed": 5, "nope": 1})
+    with pytest.raises(workflows.WorkflowError, match="no slot for: mask"):
+        wf.patch({"seed": 5, "mask": "m.png"})
+    with pytest.raises(workflows.WorkflowError, match="expects 2 values"):
+        wf.patch({"image": ["only.png"]})
+    assert wf["3"]["inputs"]["seed"] == 1
+
+    wf.patch({"seed": 5, "mask": "m.png"}, optional=("mask",))
+    assert wf["3"]["inputs"]["seed"] == 5
+
+
+def test_from_file_reports_invalid_json(tmp_path):
+    path = tmp_path / "broken.json"
+    path.write_text("{", encoding="utf-8")
+    with pytest.raises(workflows.WorkflowError, match="invalid JSON"):
+        workflows.WorkflowTemplate.from_file(str(path))
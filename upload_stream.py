@@ -0,0 +1,357 @@
+"""Reading image uploads from request bodies with bounded memory.
+
+The standalone services take images as base64 data URLs inside JSON bodies.
+``request.get_json()`` followed by ``base64.b64decode`` holds the raw body, the
+parsed string and the decoded bytes at once -- about three times the image per
+request.  ``read_payload`` instead scans the body from ``request.stream`` in
+``CHUNK`` byte pieces: the listed image fields are base64-decoded straight into
+files as their text arrives (SHA-256 and size computed on the way), and only
+the remaining small fields are parsed as JSON.
+
+A ``multipart/form-data`` body with the same field names works as well: file
+parts are copied from Werkzeug's spooled temp files in chunks, a data URL sent
+as a plain form field is decoded the same way as in JSON, and other form values
+that look like JSON objects/arrays are decoded.
+
+Limits (``UPLOAD_MAX_MB`` per image, ``UPLOAD_MAX_FIELDS_KB`` for everything
+else) are read from the Flask config or the environment.  Failures raise
+``PayloadError`` with a client message and an HTTP ``status``; files written
+for a failed request are removed.
+"""
+import binascii
+import hashlib
+import json
+import os
+import uuid
+from typing import Dict, NamedTuple, Optional, Tuple
+
+
+CHUNK = 64 * 1024
+_HEADER_LIMIT = 256  # "data:image/...;base64," prefix
+_WHITESPACE = b" \t\r\n"
+# JSON escapes that may appear inside base64 text: "\/" and line breaks
+_ESCAPES = {ord("/"): b"/", ord("n"): b"", ord("r"): b"", ord("t"): b""}
+_MIME_EXTS = {"image/png": ".png", "image/jpeg": ".jpg", "image/jpg": ".jpg", "image/webp": ".webp",
+              "image/bmp": ".bmp", "image/gif": ".gif"}
+
+
+class PayloadError(ValueError):
+    """A request body that cannot be read; ``status`` is the HTTP status to answer with."""
+
+    def __init__(self, message: str, status: int = 400):
+        super().__init__(message)
+        self.status = status
+
+
+class StreamedFile(NamedTuple):
+    path: str
+    sha256: str
+    size: int
+    mimetype: Optional[str]
+
+    def describe(self) -> Dict:
+        """Short stand-in for the field in logs and echoed parameters."""
+        return {"file": os.path.basename(self.path), "bytes": self.size, "sha256": self.sha256[:16]}
+
+
+def _setting(name: str, default: str = "") -> str:
+    # The main app reads config.py; the standalone backend services only have env vars
+    try:
+        from flask import current_app
+
+        value = current_app.config.get(name)
+    except (ImportError, RuntimeError):
+        value = None
+    return str(value if value is not None else os.getenv(name, default))
+
+
+def read_payload(req, image_fields: Dict[str, str], folder: str) -> Tuple[Dict, Dict[str, StreamedFile]]:
+    """Read ``req``'s body: ``(fields, files)``.
+
+    ``image_fields`` maps each image field name to the file name prefix it is
+    stored under in ``folder``.  ``files`` has the image fields that were sent
+    with any content (as ``StreamedFile``); ``fields`` has every other value.
+    """
+    max_bytes = int(float(_setting("UPLOAD_MAX_MB", "25")) * 1024 * 1024)
+    max_fields = int(_setting("UPLOAD_MAX_FIELDS_KB", "256")) * 1024
+    os.makedirs(folder, exist_ok=True)
+    files: Dict[str, StreamedFile] = {}
+    try:
+        if req.mimetype == "multipart/form-data":
+            fields = _read_multipart(req, image_fields, folder, files, max_bytes)
+        else:
+            fields = _JsonScanner(req.stream, image_fields, folder, files, max_bytes, max_fields).read()
+    except BaseException:
+        for f in files.values():
+            _discard(f.path)
+        raise
+    return fields, files
+
+
+def _read_multipart(req, image_fields, folder, files, max_bytes) -> Dict:
+    fields = {}
+    for key, value in req.form.items():
+        if key in image_fields and value:
+            sink = _Base64Sink(folder, image_fields[key], max_bytes)
+            for i in range(0, len(value), CHUNK):
+                sink.feed(value[i:i + CHUNK].encode("ascii", "replace"))
+            _keep(files, key, sink.close())
+        elif value[:1] in ("{", "["):
+            try:
+                fields[key] = json.loads(value)
+            except ValueError:
+                fields[key] = value
+        else:
+            fields[key] = value
+    for key, storage in req.files.items():
+        if key not in image_fields or not storage.filename:
+            continue
+        sink = _FileSink(folder, image_fields[key], max_bytes, storage.mimetype)
+        while True:
+            chunk = storage.stream.read(CHUNK)
+            if not chunk:
+                break
+            sink.write(chunk)
+        _keep(files, key, sink.close())
+    return fields
+
+
+def _keep(files: Dict, key: str, streamed: Optional[StreamedFile]) -> None:
+    if streamed is not None:
+        files[key] = streamed
+
+
+class _FileSink:
+    """Temp file that hashes and counts what is written and gets its final name on close."""
+
+    def __init__(self, folder: str, prefix: str, max_bytes: int, mimetype: Optional[str] = None):
+        self.folder, self.prefix, self.max_bytes, self.mimetype = folder, prefix, max_bytes, mimetype
+        self.tmp = os.path.join(folder, f".{prefix}_{uuid.uuid4().hex}.part")
+        self.fh = open(self.tmp, "wb")
+        self.hash = hashlib.sha256()
+        self.size = 0
+        self.head = b""
+
+    def write(self, data: bytes) -> None:
+        if not data:
+            return
+        self.size += len(data)
+        if self.size > self.max_bytes:
+            self.abort()
+            raise PayloadError(f"圖片過大（上限 {self.max_bytes // (1024 * 1024)} MB）", 413)
+        if len(self.head) < 16:
+            self.head += data[:16]
+        self.hash.update(data)
+        self.fh.write(data)
+
+    def close(self) -> Optional[StreamedFile]:
+        """The stored file, or None when nothing was written (an empty field counts as not sent)."""
+        self.fh.close()
+        if not self.size:
+            _discard(self.tmp)
+            return None
+        ext = _MIME_EXTS.get((self.mimetype or "").lower()) or _sniff_ext(self.head)
+        path = os.path.join(self.folder, f"{self.prefix}_{uuid.uuid4().hex}{ext}")
+        os.replace(self.tmp, path)
+        return StreamedFile(path, self.hash.hexdigest(), self.size, self.mimetype)
+
+    def abort(self) -> None:
+        self.fh.close()
+        _discard(self.tmp)
+
+
+class _Base64Sink(_FileSink):
+    """``_FileSink`` fed base64 text (optionally a data URL), decoded in 4-character groups."""
+
+    def __init__(self, folder: str, prefix: str, max_bytes: int):
+        super().__init__(folder, prefix, max_bytes)
+        self.pending = b""
+        self.in_header = True
+
+    def feed(self, text: bytes) -> None:
+        # MIME-wrapped base64 (line breaks every 76 chars) must not count towards the 4-char groups
+        text = self.pending + text.translate(None, _WHITESPACE)
+        if self.in_header:
+            if len(text) < 5 and text == b"data:"[:len(text)]:
+                self.pending = text
+                return
+            if text.startswith(b"data:"):
+                comma = text.find(b",")
+                if comma < 0:
+                    if len(text) > _HEADER_LIMIT:
+                        self.abort()
+                        raise PayloadError("無效的圖片資料")
+                    self.pending = text
+                    return
+                header = text[5:comma].decode("ascii", "replace")
+                self.mimetype = header.split(";", 1)[0].strip() or None
+                text = text[comma + 1:]
+            self.in_header = False
+        cut = len(text) - len(text) % 4
+        self.pending = text[cut:]
+        self._decode(text[:cut])
+
+    def _decode(self, text: bytes) -> None:
+        try:
+            self.write(binascii.a2b_base64(text))
+        except binascii.Error as e:
+            self.abort()
+            raise PayloadError(f"Base64 解碼錯誤：{e}")
+
+    def close(self) -> Optional[StreamedFile]:
+        if self.in_header and self.pending.startswith(b"data:"):
+            self.abort()
+            raise PayloadError("無效的圖片資料")
+        if self.pending.strip(b"="):
+            self._decode(self.pending + b"=" * (-len(self.pending) % 4))
+        return super().close()
+
+
+class _JsonScanner:
+    """Single pass over a JSON object body; image fields never exist as a whole in memory."""
+
+    def __init__(self, stream, image_fields, folder, files, max_bytes, max_fields):
+        self.stream = stream
+        self.image_fields = image_fields
+        self.folder = folder
+        self.files = files
+        self.max_bytes = max_bytes
+        self.budget = max_fields
+        self.buf = b""
+        self.pos = 0
+
+    def _fill(self) -> bool:
+        data = self.stream.read(CHUNK)
+        if not data:
+            return False
+        self.buf = self.buf[self.pos:] + data
+        self.pos = 0
+        return True
+
+    def _peek(self) -> int:
+        while True:
+            buf = self.buf
+            while self.pos < len(buf) and buf[self.pos] in _WHITESPACE:
+                self.pos += 1
+            if self.pos < len(buf):
+                return buf[self.pos]
+            if not self._fill():
+                raise PayloadError("JSON 資料不完整")
+
+    def _expect(self, chars: bytes) -> int:
+        c = self._peek()
+        if c not in chars:
+            raise PayloadError(f"JSON 格式錯誤（位置附近的字元：{chr(c)!r}）")
+        self.pos += 1
+        return c
+
+    def read(self) -> Dict:
+        fields = {}
+        try:
+            first = self._peek()
+        except PayloadError:
+            raise PayloadError("未提供資料")
+        if first != ord("{"):
+            raise PayloadError("請以 JSON 物件傳送資料")
+        self.pos += 1
+        if self._peek() == ord("}"):
+            return fields
+        while True:
+            if self._peek() != ord('"'):
+                raise PayloadError("JSON 格式錯誤（欄位名稱）")
+            key = self._loads(self._raw_value(b":"))
+            self._expect(b":")
+            if key in self.image_fields and self._peek() == ord('"'):
+                self.pos += 1
+                _keep(self.files, key, self._stream_image(self.image_fields[key]))
+            else:
+                fields[key] = self._loads(self._raw_value(b",}"))
+            if self._expect(b",}") == ord("}"):
+                return fields
+
+    def _loads(self, raw: bytes):
+        try:
+            return json.loads(raw.decode("utf-8"))
+        except ValueError as e:
+            raise PayloadError(f"JSON 格式錯誤：{e}")
+
+    def _raw_value(self, stop: bytes) -> bytes:
+        """Bytes of the JSON value starting here, up to ``stop`` outside strings/containers."""
+        out = bytearray()
+        depth = 0
+        in_str = escaped = False
+        while True:
+            if self.pos >= len(self.buf) and not self._fill():
+                raise PayloadError("JSON 資料不完整")
+            c = self.buf[self.pos]
+            if in_str:
+                if escaped:
+                    escaped = False
+                elif c == 0x5C:  # backslash
+                    escaped = True
+                elif c == 0x22:
+                    in_str = False
+            elif depth == 0 and c in stop:
+                return bytes(out)
+            elif c == 0x22:
+                in_str = True
+            elif c in b"{[":
+                depth += 1
+            elif c in b"}]":
+                depth -= 1
+            out.append(c)
+            self.pos += 1
+            self.budget -= 1
+            if self.budget < 0:
+                raise PayloadError("非圖片欄位資料過大", 413)
+
+    def _stream_image(self, prefix: str) -> Optional[StreamedFile]:
+        """Decode the string whose opening quote was just consumed into a file."""
+        sink = _Base64Sink(self.folder, prefix, self.max_bytes)
+        try:
+            while True:
+                if self.pos >= len(self.buf) and not self._fill():
+                    raise PayloadError("JSON 資料不完整")
+                buf = self.buf
+                quote = buf.find(b'"', self.pos)
+                slash = buf.find(b"\\", self.pos)
+                ends = [i for i in (quote, slash) if i >= 0]
+                end = min(ends) if ends else len(buf)
+                if end > self.pos:
+                    sink.feed(buf[self.pos:end])
+                    self.pos = end
+                if end == len(buf):
+                    continue
+                if end == quote:
+                    self.pos += 1
+                    return sink.close()
+                while len(self.buf) - self.pos < 2:
+                    if not self._fill():
+                        raise PayloadError("JSON 資料不完整")
+                repl = _ESCAPES.get(self.buf[self.pos + 1])
+                if repl is None:
+                    raise PayloadError("圖片欄位含有無效字元")
+                sink.feed(repl)
+                self.pos += 2
+        except BaseException:
+            sink.abort()
+            raise
+
+
+def _sniff_ext(head: bytes) -> str:
+    if head.startswith(b"\xff\xd8"):
+        return ".jpg"
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return ".webp"
+    if head.startswith(b"GIF8"):
+        return ".gif"
+    if head.startswith(b"BM"):
+        return ".bmp"
+    return ".png"
+
+
+def _discard(path: str) -> None:
+    try:
+        os.remove(path)
+    except OSError:
+        pass
@@ -0,0 +1,308 @@
+"""ffmpeg helpers shared by the app and the standalone video services.
+
+Long AnimateDiff clips
+----------------------
+One prompt for a whole clip makes its time and VRAM grow with the duration on
+a single GPU.  ``plan_segments`` splits the requested frame count into windows
+of at most ``max_frames`` that overlap by ``overlap`` frames (clamped to half a
+window; ``segment_overlap`` gives the value a plan used), and
+``SegmentedRender`` queues one prompt per window on the ComfyUI pool at the
+same time, so the pool's scheduler spreads them over every capable host.
+Each finished segment is fetched from the host that rendered it, handed to
+``on_segment`` as soon as it and every earlier segment are ready (the first
+one can be shown while the rest render), and ``crossfade`` joins them with an
+ffmpeg ``xfade`` over each overlap.
+
+Segments are separate prompts: their overlapping frames are not denoised
+together and no segment is conditioned on the previous one's tail, so the
+crossfade only blends two independent clips.  The services therefore leave
+segmentation off unless ``VIDEO_SEGMENT_FRAMES`` is set; within one prompt
+AnimateDiff's own context windows keep a long clip continuous.
+
+Progressive delivery
+--------------------
+A browser can only start an MP4 before it has the whole file when the
+``moov`` index comes before the media data.  ``faststart`` remuxes a file
+(stream copy, no re-encode) when ``moov_first`` says it is not laid out that
+way -- VHS_VideoCombine writes ``moov`` last -- and ``poster`` writes a JPEG
+of the first frame next to the video for ``<video poster>``.
+"""
+import logging
+import math
+import os
+import shutil
+import struct
+import subprocess
+import tempfile
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, NamedTuple, Optional
+
+from comfy_client import ComfyError, output_files
+from comfy_progress import ProgressTracker
+
+
+logger = logging.getLogger(__name__)
+
+
+def ffmpeg_exe() -> str:
+    """FFMPEG_BIN, else ffmpeg on PATH, else the binary bundled with imageio-ffmpeg."""
+    exe = os.getenv("FFMPEG_BIN") or shutil.which("ffmpeg")
+    if exe:
+        return exe
+    import imageio_ffmpeg
+
+    return imageio_ffmpeg.get_ffmpeg_exe()
+
+
+def run_ffmpeg(args: List[str]) -> None:
+    """Run ffmpeg with ``args``; raises RuntimeError with the tail of its log on failure."""
+    with tempfile.TemporaryFile() as errlog:
+        code = subprocess.call([ffmpeg_exe(), "-y", "-loglevel", "error"] + args, stderr=errlog)
+        if code != 0:
+            errlog.seek(0)
+            raise RuntimeError(f"ffmpeg 失敗 ({code}): {errlog.read().decode(errors='replace')[-500:]}")
+
+
+def moov_first(path: str) -> bool:
+    """Whether the MP4's ``moov`` box precedes ``mdat`` (walks the top-level box headers only)."""
+    with open(path, "rb") as fh:
+        while True:
+            header = fh.read(8)
+            if len(header) < 8:
+                return False
+            size, kind = struct.unpack(">I4s", header)
+            if kind == b"moov":
+                return True
+            if kind == b"mdat" or size == 0:  # size 0: box runs to the end of the file
+                return False
+            if size == 1:
+                large = fh.read(8)
+                if len(large) < 8:
+                    return False
+                size = struct.unpack(">Q", large)[0] - 8
+            if size < 8:
+                return False
+            fh.seek(size - 8, os.SEEK_CUR)
+
+
+def faststart(path: str) -> str:
+    """Move ``path``'s ``moov`` to the front in place (stream copy); a no-op when it already is."""
+    if moov_first(path):
+        return path
+    tmp = f"{path}.{uuid.uuid4().hex[:8]}.tmp"
+    try:
+        run_ffmpeg(["-i", path, "-map", "0", "-c", "copy", "-movflags", "+faststart", "-f", "mp4", tmp])
+        os.replace(tmp, path)
+    finally:
+        _discard(tmp)
+    return path
+
+
+def poster_path(video_path: str) -> str:
+    """Where ``poster`` puts the still for ``video_path``: same name, ``.jpg``."""
+    return os.path.splitext(video_path)[0] + ".jpg"
+
+
+def poster(video_path: str, out_path: Optional[str] = None) -> str:
+    """Write the first frame of ``video_path`` as a JPEG (``poster_path`` by default); returns its path."""
+    out_path = out_path or poster_path(video_path)
+    tmp = f"{out_path}.{uuid.uuid4().hex[:8]}.tmp"
+    try:
+        run_ffmpeg(["-i", video_path, "-map", "0:v:0", "-frames:v", "1", "-q:v", "3", "-f", "image2",
+                    "-c:v", "mjpeg", tmp])
+        os.replace(tmp, out_path)
+    finally:
+        _discard(tmp)
+    return out_path
+
+
+class Segment(NamedTuple):
+    index: int
+    start: int   # first frame of the clip this segment covers
+    frames: int
+
+
+def plan_segments(total: int, max_frames: int, overlap: int) -> List[Segment]:
+    """Overlapping windows of about equal length covering ``total`` frames.
+
+    A clip that fits in ``max_frames`` (or ``max_frames <= 0``) is one segment.
+    """
+    total = max(1, int(total))
+    if max_frames <= 0 or total <= max_frames:
+        return [Segment(0, 0, total)]
+    overlap = max(0, min(int(overlap), max_frames // 2))
+    count = math.ceil((total - overlap) / float(max_frames - overlap))
+    length = math.ceil((total + (count - 1) * overlap) / float(count))
+    segments = []
+    start = 0
+    for i in range(count):
+        frames = min(length, total - start)
+        segments.append(Segment(i, start, frames))
+        start += length - overlap
+    return segments
+
+
+def segment_overlap(segments: List[Segment]) -> int:
+    """Frames each segment of a ``plan_segments`` plan shares with the previous one.
+
+    ``plan_segments`` clamps the requested overlap, so this is what ``crossfade``
+    must fade over; 0 for a single segment.
+    """
+    if len(segments) < 2:
+        return 0
+    first, second = segments[0], segments[1]
+    return first.start + first.frames - second.start
+
+
+def crossfade(paths: List[str], frames: List[int], out_path: str, fps: float, overlap: int, crf: int = 19) -> str:
+    """Join ``paths`` (``frames[i]`` frames each, in order) into ``out_path``, crossfading ``overlap`` frames at each seam."""
+    if len(paths) == 1:
+        shutil.copyfile(paths[0], out_path)
+        return out_path
+    fade = overlap / float(fps)
+    args: List[str] = []
+    for p in paths:
+        args += ["-i", p]
+    # Same timebase / rate on every input is what xfade needs
+    chains = [f"[{i}:v]settb=AVTB,setpts=PTS-STARTPTS,fps={fps},format=yuv420p[s{i}]" for i in range(len(paths))]
+    offset = 0.0
+    last = "s0"
+    for i in range(1, len(paths)):
+        offset += frames[i - 1] / float(fps) - fade
+        label = f"x{i}"
+        chains.append(f"[{last}][s{i}]xfade=transition=fade:duration={fade:.4f}:offset={offset:.4f}[{label}]")
+        last = label
+    args += [
+        "-filter_complex", ";".join(chains), "-map", f"[{last}]", "-an",
+        "-c:v", "libx264", "-preset", "veryfast", "-crf", str(crf), "-pix_fmt", "yuv420p",
+        "-movflags", "+faststart", out_path,
+    ]
+    run_ffmpeg(args)
+    return out_path
+
+
+class SegmentedRender:
+    """Render ``segments`` concurrently on a ``ComfyPool`` and collect their MP4s (remuxed to fast start).
+
+    ``build(segment)`` returns the workflow for one segment and
+    ``prepare(workflow, client)`` (optional) runs on the chosen host before it
+    is queued, e.g. to upload the input image there.  ``emit`` receives
+    ``ProgressTracker``-style events: the first segment's queue/node events and
+    one ``progress`` stream combined over all segments.
+    """
+
+    def __init__(self, pool, segments: List[Segment], build: Callable[[Segment], Dict], out_dir: str, stem: str,
+                 prepare: Optional[Callable] = None, emit: Optional[Callable[..., None]] = None,
+                 on_segment: Optional[Callable[[Segment, str], None]] = None, timeout: Optional[float] = None):
+        self.pool = pool
+        self.segments = segments
+        self.build = build
+        self.out_dir = out_dir
+        self.stem = stem
+        self.prepare = prepare
+        self.emit = emit or (lambda event, **data: None)
+        self.on_segment = on_segment
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._cancelled = threading.Event()
+        self._submitted: List = []
+        self._fraction: Dict[int, float] = {}
+        self._ready: Dict[int, str] = {}
+        self._announced = 0
+
+    def cancel(self) -> None:
+        """Dequeue / interrupt every segment; ``run`` then raises."""
+        self._cancelled.set()
+        with self._lock:
+            submitted = list(self._submitted)
+        for node, prompt_id in submitted:
+            try:
+                node.client.cancel(prompt_id)
+            except Exception as e:
+                logger.warning("Cancelling segment prompt %s failed: %s", prompt_id, e)
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancelled.is_set()
+
+    def run(self) -> List[str]:
+        """Paths of the segment MP4s in order; raises if any segment fails (the others are cancelled)."""
+        ex = ThreadPoolExecutor(max_workers=len(self.segments), thread_name_prefix="segment")
+        futures = [ex.submit(self._render, seg) for seg in self.segments]
+        try:
+            return [f.result() for f in futures]
+        except BaseException:
+            self.cancel()
+            ex.shutdown(wait=True, cancel_futures=True)
+            for f in futures:
+                if f.done() and not f.cancelled() and f.exception() is None:
+                    _discard(f.result())
+            raise
+        finally:
+            ex.shutdown(wait=False)
+
+    def _render(self, seg: Segment) -> str:
+        if self._cancelled.is_set():
+            raise ComfyError("已取消")
+        workflow = self.build(seg)
+        tracker = ProgressTracker(lambda event, **data: self._relay(seg, event, data), workflow)
+
+        def on_submit(prompt_id, node):
+            with self._lock:
+                self._submitted.append((node, prompt_id))
+            if self._cancelled.is_set():
+                node.client.cancel(prompt_id)
+            elif seg.index == 0:
+                tracker.watch_queue(node.client, prompt_id)
+
+        prepare = (lambda client: self.prepare(workflow, client)) if self.prepare else None
+        try:
+            node, result = self.pool.run(workflow, listener=tracker.listener, prepare=prepare, on_submit=on_submit,
+                                         timeout=self.timeout)
+        finally:
+            tracker.stop()
+        if self._cancelled.is_set():
+            raise ComfyError("已取消")
+        files = output_files(result.get("outputs"), exts=(".mp4",))
+        if not files:
+            raise ComfyError(f"第 {seg.index + 1} 段沒有輸出影片")
+        path = os.path.join(self.out_dir, f"{self.stem}_part{seg.index}.mp4")
+        node.client.fetch_output(files[0], path)
+        faststart(path)
+        self._finished(seg, path)
+        return path
+
+    def _relay(self, seg: Segment, event: str, data: Dict) -> None:
+        if event == "progress":
+            if not data.get("max"):
+                return
+            with self._lock:
+                self._fraction[seg.index] = data["value"] / float(data["max"])
+                done = sum(self._fraction.values())
+            total = len(self.segments)
+            self.emit("progress", value=round(done * 100 / total), max=100, node=data.get("node"),
+                      eta=data.get("eta"))
+        elif seg.index == 0 and event in ("queued", "started", "executing"):
+            self.emit(event, **data)
+
+    def _finished(self, seg: Segment, path: str) -> None:
+        # Announce segments strictly in order, each as soon as it and all before it exist
+        with self._lock:
+            self._ready[seg.index] = path
+            self._fraction[seg.index] = 1.0
+            ready = []
+            while self._announced in self._ready:
+                ready.append(self.segments[self._announced])
+                self._announced += 1
+        if self.on_segment is not None:
+            for s in ready:
+                self.on_segment(s, self._ready[s.index])
+
+
+def _discard(path: str) -> None:
+    try:
+        os.remove(path)
+    except OSError:
+        pass